@@ -1,20 +1,21 @@
 import json
-from collections import OrderedDict
-from datetime import datetime, timedelta
-from typing import Any, List
+from collections import defaultdict, OrderedDict
+from datetime import date, datetime, timedelta, tzinfo
+from typing import Any, DefaultDict, Dict, List, Optional, Tuple
 
-import pytz
+from django.db.models import Max, Min, QuerySet
 from django.shortcuts import render
-from django.utils.timezone import make_aware
 
 from authentication.admin_authentication import authenticate_researcher_study_access
 from constants.dashboard_constants import COMPLETE_DATA_STREAM_DICT, PROCESSED_DATA_STREAM_DICT
 from constants.data_stream_constants import ALL_DATA_STREAMS
 from constants.datetime_constants import API_DATE_FORMAT
 from database.dashboard_models import DashboardColorSetting, DashboardGradient, DashboardInflection
-from database.data_access_models import ChunkRegistry, PipelineRegistry
+from database.data_access_models import ChunkRegistry, ChunkTimeRange, PipelineRegistry
 from database.study_models import Study
+from database.tableau_api_models import SummaryStatisticDaily
 from database.user_models import Participant
+from libs.file_processing.data_qty_stats import utc_datetime_of_local_midnight_date
 from libs.internal_types import ResearcherRequest
 from middleware.abort_middleware import abort
 
@@ -108,28 +109,23 @@ def get_data_for_dashboard_datastream_display(
 
     # --------------------- decide whether data is in Processed DB or Bytes DB -----------------------------
     if data_stream in ALL_DATA_STREAMS:
-        first_day, last_day = dashboard_chunkregistry_date_query(study_id, data_stream)
+        # days are in the study's timezone, like the SummaryStatisticDaily byte counts
+        first_day, last_day = dashboard_chunkregistry_date_query(study_id, data_stream, study.timezone)
         if first_day is not None:
-            stream_data = OrderedDict(
-                (
-                    participant.patient_id,
-                    dashboard_chunkregistry_query(participant.id, data_stream=data_stream)
-                )
-                for participant in participant_objects
-            )
             unique_dates, _, _ = get_unique_dates(start, end, first_day, last_day)
             next_url, past_url = create_next_past_urls(first_day, last_day, start=start, end=end)
 
             # get the byte streams per date for each patient for a specific data stream for those dates
+            byte_matrix = dashboard_daily_bytes_matrix(
+                study_id, [participant.id for participant in participant_objects], data_stream,
+                unique_dates, study.timezone,
+            )
             byte_streams = OrderedDict(
-                (
-                    participant.patient_id,
-                    [get_bytes_participant_match(stream_data[participant.patient_id], date) for date in unique_dates]
-                )
-                for participant in participant_objects
+                (participant.patient_id, byte_row)
+                for participant, byte_row in zip(participant_objects, byte_matrix)
             )
             # check if there is data to display
-            data_exists = len([data for patient in byte_streams for data in byte_streams[patient] if data is not None]) > 0
+            data_exists = any(data is not None for byte_row in byte_matrix for data in byte_row)
     else:
         start, end = extract_date_args_from_request(request)
         first_day, last_day, stream_data = parse_processed_data(study_id, participant_objects, data_stream)
@@ -185,7 +181,6 @@ def dashboard_participant_page(request: ResearcherRequest, study_id, patient_id)
     study = Study.get_or_404(pk=study_id)
     participant = get_participant(patient_id, study_id)
     start, end = extract_date_args_from_request(request)
-    chunks = dashboard_chunkregistry_query(participant.id)
     patient_ids = list(
         Participant.objects.filter(study=study_id)
         .exclude(patient_id=patient_id)
@@ -193,29 +188,27 @@ def dashboard_participant_page(request: ResearcherRequest, study_id, patient_id)
     )
 
     # ----------------- dates for bytes data streams -----------------------
-    if chunks:
-        first_day, last_day = dashboard_chunkregistry_date_query(study_id)
-        _, first_date_data_entry, last_date_data_entry = \
-            get_unique_dates(start, end, first_day, last_day, chunks)
-    else:
-        last_date_data_entry = first_date_data_entry = None
+    # days are in the study's timezone, like the SummaryStatisticDaily byte counts
+    first_date_data_entry, last_date_data_entry = \
+        dashboard_participant_date_query(participant.id, study.timezone)
+    has_bytes_data = first_date_data_entry is not None
     # --------------- dates for  processed data streams -------------------
     # all_data is a list of dicts [{"time_bin": , "stream": , "processed_data": }...]
     processed_first_date_data_entry, processed_last_date_data_entry, all_data = parse_patient_processed_data(study_id, participant)
 
     # ------- decide the first date of data entry from processed AND bytes data as well as put the data together ------
     # but only if there are both processed and bytes data
-    if chunks and all_data:
+    if has_bytes_data and all_data:
         if (processed_first_date_data_entry - first_date_data_entry).days < 0:
             first_date_data_entry = processed_first_date_data_entry
         if (processed_last_date_data_entry - last_date_data_entry).days < 0:
             last_date_data_entry = processed_last_date_data_entry
-    if all_data and not chunks:
+    if all_data and not has_bytes_data:
         first_date_data_entry = processed_first_date_data_entry
         last_date_data_entry = processed_last_date_data_entry
 
     # ---------------------- get next/past urls and unique dates, as long as data has been entered -------------------
-    if chunks or all_data:
+    if has_bytes_data or all_data:
         next_url, past_url = create_next_past_urls(first_date_data_entry, last_date_data_entry, start=start, end=end)
         unique_dates, _, _ = get_unique_dates(start, end, first_date_data_entry, last_date_data_entry)
     else:
@@ -224,34 +217,37 @@ def dashboard_participant_page(request: ResearcherRequest, study_id, patient_id)
     # --------------------- get all the data using the correct unique dates from both data sets ----------------------
         # get the byte data for the dates that have data collected in that week
     if all_data:
+        # (stream, date) -> processed data, the first data point of a stream on a date is displayed.
+        processed_data = {}
+        for data_point in all_data:
+            processed_data.setdefault((data_point["data_stream"], data_point["time_bin"]), data_point["processed_data"])
         processed_byte_streams = OrderedDict(
-            (stream, [
-                get_bytes_patient_processed_match(all_data, date, stream) for date in unique_dates
-            ]) for stream in PROCESSED_DATA_STREAM_DICT
+            (stream, [processed_data.get((stream, date)) for date in unique_dates])
+            for stream in PROCESSED_DATA_STREAM_DICT
         )
     else:
         processed_byte_streams = None
 
 
-    if chunks:
+    if has_bytes_data:
+        daily_bytes = dashboard_participant_daily_bytes(participant.id, unique_dates, study.timezone)
         byte_streams = OrderedDict(
-            (stream, [
-                get_bytes_data_stream_match(chunks, date, stream) for date in unique_dates
-            ]) for stream in ALL_DATA_STREAMS
+            (stream, [daily_bytes.get((stream, date)) for date in unique_dates])
+            for stream in ALL_DATA_STREAMS
         )
     else:
         byte_streams = None
 
-    if chunks and all_data:
+    if has_bytes_data and all_data:
         byte_streams.update(processed_byte_streams)
-    elif all_data and not chunks:
+    elif all_data and not has_bytes_data:
         byte_streams = OrderedDict(
             (stream, [
                 None for date in unique_dates
             ]) for stream in ALL_DATA_STREAMS
         )
         byte_streams.update(processed_byte_streams)
-    elif chunks and not all_data:
+    elif has_bytes_data and not all_data:
         processed_byte_streams = OrderedDict(
             (stream, [None for date in unique_dates]) for stream in PROCESSED_DATA_STREAM_DICT
         )
@@ -508,35 +504,6 @@ def create_next_past_urls(first_day, last_day, start=None, end=None):
     return next_url, past_url
 
 
-def get_bytes_data_stream_match(chunks, date, stream):
-    """ returns byte value for correct chunk based on data stream and type comparisons"""
-    all_bytes = None
-    for chunk in chunks:
-        if (chunk["time_bin"]).date() == date and chunk["data_stream"] == stream:
-            if all_bytes is None:
-                all_bytes = chunk.get("bytes", 0) or 0
-            else:
-                all_bytes += chunk.get("bytes", 0) or 0
-    if all_bytes is not None:
-        return all_bytes
-    else:
-        return None
-
-
-def get_bytes_participant_match(stream_data, date):
-    all_bytes = None
-    for data_point in stream_data:
-        if (data_point["time_bin"]).date() == date:
-            if all_bytes is None:
-                all_bytes = data_point.get("bytes", 0) or 0
-            else:
-                all_bytes += data_point.get("bytes", 0) or 0
-    if all_bytes is not None:
-        return all_bytes
-    else:
-        return None
-
-
 def get_bytes_processed_data_match(participant_data, date):
     # participant_data is a list of dicts which hold {time_bin: , processed_data: }
     # there should only ever be one data_point corresponding to a specific date per patient
@@ -549,64 +516,134 @@ def get_bytes_processed_data_match(participant_data, date):
     return None
 
 
-def get_bytes_patient_processed_match(participant_data, date, stream):
-    # participant_data is a list of dicts which hold {time_bin: , processed_data: , stream:, }
-    # there should only ever be one data_point corresponding to a specific date per patient
-    # if no data exists, return None -- if the participant_data object is none, there is no data for this data
-    # stream for this participant
-    if participant_data is not None:
-        for data_point in participant_data:
-            if (data_point["time_bin"]) == date and data_point["data_stream"] == stream:
-                return data_point["processed_data"]
-    return None
-
-
-def dashboard_chunkregistry_date_query(study_id, data_stream=None):
+def dashboard_chunkregistry_date_query(study_id, data_stream=None, study_timezone=None):
     """ gets the first and last days in the study excluding 1/1/1970 bc that is obviously an error and makes
-    the frontend annoying to use """
-    unix_epoch_start_sorta = make_aware(datetime(1970, 1, 2), pytz.utc)
+    the frontend annoying to use.  Days are in UTC unless a timezone is provided. """
+    # ChunkTimeRange already excludes time bins before EARLIEST_VALID_TIME_BIN (1970-01-02)
     kwargs = {"study_id": study_id}
     if data_stream:
         kwargs["data_type"] = data_stream
     
-    # this as queries with .first() and .last() is slow even as size of all_time_bins grows.
-    all_time_bins: List[datetime] = list(
-        ChunkRegistry.objects.filter(**kwargs).exclude(time_bin__lt=unix_epoch_start_sorta)
-        .order_by("time_bin").values_list("time_bin", flat=True)
+    time_range = ChunkTimeRange.objects.filter(**kwargs).aggregate(
+        first=Min("earliest_time_bin"), last=Max("latest_time_bin")
     )
-    
-    # default behavior for 1 or 0 time_bins
-    if len(all_time_bins) < 2:
+    if time_range["first"] is None:
         return None, None
     
-    return all_time_bins[0].date(), all_time_bins[-1].date()
+    if study_timezone is not None:
+        return time_range["first"].astimezone(study_timezone).date(), \
+            time_range["last"].astimezone(study_timezone).date()
+    return time_range["first"].date(), time_range["last"].date()
 
 
-def dashboard_chunkregistry_query(participant_id, data_stream=None, start=None, end=None):
-    """ Queries ChunkRegistry based on the provided parameters and returns a list of dictionaries
-    with 3 keys: bytes, data_stream, and time_bin. """
-    kwargs = {"participant__id": participant_id}
-    if start:
-        kwargs["time_bin__gte"] = start
-    if end:
-        kwargs["time_bin__lte"] = end
-    if data_stream:
-        kwargs["data_type"] = data_stream
-
-    # on a (good) test device running on sqlite, for 12,200 chunks, this takes ~135ms
-    # sticking the query_set directly into a list is a slight speedup. (We need it all in memory anyway.)
-    chunks = list(
-        ChunkRegistry.objects.filter(**kwargs)
-        .extra(
-            select={
-                # rename the data_type and file_size fields in the db query itself for speed
-                'data_stream': 'data_type',
-                'bytes': 'file_size',
-            }
-        ).values("bytes", "data_stream", "time_bin")
+def dashboard_participant_date_query(participant_id, study_timezone):
+    """ gets the first and last days (in the study's timezone) of a participant's data, excluding
+    1/1/1970. Returns None, None if there is no data. """
+    time_range = ChunkTimeRange.objects.filter(participant_id=participant_id).aggregate(
+        first=Min("earliest_time_bin"), last=Max("latest_time_bin")
     )
-
-    return chunks
+    if time_range["first"] is None:
+        return None, None
+    return time_range["first"].astimezone(study_timezone).date(), \
+        time_range["last"].astimezone(study_timezone).date()
+
+
+def dashboard_participant_daily_bytes(
+    participant_id, dates: List[date], study_timezone: tzinfo
+) -> Dict[Tuple[str, date], int]:
+    """ The bytes of data of each data stream of a participant on each of the dates (in the study's
+    timezone), from the SummaryStatisticDaily byte counts, keyed by (data stream, date).  Days
+    without data for a stream are absent.  Byte counts that are missing or NULL are calculated from
+    ChunkRegistry data, so this is at most two queries, both bounded by the dates. """
+    if not dates:
+        return {}
+    field_names = {f"beiwe_{stream}_bytes": stream for stream in ALL_DATA_STREAMS}
+    query = SummaryStatisticDaily.objects.filter(
+        participant_id=participant_id, date__gte=min(dates), date__lte=max(dates)
+    ).values("date", *field_names)
+    
+    daily_bytes = {}
+    for summary in query:
+        for field_name, stream in field_names.items():
+            if summary[field_name] is not None:
+                daily_bytes[(stream, summary["date"])] = summary[field_name]
+    
+    missing = [
+        (stream, day) for stream in ALL_DATA_STREAMS for day in dates if (stream, day) not in daily_bytes
+    ]
+    if missing:
+        chunks = ChunkRegistry.objects.filter(
+            participant_id=participant_id, data_type__in={stream for stream, _ in missing}
+        )
+        chunk_bytes = chunkregistry_daily_bytes(chunks, [day for _, day in missing], study_timezone)
+        for stream, day in missing:
+            if (participant_id, stream, day) in chunk_bytes:
+                daily_bytes[(stream, day)] = chunk_bytes[(participant_id, stream, day)]
+    return daily_bytes
+
+
+def dashboard_daily_bytes_matrix(
+    study_id: int, participant_ids: List[int], data_stream: str, dates: List[date],
+    study_timezone: tzinfo,
+) -> List[List[Optional[int]]]:
+    """ The bytes of data of a data stream per participant per day (in the study's timezone), from
+    the SummaryStatisticDaily byte counts.  Returns a list of rows, one for each participant id, of
+    the bytes on each of the dates, or None where there was no data.  Byte counts that are missing
+    or NULL are calculated from ChunkRegistry data, so this is at most two queries. """
+    byte_matrix = [[None] * len(dates) for _ in participant_ids]
+    if not participant_ids or not dates:
+        return byte_matrix
+    
+    rows = {participant_id: row for participant_id, row in zip(participant_ids, byte_matrix)}
+    columns = {day: column for column, day in enumerate(dates)}
+    field_name = f"beiwe_{data_stream}_bytes"
+    query = SummaryStatisticDaily.objects.filter(
+        participant__study_id=study_id,
+        date__gte=min(dates),
+        date__lte=max(dates),
+        **{f"{field_name}__isnull": False},
+    ).values_list("participant_id", "date", field_name)
+    
+    for participant_id, day, byte_count in query:
+        if participant_id in rows and day in columns:
+            rows[participant_id][columns[day]] = byte_count
+    
+    missing_participant_ids = [
+        participant_id for participant_id, row in rows.items() if None in row
+    ]
+    if missing_participant_ids:
+        missing_days = [
+            day for day, column in columns.items()
+            if any(rows[participant_id][column] is None for participant_id in missing_participant_ids)
+        ]
+        chunks = ChunkRegistry.objects.filter(
+            study_id=study_id, participant_id__in=missing_participant_ids, data_type=data_stream
+        )
+        chunk_bytes = chunkregistry_daily_bytes(chunks, missing_days, study_timezone)
+        for participant_id in missing_participant_ids:
+            for day, column in columns.items():
+                if rows[participant_id][column] is None:
+                    rows[participant_id][column] = chunk_bytes.get((participant_id, data_stream, day))
+    return byte_matrix
+
+
+def chunkregistry_daily_bytes(
+    chunks: QuerySet, dates: List[date], study_timezone: tzinfo
+) -> DefaultDict[Tuple[int, str, date], int]:
+    """ The bytes of data of the ChunkRegistries per participant, data stream and day (in the
+    study's timezone), keyed by (participant id, data stream, date), over the days from the first
+    to the last of the dates.  This is the fallback for days that have no SummaryStatisticDaily
+    byte counts, e.g. days from before file processing maintained them. """
+    query = chunks.filter(
+        time_bin__gte=utc_datetime_of_local_midnight_date(min(dates), study_timezone),
+        time_bin__lt=utc_datetime_of_local_midnight_date(max(dates) + timedelta(days=1), study_timezone),
+    ).values_list("participant_id", "data_type", "time_bin", "file_size")
+    
+    daily_bytes = defaultdict(int)
+    for participant_id, data_type, time_bin, file_size in query:
+        day = time_bin.astimezone(study_timezone).date()
+        daily_bytes[(participant_id, data_type, day)] += 0 if file_size is None else file_size
+    return daily_bytes
 
 
 def dashboard_pipelineregistry_query(study_id, participant_id):
@@ -3,7 +3,7 @@ from datetime import datetime
 
 from dateutil import tz
 from django.db.models import QuerySet
-from django.http.response import FileResponse
+from django.http.response import FileResponse, HttpResponse
 from django.utils.timezone import make_aware
 from django.views.decorators.http import require_http_methods
 
@@ -11,10 +11,12 @@ from authentication.data_access_authentication import api_study_credential_check
 from constants.data_access_api_constants import CHUNK_FIELDS
 from constants.data_stream_constants import ALL_DATA_STREAMS
 from constants.datetime_constants import API_TIME_FORMAT
-from database.data_access_models import ChunkRegistry
+from database.data_access_models import ChunkRegistry, DataManifest
 from database.user_models import Participant
 from libs.internal_types import ApiStudyResearcherRequest
-from libs.streaming_zip import zip_generator
+from libs.key_caches import get_key_cache_stats
+from libs.s3 import get_s3_metrics
+from libs.streaming_zip import determine_file_name, prefetching_zip_generator
 from middleware.abort_middleware import abort
 
 
@@ -47,7 +49,7 @@ def get_data(request: ApiStudyResearcherRequest):
         request.api_study.pk, query_args, registry_dict=parse_registry(request)
     )
     streaming_response = FileResponse(
-        zip_generator(get_these_files, construct_registry='web_form' not in request.POST),
+        prefetching_zip_generator(get_these_files, construct_registry='web_form' not in request.POST),
         content_type="application/zip",
         as_attachment='web_form' in request.POST,
         filename="data.zip",
@@ -55,8 +57,92 @@ def get_data(request: ApiStudyResearcherRequest):
     # for unknown reasons this call never happens in django's responding process, and so the
     # headers, which includes the file name, are never set.
     streaming_response.set_headers(None)
+    # debugging only, this endpoint is hot.  (Cumulative for this process, the files of this
+    # request have not been retrieved yet.)
+    if ENABLE_DATA_API_DEBUG:
+        log("key cache stats:", get_key_cache_stats())
+        log("s3 metrics:", get_s3_metrics())
     return streaming_response
 
+
+@require_http_methods(['POST', "GET"])
+@api_study_credential_check(block_test_studies=True)
+def get_data_manifest(request: ApiStudyResearcherRequest):
+    """ Takes the same query parameters as get_data (including the registry).
+    Returns json of a manifest token, its expiration time, and the ordered list of files the query
+    matched: their index in the manifest, name in the zip file, chunk_path, chunk_hash and file_size.
+    Any range of the manifest can then be downloaded as its own zip file with get_data_range, so a
+    large download can be split up, run in parallel, and resumed. """
+    query_args = {}
+    determine_data_streams_for_db_query(request, query_args)
+    determine_users_for_db_query(request, query_args)
+    determine_time_range_for_db_query(request, query_args)
+    
+    chunks = list(handle_database_query(
+        request.api_study.pk, query_args, registry_dict=parse_registry(request), order_by_pk=True
+    ))
+    manifest = DataManifest.create_for_chunks(
+        request.api_study, request.api_researcher, [chunk["pk"] for chunk in chunks]
+    )
+    return HttpResponse(
+        json.dumps({
+            "token": manifest.token,
+            "expires": manifest.expires.strftime(API_TIME_FORMAT),
+            "files": [
+                {
+                    "index": i,
+                    "file_name": determine_file_name(chunk),
+                    "chunk_path": chunk["chunk_path"],
+                    "chunk_hash": chunk["chunk_hash"],
+                    "file_size": chunk["file_size"],
+                }
+                for i, chunk in enumerate(chunks)
+            ],
+        }),
+        content_type="application/json",
+    )
+
+
+@require_http_methods(['POST', "GET"])
+@api_study_credential_check(block_test_studies=True)
+def get_data_range(request: ApiStudyResearcherRequest):
+    """ Required: access key, access secret, study_id, manifest_token (from get_data_manifest)
+    optional: start, end - integer indexes into the manifest's files, start is inclusive, end is
+        exclusive, default to the whole manifest.
+    Returns a zip file of the files in that range of the manifest, as get_data does.  Files deleted
+    since the manifest was created are skipped.
+    cases handled:
+        no such manifest for this researcher and study, or it has expired: 404
+        invalid range: 400 """
+    manifest = DataManifest.get_or_404(
+        token=request.POST.get("manifest_token", ""),
+        study=request.api_study,
+        researcher=request.api_researcher,
+    )
+    if manifest.is_expired:
+        log("manifest expired")
+        return abort(404)
+    
+    chunk_ids = manifest.get_chunk_ids()
+    start = parse_manifest_index(request, "start", 0)
+    end = parse_manifest_index(request, "end", len(chunk_ids))
+    if start > end:
+        log("invalid manifest range")
+        return abort(400)
+    
+    streaming_response = FileResponse(
+        prefetching_zip_generator(
+            manifest.chunks_in_range(start, end, chunk_ids),
+            construct_registry='web_form' not in request.POST,
+        ),
+        content_type="application/zip",
+        as_attachment='web_form' in request.POST,
+        filename=f"data_{start}-{end}.zip",
+    )
+    streaming_response.set_headers(None)  # see get_data
+    return streaming_response
+
+
 # @require_http_methods(["GET", "POST"])
 # @api_study_credential_check()
 # def pipeline_data_download(request: ApiStudyResearcherRequest):
@@ -101,6 +187,22 @@ def parse_registry(request: ApiStudyResearcherRequest):
     return ret
 
 
+def parse_manifest_index(request: ApiStudyResearcherRequest, key: str, default: int) -> int:
+    """ Returns an index into a manifest from the request, raises a 400 if it is not a non-negative
+    integer. """
+    if key not in request.POST:
+        return default
+    try:
+        index = int(request.POST[key])
+    except ValueError:
+        log("bad manifest index")
+        return abort(400)
+    if index < 0:
+        log("negative manifest index")
+        return abort(400)
+    return index
+
+
 def str_to_datetime(time_string):
     """ Translates a time string to a datetime object, raises a 400 if the format is wrong."""
     try:
@@ -162,9 +264,13 @@ def determine_time_range_for_db_query(request: ApiStudyResearcherRequest, query:
         query['end'] = str_to_datetime(request.POST['time_end'])
 
 
-def handle_database_query(study_id: int, query_dict: dict, registry_dict: dict = None) -> QuerySet:
+def handle_database_query(
+        study_id: int, query_dict: dict, registry_dict: dict = None, order_by_pk: bool = False
+) -> QuerySet:
     """ Runs the database query and returns a QuerySet. """
     chunks = ChunkRegistry.get_chunks_time_range(study_id, **query_dict)
+    if order_by_pk:
+        chunks = chunks.order_by("pk")
     
     if not registry_dict:
         return chunks.values(*CHUNK_FIELDS).iterator()
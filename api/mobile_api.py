@@ -26,6 +26,7 @@ from libs.internal_types import ParticipantRequest
 from libs.push_notification_helpers import repopulate_all_survey_scheduled_events
 from libs.s3 import get_client_public_key_string, s3_upload
 from libs.sentry import make_sentry_client, SentryTypes
+from libs.upload_spool import is_spooled, spool_upload, SpooledFileExists, upload_spool_enabled
 from middleware.abort_middleware import abort
 
 
@@ -93,6 +94,8 @@ def upload(request: ParticipantRequest, OS_API=""):
     # block duplicate FTPs.  Testing the upload history is too complex
     if FileToProcess.test_file_path_exists(s3_file_location, participant.study.object_id):
         return HttpResponse(status=200)
+    if upload_spool_enabled() and is_spooled(s3_file_location, participant.study.object_id):
+        return HttpResponse(status=200)
     
     uploaded_file = get_uploaded_file(request)
     try:
@@ -123,6 +126,16 @@ def upload(request: ParticipantRequest, OS_API=""):
     
     # if uploaded data actually exists, and has a valid extension
     if uploaded_file and file_name and contains_valid_extension(file_name):
+        if upload_spool_enabled():
+            # The file is uploaded to S3 and added to FileToProcess and UploadTracking later, the
+            # device may delete it once it is safely in the spool.
+            try:
+                spool_upload(s3_file_location, uploaded_file, participant)
+            except SpooledFileExists:
+                # the same race condition as below, a concurrent upload of the same file.
+                return abort(400)
+            return HttpResponse(status=200)
+        
         s3_upload(s3_file_location, uploaded_file, participant.study.object_id)
         
         # race condition: multiple _concurrent_ uploads with same file path. Behavior without
@@ -278,6 +291,7 @@ def register_user(request: ParticipantRequest, OS_API=""):
     participant.device_id = device_id
     participant.os_type = OS_API
     participant.set_password(request.POST['new_password'])  # set password saves the model
+    participant.clear_key_caches()
     device_settings = participant.study.device_settings.as_unpacked_native_python()
     device_settings.pop('_id', None)
     
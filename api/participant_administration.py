@@ -70,6 +70,7 @@ def reset_device(request: ResearcherRequest):
     
     participant.device_id = ""
     participant.save()
+    participant.clear_key_caches()
     messages.success(request, f'For patient {patient_id}, device was reset; password is untouched.')
     # FIXME: this was originally request.referrer
     return redirect(f'/view_study/{study_id}/')
@@ -1,4 +1,7 @@
 import json
+from collections import defaultdict
+from datetime import datetime
+from typing import List, Optional, Tuple
 
 from django.contrib import messages
 from django.db.models import ProtectedError
@@ -9,6 +12,7 @@ from django.db.models.query import Prefetch
 from django.db.models.query_utils import Q
 from django.http import FileResponse, HttpResponse
 from django.shortcuts import get_object_or_404, redirect, render
+from django.utils.dateparse import parse_datetime
 from django.views.decorators.http import require_GET, require_http_methods, require_POST
 
 from authentication.admin_authentication import authenticate_researcher_study_access
@@ -20,6 +24,10 @@ from libs.internal_types import ResearcherRequest
 from libs.intervention_export import intervention_survey_data
 
 
+# the columns of the participants table that are the same in every study, and that it can be sorted by
+PARTICIPANTS_TABLE_BASIC_COLUMNS = ['created_on', 'patient_id', 'registered', 'os_type']
+
+
 @require_GET
 @authenticate_researcher_study_access
 def study_participants_api(request: ResearcherRequest, study_id: int):
@@ -32,16 +40,22 @@ def study_participants_api(request: ResearcherRequest, study_id: int):
     sort_by_column_index = int(request.GET.get('order[0][column]'))
     sort_in_descending_order = request.GET.get('order[0][dir]') == 'desc'
     contains_string = request.GET.get('search[value]')
+    # `cursor` is optional, it is the next_cursor of the response for the previous page.
+    cursor = request.GET.get('cursor', None)
     total_participants_count = Participant.objects.filter(study_id=study_id).count()
-    filtered_participants_count = study.filtered_participants(contains_string).count()
-    data = get_values_for_participants_table(
-        study, start, length, sort_by_column_index, sort_in_descending_order, contains_string
+    if contains_string:
+        filtered_participants_count = study.filtered_participants(contains_string).count()
+    else:
+        filtered_participants_count = total_participants_count
+    data, next_cursor = get_values_for_participants_table(
+        study, start, length, sort_by_column_index, sort_in_descending_order, contains_string, cursor
     )
     table_data = {
         "draw": draw,
         "recordsTotal": total_participants_count,
         "recordsFiltered": filtered_participants_count,
-        "data": data
+        "data": data,
+        "next_cursor": next_cursor,
     }
     return HttpResponse(json.dumps(table_data), status=200)
 
@@ -196,22 +210,21 @@ def get_values_for_participants_table(
             length: int,
             sort_by_column_index: int,
             sort_in_descending_order: bool,
-            contains_string: str
-    ):
-    """ Logic to get paginated information of the participant list on a study. """
-    # If we need to optimize this function that probably requires the set up of a lookup
-    # dictionary instead of querying the database for every participant's field values.
-    # This isn't currently implemented because there are only ~15 participants per page rendered
-    # x = ParticipantFieldValue.objects.filter(participant__study=self).values_list(
-    #     "participant_id", "field__field_name", "value"
-    # )
-    # participant_field_values = defaultdict(dict)
-    # for participant_id, field_name, value in x:
-    #     participant_field_values[participant_id][field_name] = value
-    
-    basic_columns = ['created_on', 'patient_id', 'registered', 'os_type']
-    sort_by_column = basic_columns[sort_by_column_index]
-    sort_by_column = f"-{sort_by_column}" if sort_in_descending_order else sort_by_column
+            contains_string: str,
+            cursor: Optional[str] = None,
+    ) -> Tuple[List[list], Optional[str]]:
+    """ Logic to get paginated information of the participant list on a study.  Returns the rows
+    and a cursor for the page after them (None on the last page).
+    
+    Pages are read with a keyset: given the cursor of the previous page the query starts after its
+    last row, so later pages are as fast as the first one.  Without a (valid) cursor, e.g. when
+    jumping to a page, the page is found by offset.  Rows are ordered by the sort column and then
+    by primary key, so that the keyset is unique. """
+    sort_by_column = PARTICIPANTS_TABLE_BASIC_COLUMNS[sort_by_column_index]
+    if sort_in_descending_order:
+        ordering = (f"-{sort_by_column}", "-pk")
+    else:
+        ordering = (sort_by_column, "pk")
     
     # ~ is the not operator
     participant_unregistered_expression = \
@@ -224,17 +237,32 @@ def get_values_for_participants_table(
     )
     
     # Prefetch intervention dates, sorted case-insensitively by name
-    query = study.filtered_participants(contains_string).order_by(sort_by_column) \
+    query = study.filtered_participants(contains_string) \
             .annotate(registered=participant_unregistered_expression) \
+            .order_by(*ordering) \
             .prefetch_related(
                Prefetch('intervention_dates',
                         queryset=InterventionDate.objects.order_by(Lower('intervention__name'))))
     
+    keyset = participants_table_keyset(cursor, sort_by_column_index, sort_in_descending_order)
+    if keyset is None:
+        participants = list(query[start:start + length])
+    else:
+        participants = list(query.filter(keyset)[:length])
+    
+    # the custom field values of the whole page in one query
+    participant_field_values = defaultdict(dict)
+    field_values_query = ParticipantFieldValue.objects.filter(
+        participant_id__in=[participant.id for participant in participants]
+    ).values_list("participant_id", "field__field_name", "value")
+    for participant_id, field_name, value in field_values_query:
+        participant_field_values[participant_id][field_name] = value
+    
     # Get the list of the basic columns that are present in every study, convert the created_on
     # into a string in YYYY-MM-DD format, then add intervention dates (sorted in prefetch).
     participants_data = []
-    for participant in query[start:start + length]:
-        participant_values = [getattr(participant, field) for field in basic_columns]
+    for participant in participants:
+        participant_values = [getattr(participant, field) for field in PARTICIPANTS_TABLE_BASIC_COLUMNS]
         participant_values[0] = participant_values[0].strftime(API_DATE_FORMAT)
         
         # a participant has all intervention dates, even if they are not populated yet.
@@ -245,11 +273,67 @@ def get_values_for_participants_table(
         
         # a participant may not have all custom field values populated, so we need a reference
         # in order to fill None values where they [don't] exist.
-        field_values = dict(participant.field_values.values_list("field__field_name", "value"))
+        field_values = participant_field_values[participant.id]
         for field_name in field_names_ordered:
-            participant_values.append(
-                field_values[field_name] if field_name in field_values else None
-            )
+            participant_values.append(field_values.get(field_name, None))
         
         participants_data.append(participant_values)
-    return participants_data
+    
+    if participants and len(participants) == length:
+        next_cursor = participants_table_cursor(
+            participants[-1], sort_by_column_index, sort_in_descending_order
+        )
+    else:
+        next_cursor = None
+    return participants_data, next_cursor
+
+
+def participants_table_cursor(
+        participant: Participant, sort_by_column_index: int, sort_in_descending_order: bool
+) -> str:
+    """ The keyset of a row of the participants table, as an opaque string for the frontend. """
+    value = getattr(participant, PARTICIPANTS_TABLE_BASIC_COLUMNS[sort_by_column_index])
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    return json.dumps([sort_by_column_index, sort_in_descending_order, value, participant.pk])
+
+
+def participants_table_keyset(
+        cursor: Optional[str], sort_by_column_index: int, sort_in_descending_order: bool
+) -> Optional[Q]:
+    """ The filter for the rows after the cursor's row, None if there is no cursor or the cursor
+    is malformed or was made for a different sort order. """
+    if not cursor:
+        return None
+    try:
+        column_index, descending, value, pk = json.loads(cursor)
+    except (ValueError, TypeError):
+        return None
+    
+    if column_index != sort_by_column_index or descending != sort_in_descending_order:
+        return None
+    if not isinstance(pk, int):
+        return None
+    
+    column = PARTICIPANTS_TABLE_BASIC_COLUMNS[column_index]
+    if column == "created_on":
+        value = parse_datetime(value) if isinstance(value, str) else None
+        if value is None:
+            return None
+    elif column == "registered":
+        if not isinstance(value, bool):
+            return None
+    elif not isinstance(value, str):
+        return None
+    
+    lookup = "lt" if sort_in_descending_order else "gt"
+    if column == "registered":
+        # registered is a NOT expression, which binds looser than a comparison in SQL, so filtering
+        # on the annotation gives the wrong rows.  Compare device_id like the annotation does.
+        same_group = ~Q(device_id='') if value else Q(device_id='')
+        keyset = same_group & Q(**{f"pk__{lookup}": pk})
+        # False sorts before True, so only one of the two groups comes after the cursor's group
+        if value == sort_in_descending_order:
+            keyset |= Q(device_id='') if value else ~Q(device_id='')
+        return keyset
+    return Q(**{f"{column}__{lookup}": value}) | Q(**{column: value, f"pk__{lookup}": pk})
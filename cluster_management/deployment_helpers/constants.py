@@ -62,7 +62,6 @@ BASE_INSTALLS = [
     'silversearcher-ag',
     # libraries
     'libpq-dev',
-    "zstd",
 ]
 
 APT_WORKER_INSTALLS = copy(BASE_INSTALLS) + copy(PYTHON_COMPILE_REQUIREMENTS)
@@ -66,6 +66,23 @@ for mandatory_var in MANDATORY_VARS:
 # Environment variable type can be unpredictable, sanitize the numerical ones.
 settings.CONCURRENT_NETWORK_OPS = int(settings.CONCURRENT_NETWORK_OPS)
 settings.FILE_PROCESS_PAGE_SIZE = int(settings.FILE_PROCESS_PAGE_SIZE)
+settings.FILE_PROCESS_MEMORY_BUDGET = int(settings.FILE_PROCESS_MEMORY_BUDGET)
+settings.FILE_PROCESS_QUEUE_DEPTH = int(settings.FILE_PROCESS_QUEUE_DEPTH)
+settings.FILE_PROCESS_MERGE_QUEUE_DEPTH = int(settings.FILE_PROCESS_MERGE_QUEUE_DEPTH)
+settings.FILE_PROCESS_UPLOAD_QUEUE_DEPTH = int(settings.FILE_PROCESS_UPLOAD_QUEUE_DEPTH)
+settings.DATA_ACCESS_API_PREFETCH_WORKERS = int(settings.DATA_ACCESS_API_PREFETCH_WORKERS)
+settings.DATA_ACCESS_API_PREFETCH_BYTES = int(settings.DATA_ACCESS_API_PREFETCH_BYTES)
+settings.S3_MAX_ATTEMPTS = int(settings.S3_MAX_ATTEMPTS)
+settings.S3_CONNECT_TIMEOUT = int(settings.S3_CONNECT_TIMEOUT)
+settings.S3_READ_TIMEOUT = int(settings.S3_READ_TIMEOUT)
+if settings.S3_MAX_POOL_CONNECTIONS:
+    settings.S3_MAX_POOL_CONNECTIONS = int(settings.S3_MAX_POOL_CONNECTIONS)
+
+if settings.S3_RETRY_MODE not in ("legacy", "standard", "adaptive"):
+    ERRORS.append(f"S3_RETRY_MODE '{settings.S3_RETRY_MODE}' is not one of legacy, standard, or adaptive.")
+
+if settings.UPLOAD_SPOOL_DIRECTORY and not os.path.isdir(settings.UPLOAD_SPOOL_DIRECTORY):
+    ERRORS.append(f"UPLOAD_SPOOL_DIRECTORY '{settings.UPLOAD_SPOOL_DIRECTORY}' is not a directory.")
 
 # email addresses are parsed from a comma separated list, strip whitespace.
 if settings.SYSADMIN_EMAILS:
@@ -58,14 +58,88 @@ DOWNLOADABLE_APK_URL = getenv("DOWNLOADABLE_APK_URL", "https://beiwe-app-backups
 #   Expects an integer number.
 CONCURRENT_NETWORK_OPS = getenv("CONCURRENT_NETWORK_OPS") or cpu_count() * 2
 
-# This is number of files to be pulled in and processed simultaneously on data processing servers,
-# it has no effect on frontend servers. Mostly this affects the ram utilization of file processing.
-# A larger "page" of files to process is more efficient with respect to network bandwidth (and
-# therefore S3 costs), but will use more memory. Individual file size ranges from bytes to tens of
-# megabytes, so memory usage can be spikey and difficult to predict.
+# This is the maximum number of files in a "page" of files processed together on data processing
+# servers, it has no effect on frontend servers.  Pages are normally limited by
+# FILE_PROCESS_MEMORY_BUDGET (below), this limit applies when there are many small files.
 #   Expects an integer number.
 FILE_PROCESS_PAGE_SIZE = getenv("FILE_PROCESS_PAGE_SIZE", 100)
 
+# The approximate amount of memory, in bytes, that file data may use on data processing servers.
+# Files are downloaded, processed, and uploaded at the same time, each of the two "pages" of files
+# in progress (one being processed, one being uploaded) is limited to half this number.  A larger
+# budget is more efficient with respect to network bandwidth (and therefore S3 costs), but will
+# use more memory.  Processing uses more memory than the size of the files themselves, so leave
+# plenty of headroom.  Files larger than half of this value are processed one at a time.
+# Defaults to 500 megabytes.
+#   Expects an integer number.
+FILE_PROCESS_MEMORY_BUDGET = getenv("FILE_PROCESS_MEMORY_BUDGET", 500 * 1024 * 1024)
+
+# The number of files that data processing servers download ahead of the file currently being
+# processed.  Defaults to double the CONCURRENT_NETWORK_OPS setting.
+#   Expects an integer number.
+FILE_PROCESS_QUEUE_DEPTH = getenv("FILE_PROCESS_QUEUE_DEPTH") or int(CONCURRENT_NETWORK_OPS) * 2
+
+# The number of complete pages of files that data processing servers queue for the merge and upload
+# stage, including the page being merged and uploaded.  Pages are always merged one at a time, in
+# order, a deeper queue lets processing run further ahead of slow uploads.  Defaults to 1.
+#   Expects an integer number.
+FILE_PROCESS_MERGE_QUEUE_DEPTH = getenv("FILE_PROCESS_MERGE_QUEUE_DEPTH", 1)
+
+# The number of merged chunks that data processing servers hold waiting for or undergoing upload.
+# Defaults to double the CONCURRENT_NETWORK_OPS setting.
+#   Expects an integer number.
+FILE_PROCESS_UPLOAD_QUEUE_DEPTH = getenv("FILE_PROCESS_UPLOAD_QUEUE_DEPTH") or int(CONCURRENT_NETWORK_OPS) * 2
+
+# Enables the columnar file parsing engine on data processing servers.  This engine parses csv
+# files (accelerometer, gyro, etc.) into arrays instead of lists of rows, which uses substantially
+# less cpu time and memory.  It requires the numpy library (which is installed alongside forest on
+# data processing servers), files that it cannot handle are processed normally.
+#   Expects (case-insensitive) "true" to enable, otherwise it is disabled.
+COLUMNAR_FILE_PROCESSING = getenv('COLUMNAR_FILE_PROCESSING', 'false').lower() == 'true'
+
+#
+# S3 connection options
+
+# The maximum number of connections to S3 that each server process keeps open.  Threads that access
+# S3 wait for a free connection, so by default this scales with CONCURRENT_NETWORK_OPS.
+#   Expects an integer number.
+S3_MAX_POOL_CONNECTIONS = getenv("S3_MAX_POOL_CONNECTIONS")
+
+# How failed S3 requests are retried.  The retry mode is one of "legacy", "standard" or "adaptive"
+# (see the boto3 documentation on retries), adaptive additionally slows down requests when S3
+# throttles them.  The maximum number of attempts includes the first attempt.
+#   Expects one of the three retry modes, and an integer number.
+S3_RETRY_MODE = getenv("S3_RETRY_MODE", "adaptive")
+S3_MAX_ATTEMPTS = getenv("S3_MAX_ATTEMPTS", 5)
+
+# Timeouts, in seconds, for establishing a connection to S3 and for reading from a connection.
+#   Expects an integer number.
+S3_CONNECT_TIMEOUT = getenv("S3_CONNECT_TIMEOUT", 10)
+S3_READ_TIMEOUT = getenv("S3_READ_TIMEOUT", 60)
+
+#
+# Data access API options
+
+# Data downloads from the data access API are zip files that are streamed to the client while
+# files are added to them.  Files are downloaded from S3 (and decrypted) ahead of being added to
+# the zip file by this many threads, and up to approximately this many bytes of file data are held
+# in memory.  Defaults to 3 threads and 100 megabytes.
+#   Expects integer numbers.
+DATA_ACCESS_API_PREFETCH_WORKERS = getenv("DATA_ACCESS_API_PREFETCH_WORKERS", 3)
+DATA_ACCESS_API_PREFETCH_BYTES = getenv("DATA_ACCESS_API_PREFETCH_BYTES", 100 * 1024 * 1024)
+
+#
+# Upload options
+
+# Enables the upload spool on frontend servers.  When set to the path of a directory, uploaded
+# files are written to that directory and the upload is confirmed to the device as soon as the file
+# is safely on disk, the files are then uploaded to S3 and queued for data processing in batches by
+# services/upload_spool_flusher.py, which must be kept running on every frontend server.  This keeps
+# web server processes available when many devices upload at once.  The directory must exist, and
+# must be on persistent storage.
+#   Expects a directory path, disabled by default.
+UPLOAD_SPOOL_DIRECTORY = getenv("UPLOAD_SPOOL_DIRECTORY")
+
 #
 # Push Notification directives
 
@@ -1,4 +1,12 @@
+from datetime import timedelta
+
+
 CHUNK_FIELDS = (
     "pk", "participant_id", "data_type", "chunk_path", "time_bin", "chunk_hash",
-    "participant__patient_id", "study_id", "survey_id", "survey__object_id"
+    "participant__patient_id", "study_id", "survey_id", "survey__object_id", "file_size"
 )
+
+# data manifests (the get-data-manifest and get-data-range endpoints) can be used for this long
+DATA_MANIFEST_LIFETIME = timedelta(days=7)
+# the number of ChunkRegistries queried at a time when streaming a range of a manifest
+DATA_MANIFEST_QUERY_BATCH_SIZE = 500
@@ -1,5 +1,11 @@
+from datetime import datetime, timezone
+
+
 ## Chunks
 # This value is in seconds, it sets the time period that chunked files will be sliced into.
 CHUNK_TIMESLICE_QUANTUM = 3600
 # the name of the s3 folder that contains chunked data
 CHUNKS_FOLDER = "CHUNKED_DATA"
+# Time bins before this are from devices whose clocks were unset or from corrupted data, they are
+# ignored when determining the time range of a study's (or participant's) data.
+EARLIEST_VALID_TIME_BIN = datetime(1970, 1, 2, tzinfo=timezone.utc)
@@ -1,16 +1,23 @@
+import json
 from collections import Counter
 from datetime import datetime, timedelta
-from typing import Dict
+from typing import Dict, List, Tuple
 
-from django.db import models
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, models, transaction
+from django.db.models import Max, Min, Value
+from django.db.models.functions import Greatest, Least
 from django.utils import timezone
 from django_extensions.db.fields.json import JSONField
 
-from constants.data_processing_constants import CHUNK_TIMESLICE_QUANTUM, CHUNKS_FOLDER
+from constants.data_access_api_constants import (CHUNK_FIELDS, DATA_MANIFEST_LIFETIME,
+    DATA_MANIFEST_QUERY_BATCH_SIZE)
+from constants.data_processing_constants import (CHUNK_TIMESLICE_QUANTUM, CHUNKS_FOLDER,
+    EARLIEST_VALID_TIME_BIN)
 from constants.data_stream_constants import (CHUNKABLE_FILES, IDENTIFIERS,
     REVERSE_UPLOAD_FILE_TYPE_MAPPING)
 from constants.datetime_constants import API_TIME_FORMAT
-from database.models import TimestampedModel
+from database.models import JSONTextField, TimestampedModel
 from database.study_models import Study
 from database.user_models import Participant
 from database.validators import LengthValidator
@@ -44,6 +51,10 @@ class PipelineRegistry(TimestampedModel):
         )
 
 
+# the ChunkRegistry fields populated by ChunkRegistry.set_chunk_contents
+CHUNK_CONTENTS_FIELDS = ("chunk_hash", "file_size")
+
+
 class ChunkRegistry(TimestampedModel):
     # this is declared in the abstract model but needs to be indexed for pipeline queries.
     last_updated = models.DateTimeField(auto_now=True, db_index=True)
@@ -67,6 +78,29 @@ class ChunkRegistry(TimestampedModel):
         db_index=True
     )
     
+    class Meta:
+        # Composite indexes for the hot query paths, trailing columns make some of them covering
+        # (the query is answered from the index without reading the table).  These are checked by
+        # tests.test_models.ChunkRegistryQueryPlanTests, which runs EXPLAIN on each query.  They are
+        # built concurrently, see database.migration_operations.AddIndexConcurrently.
+        indexes = [
+            # get_chunks_time_range (data download)
+            models.Index(fields=["study", "data_type", "time_bin"], name="chunk_study_type_time"),
+            # get_chunks_time_range with user_ids, per-participant byte counts by data stream
+            models.Index(
+                fields=["participant", "data_type", "time_bin", "file_size"],
+                name="chunk_participant_type_time",
+            ),
+            # forest's participant and time window query, data quantity stats
+            models.Index(
+                fields=["participant", "time_bin", "file_size"], name="chunk_participant_time"
+            ),
+            # get_updated_users_for_study
+            models.Index(
+                fields=["study", "last_updated", "participant"], name="chunk_study_updated"
+            ),
+        ]
+    
     def s3_retrieve(self):
         return s3_retrieve(self.chunk_path, self.study.object_id, raw_path=True)
     
@@ -74,24 +108,77 @@ class ChunkRegistry(TimestampedModel):
     def register_chunked_data(
             cls, data_type, time_bin, chunk_path, file_contents, study_id, participant_id, survey_id=None
     ):
+        chunk = cls.build_chunked_data(
+            data_type, time_bin, chunk_path, file_contents, study_id, participant_id, survey_id
+        )
+        chunk.save()
+        ChunkTimeRange.add_chunks([chunk])
+    
+    @classmethod
+    def build_chunked_data(
+            cls, data_type, time_bin, chunk_path, file_contents, study_id, participant_id, survey_id=None
+    ) -> "ChunkRegistry":
+        """ As register_chunked_data, but the ChunkRegistry is not saved. """
         if data_type not in CHUNKABLE_FILES:
             raise UnchunkableDataTypeError
         
-        chunk_hash_str = chunk_hash(file_contents).decode()
         time_bin = int(time_bin) * CHUNK_TIMESLICE_QUANTUM
         time_bin = timezone.make_aware(datetime.utcfromtimestamp(time_bin), timezone.utc)
         
-        cls.objects.create(
+        chunk = cls(
             is_chunkable=True,
             chunk_path=chunk_path,
-            chunk_hash=chunk_hash_str,
             data_type=data_type,
             time_bin=time_bin,
             study_id=study_id,
             participant_id=participant_id,
             survey_id=survey_id,
-            file_size=len(file_contents),
         )
+        chunk.set_chunk_contents(file_contents)
+        return chunk
+    
+    @classmethod
+    def bulk_register_chunked_data(
+            cls, new_chunks: List["ChunkRegistry"], updated_chunks: List["ChunkRegistry"]
+    ) -> List[Tuple["ChunkRegistry", Exception]]:
+        """ Saves new ChunkRegistries (from build_chunked_data) and updated ChunkRegistries (from
+        set_chunk_contents) in a single transaction.  If this fails on a database constraint, e.g.
+        a new chunk_path already exists, every chunk is saved individually instead, each in its own
+        savepoint, so that every chunk that can be registered is.
+        Returns the chunks that could not be saved with their errors, for duplicates this is the
+        same ValidationError that register_chunked_data raises. """
+        # bulk_update does not apply auto_now, last_updated is set and saved explicitly
+        now = timezone.now()
+        for chunk in updated_chunks:
+            chunk.last_updated = now
+        
+        try:
+            # bulk_create skips save(), validate new chunks the way TimestampedModel.save does
+            for chunk in new_chunks:
+                chunk.full_clean()
+            with transaction.atomic():
+                cls.objects.bulk_create(new_chunks)
+                cls.objects.bulk_update(updated_chunks, CHUNK_CONTENTS_FIELDS + ("last_updated",))
+        except (IntegrityError, ValidationError):
+            return cls._register_individually(new_chunks, updated_chunks)
+        ChunkTimeRange.add_chunks(new_chunks)
+        return []
+    
+    @classmethod
+    def _register_individually(
+            cls, new_chunks: List["ChunkRegistry"], updated_chunks: List["ChunkRegistry"]
+    ) -> List[Tuple["ChunkRegistry", Exception]]:
+        for chunk in new_chunks:
+            chunk.pk = None  # may have been populated by the rolled back bulk_create
+        failures = []
+        for chunk in new_chunks + updated_chunks:
+            try:
+                with transaction.atomic():
+                    chunk.save()
+            except (IntegrityError, ValidationError) as e:
+                failures.append((chunk, e))
+        ChunkTimeRange.add_chunks([chunk for chunk in new_chunks if chunk.pk is not None])
+        return failures
     
     @classmethod
     def register_unchunked_data(cls, data_type, unix_timestamp, chunk_path, study_id, participant_id,
@@ -101,7 +188,7 @@ class ChunkRegistry(TimestampedModel):
         if data_type in CHUNKABLE_FILES:
             raise ChunkableDataTypeError
         
-        cls.objects.create(
+        chunk = cls.objects.create(
             is_chunkable=False,
             chunk_path=chunk_path,
             chunk_hash='',
@@ -112,16 +199,19 @@ class ChunkRegistry(TimestampedModel):
             survey_id=survey_id,
             file_size=len(file_contents),
         )
+        ChunkTimeRange.add_chunks([chunk])
     
     @classmethod
-    def update_registered_unchunked_data(cls, data_type, chunk_path, file_contents):
+    def update_registered_unchunked_data(cls, data_type, chunk_path, file_contents) -> int:
         """ Updates the data in case a user uploads an unchunkable file more than once,
-        and updates the file size just in case it changed. """
+        and updates the file size just in case it changed.  Returns the change in file size. """
         if data_type in CHUNKABLE_FILES:
             raise ChunkableDataTypeError
         chunk = cls.objects.get(chunk_path=chunk_path)
+        previous_file_size = chunk.file_size or 0
         chunk.file_size = len(file_contents)
         chunk.save()
+        return chunk.file_size - previous_file_size
     
     @classmethod
     def get_chunks_time_range(cls, study_id, user_ids=None, data_types=None, start=None, end=None):
@@ -140,9 +230,14 @@ class ChunkRegistry(TimestampedModel):
         return cls.objects.filter(**query)
     
     def update_chunk(self, data_to_hash: bytes):
-        self.chunk_hash = chunk_hash(data_to_hash).decode()
+        self.set_chunk_contents(data_to_hash)
         self.save()
     
+    def set_chunk_contents(self, file_contents: bytes):
+        """ Populates the fields derived from the contents of a chunked file, does not save. """
+        self.chunk_hash = chunk_hash(file_contents).decode()
+        self.file_size = len(file_contents)
+    
     @classmethod
     def get_updated_users_for_study(cls, study, date_of_last_activity):
         """ Returns a list of patient ids that have had new or updated ChunkRegistry data
@@ -154,6 +249,84 @@ class ChunkRegistry(TimestampedModel):
         ).values_list("participant__patient_id", flat=True).distinct()
 
 
+class ChunkTimeRange(TimestampedModel):
+    """ The earliest and latest valid time bin (see EARLIEST_VALID_TIME_BIN) of each participant's
+    ChunkRegistries of each data stream.  This is maintained when chunks are registered, so that
+    the time range of a study's data is a query of a few rows instead of every ChunkRegistry. """
+    # this is derived data, it does not protect anything from deletion.
+    study = models.ForeignKey('Study', on_delete=models.CASCADE, related_name='chunk_time_ranges')
+    participant = models.ForeignKey(
+        'Participant', on_delete=models.CASCADE, related_name='chunk_time_ranges'
+    )
+    data_type = models.CharField(max_length=32)
+    earliest_time_bin = models.DateTimeField()
+    latest_time_bin = models.DateTimeField()
+    
+    class Meta:
+        unique_together = (("participant", "data_type"),)
+    
+    @classmethod
+    def add_chunks(cls, chunks: List[ChunkRegistry]):
+        """ Expands the time ranges to include the time bins of newly registered chunks. """
+        time_ranges = {}
+        for chunk in chunks:
+            if chunk.time_bin < EARLIEST_VALID_TIME_BIN:
+                continue
+            key = (chunk.study_id, chunk.participant_id, chunk.data_type)
+            earliest, latest = time_ranges.get(key, (chunk.time_bin, chunk.time_bin))
+            time_ranges[key] = (min(earliest, chunk.time_bin), max(latest, chunk.time_bin))
+        
+        for (study_id, participant_id, data_type), (earliest, latest) in time_ranges.items():
+            cls.expand(study_id, participant_id, data_type, earliest, latest)
+    
+    @classmethod
+    def expand(cls, study_id: int, participant_id: int, data_type: str, earliest: datetime,
+               latest: datetime, retry: bool = True):
+        # a single update statement, concurrent file processing can't undo another's expansion.
+        updated = cls.objects.filter(participant_id=participant_id, data_type=data_type).update(
+            earliest_time_bin=Least("earliest_time_bin", Value(earliest, output_field=models.DateTimeField())),
+            latest_time_bin=Greatest("latest_time_bin", Value(latest, output_field=models.DateTimeField())),
+            last_updated=timezone.now(),
+        )
+        if updated:
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(
+                    study_id=study_id,
+                    participant_id=participant_id,
+                    data_type=data_type,
+                    earliest_time_bin=earliest,
+                    latest_time_bin=latest,
+                )
+        except (IntegrityError, ValidationError):
+            # it was just created by another process, expand that one.
+            if not retry:
+                raise
+            cls.expand(study_id, participant_id, data_type, earliest, latest, retry=False)
+    
+    @classmethod
+    def recalculate_participant(cls, participant: Participant):
+        """ Rebuilds a participant's time ranges from their ChunkRegistries, call this after
+        deleting ChunkRegistries. """
+        with transaction.atomic():
+            cls.objects.filter(participant=participant).delete()
+            cls.objects.bulk_create([
+                cls(
+                    study_id=participant.study_id,
+                    participant=participant,
+                    data_type=time_range["data_type"],
+                    earliest_time_bin=time_range["earliest"],
+                    latest_time_bin=time_range["latest"],
+                )
+                for time_range in participant.chunk_registries
+                .filter(time_bin__gte=EARLIEST_VALID_TIME_BIN)
+                .values("data_type")
+                .annotate(earliest=Min("time_bin"), latest=Max("time_bin"))
+                .order_by()
+            ])
+
+
 class FileToProcess(TimestampedModel):
     s3_file_path = models.CharField(max_length=256, blank=False, unique=True)
     study = models.ForeignKey('Study', on_delete=models.PROTECT, related_name='files_to_process')
@@ -264,6 +437,54 @@ class FileToProcess(TimestampedModel):
         )
 
 
+class DataManifest(TimestampedModel):
+    """ The ordered list of ChunkRegistries that matched a data access api query, a download can be
+    fetched as any number of zip files that each contain a range of the manifest. """
+    token = models.CharField(max_length=24, unique=True, validators=[LengthValidator(24)])
+    study = models.ForeignKey(Study, on_delete=models.CASCADE, related_name='data_manifests')
+    researcher = models.ForeignKey(
+        'Researcher', on_delete=models.CASCADE, related_name='data_manifests'
+    )
+    chunk_ids = JSONTextField()  # json list of ChunkRegistry pks, in manifest order
+    expires = models.DateTimeField(db_index=True)
+    
+    @classmethod
+    def create_for_chunks(cls, study: Study, researcher, chunk_ids: List[int]) -> "DataManifest":
+        # manifests are only ever looked up by token, expired ones are cleaned up here.
+        cls.objects.filter(expires__lt=timezone.now()).delete()
+        return cls.objects.create(
+            token=cls.generate_objectid_string("token"),
+            study=study,
+            researcher=researcher,
+            chunk_ids=json.dumps(chunk_ids),
+            expires=timezone.now() + DATA_MANIFEST_LIFETIME,
+        )
+    
+    @property
+    def is_expired(self) -> bool:
+        return self.expires < timezone.now()
+    
+    def get_chunk_ids(self) -> List[int]:
+        return json.loads(self.chunk_ids)
+    
+    def chunks_in_range(self, start: int, end: int, chunk_ids: List[int] = None):
+        """ A generator of the CHUNK_FIELDS values dicts of the manifest's chunks from index start up
+        to (not including) index end, in manifest order.  Chunks deleted since the manifest was
+        created are skipped.  Pass chunk_ids (from get_chunk_ids) if they have already been parsed. """
+        if chunk_ids is None:
+            chunk_ids = self.get_chunk_ids()
+        chunk_ids = chunk_ids[start:end]
+        for i in range(0, len(chunk_ids), DATA_MANIFEST_QUERY_BATCH_SIZE):
+            batch = chunk_ids[i:i + DATA_MANIFEST_QUERY_BATCH_SIZE]
+            chunks = {
+                chunk["pk"]: chunk for chunk in
+                ChunkRegistry.objects.filter(study_id=self.study_id, pk__in=batch).values(*CHUNK_FIELDS)
+            }
+            for chunk_id in batch:
+                if chunk_id in chunks:
+                    yield chunks[chunk_id]
+
+
 # Everything below this line should [only] be deleting by reverting the correct commit.
 class InvalidUploadParameterError(Exception): pass
 
@@ -0,0 +1,88 @@
+from django.db.migrations import AddIndex
+from django.db.migrations.operations.base import Operation
+
+
+class AddIndexConcurrently(AddIndex):
+    """ As AddIndex, but on postgres the index is built with CREATE INDEX CONCURRENTLY, which does
+    not lock the table against writes while it is built.  (Django 3.0 ships this operation in
+    django.contrib.postgres.operations, remove this when we upgrade.)
+    Migrations using this operation must set atomic = False. """
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor != "postgresql":
+            return super().database_forwards(app_label, schema_editor, from_state, to_state)
+
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            # a failed concurrent build leaves an invalid index behind, which blocks a retry.
+            schema_editor.execute(
+                "DROP INDEX CONCURRENTLY IF EXISTS %s" % schema_editor.quote_name(self.index.name)
+            )
+            sql = str(self.index.create_sql(model, schema_editor))
+            schema_editor.execute(sql.replace("CREATE INDEX", "CREATE INDEX CONCURRENTLY", 1))
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor != "postgresql":
+            return super().database_backwards(app_label, schema_editor, from_state, to_state)
+
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            schema_editor.execute(
+                "DROP INDEX CONCURRENTLY IF EXISTS %s" % schema_editor.quote_name(self.index.name)
+            )
+
+    def describe(self):
+        return "Concurrently create index %s on field(s) %s of model %s" % (
+            self.index.name, ", ".join(self.index.fields), self.model_name,
+        )
+
+
+
+class AddTrigramIndexConcurrently(Operation):
+    """ Postgres only: concurrently builds a pg_trgm GIN index on UPPER(field), which is what
+    Django's icontains lookup compares against, so `field__icontains` searches of 3 or more
+    characters can use the index instead of scanning the table.  Does nothing on other databases.
+    Django 2.2 can't express an opclass on an expression index in Model.Meta, so this index is not
+    part of the model state.  Migrations using this operation must set atomic = False. """
+
+    reversible = True
+
+    def __init__(self, model_name: str, field_name: str, name: str):
+        self.model_name = model_name
+        self.field_name = field_name
+        self.name = name
+
+    def state_forwards(self, app_label, state):
+        pass
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor != "postgresql":
+            return
+
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            quote_name = schema_editor.quote_name
+            schema_editor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+            schema_editor.execute("DROP INDEX CONCURRENTLY IF EXISTS %s" % quote_name(self.name))
+            schema_editor.execute(
+                "CREATE INDEX CONCURRENTLY %s ON %s USING gin (UPPER(%s::text) gin_trgm_ops)" % (
+                    quote_name(self.name),
+                    quote_name(model._meta.db_table),
+                    quote_name(model._meta.get_field(self.field_name).column),
+                )
+            )
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor != "postgresql":
+            return
+
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            schema_editor.execute(
+                "DROP INDEX CONCURRENTLY IF EXISTS %s" % schema_editor.quote_name(self.name)
+            )
+
+    def describe(self):
+        return "Concurrently create trigram index %s on field %s of model %s" % (
+            self.name, self.field_name, self.model_name,
+        )
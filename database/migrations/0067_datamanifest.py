@@ -0,0 +1,32 @@
+# Generated by Django 2.2.27 on 2026-10-18 21:42
+
+import database.common_models
+import database.validators
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('database', '0066_remove_researcher_is_batch_user'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DataManifest',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+                ('last_updated', models.DateTimeField(auto_now=True)),
+                ('token', models.CharField(max_length=24, unique=True, validators=[database.validators.LengthValidator(24)])),
+                ('chunk_ids', database.common_models.JSONTextField()),
+                ('expires', models.DateTimeField(db_index=True)),
+                ('researcher', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='data_manifests', to='database.Researcher')),
+                ('study', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='data_manifests', to='database.Study')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 2.2.27 on 2026-10-18 21:43
+
+from django.db import migrations, models
+
+from database.migration_operations import AddIndexConcurrently
+
+
+class Migration(migrations.Migration):
+    # indexes can only be built concurrently outside of a transaction
+    atomic = False
+
+    dependencies = [
+        ('database', '0067_datamanifest'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='chunkregistry',
+            index=models.Index(fields=['study', 'data_type', 'time_bin'], name='chunk_study_type_time'),
+        ),
+        AddIndexConcurrently(
+            model_name='chunkregistry',
+            index=models.Index(fields=['participant', 'data_type', 'time_bin', 'file_size'], name='chunk_participant_type_time'),
+        ),
+        AddIndexConcurrently(
+            model_name='chunkregistry',
+            index=models.Index(fields=['participant', 'time_bin', 'file_size'], name='chunk_participant_time'),
+        ),
+        AddIndexConcurrently(
+            model_name='chunkregistry',
+            index=models.Index(fields=['study', 'last_updated', 'participant'], name='chunk_study_updated'),
+        ),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 2.2.27 on 2026-10-18 21:46
+
+from datetime import datetime, timezone
+
+from django.db import migrations, models
+from django.db.models import Max, Min
+import django.db.models.deletion
+
+
+def populate_chunk_time_ranges(apps, schema_editor):
+    """ Calculates the time ranges of all existing ChunkRegistries, this is an aggregate over the
+    whole table, it may take a while. """
+    ChunkRegistry = apps.get_model('database', 'ChunkRegistry')
+    ChunkTimeRange = apps.get_model('database', 'ChunkTimeRange')
+    # (the value of EARLIEST_VALID_TIME_BIN at the time of this migration)
+    time_ranges = ChunkRegistry.objects.filter(
+        time_bin__gte=datetime(1970, 1, 2, tzinfo=timezone.utc)
+    ).values("study_id", "participant_id", "data_type").annotate(
+        earliest=Min("time_bin"), latest=Max("time_bin")
+    ).order_by()
+    ChunkTimeRange.objects.bulk_create(
+        (
+            ChunkTimeRange(
+                study_id=time_range["study_id"],
+                participant_id=time_range["participant_id"],
+                data_type=time_range["data_type"],
+                earliest_time_bin=time_range["earliest"],
+                latest_time_bin=time_range["latest"],
+            )
+            for time_range in time_ranges.iterator()
+        ),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+    # the population step is a long aggregate over ChunkRegistry, don't hold a transaction open
+    # for it.  The table is created first, so a failure can be recovered with recalculate_participant.
+    atomic = False
+
+    dependencies = [
+        ('database', '0068_chunkregistry_composite_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChunkTimeRange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+                ('last_updated', models.DateTimeField(auto_now=True)),
+                ('data_type', models.CharField(max_length=32)),
+                ('earliest_time_bin', models.DateTimeField()),
+                ('latest_time_bin', models.DateTimeField()),
+                ('participant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chunk_time_ranges', to='database.Participant')),
+                ('study', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chunk_time_ranges', to='database.Study')),
+            ],
+            options={
+                'unique_together': {('participant', 'data_type')},
+            },
+        ),
+        migrations.RunPython(populate_chunk_time_ranges, migrations.RunPython.noop),
+    ]
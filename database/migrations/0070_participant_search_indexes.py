@@ -0,0 +1,24 @@
+# Generated by Django 2.2.27 on 2026-10-18 21:51
+
+from django.db import migrations, models
+
+from database.migration_operations import AddIndexConcurrently, AddTrigramIndexConcurrently
+
+
+class Migration(migrations.Migration):
+    # indexes can only be built concurrently outside of a transaction
+    atomic = False
+
+    dependencies = [
+        ('database', '0069_chunktimerange'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='participant',
+            index=models.Index(fields=['study', 'created_on'], name='participant_study_created'),
+        ),
+        AddTrigramIndexConcurrently(
+            model_name='participant', field_name='patient_id', name='participant_patient_id_trgm',
+        ),
+    ]
@@ -1,13 +1,12 @@
 from __future__ import annotations
 
-import operator
 from datetime import datetime
 from typing import Optional
 
 from dateutil.tz import gettz
 from django.core.exceptions import ObjectDoesNotExist
 from django.db import models
-from django.db.models import F, Func, Q
+from django.db.models import F, Func, Max, Min, Q
 from django.db.models.query import QuerySet
 from django.utils import timezone
 from django.utils.timezone import localtime
@@ -19,6 +18,7 @@ from database.models import JSONTextField, TimestampedModel
 from database.tableau_api_models import ForestParam
 from database.user_models import Participant, Researcher
 from database.validators import LengthValidator
+from libs.key_caches import STUDY_ENCRYPTION_KEY_CACHE
 
 
 class Study(TimestampedModel):
@@ -65,6 +65,8 @@ class Study(TimestampedModel):
             settings.save()
             # update the study object to have a device settings object (possibly unnecessary?).
             super().save(*args, **kwargs)
+        # the encryption key may have changed.
+        STUDY_ENCRYPTION_KEY_CACHE.remove(self.object_id)
     
     @classmethod
     def create_with_object_id(cls, **kwargs):
@@ -125,30 +127,57 @@ class Study(TimestampedModel):
         """
         Return the earliest ChunkRegistry time bin datetime for this study.
 
-        Note: As of 2021-07-01, running the query as a QuerySet filter or sorting the QuerySet can
-              take upwards of 30 seconds. Doing the logic in python speeds this up tremendously.
+        Note: As of 2021-07-01, running the query on ChunkRegistry as a QuerySet filter or sorting
+              the QuerySet can take upwards of 30 seconds.  The time ranges of valid time bins (after
+              EARLIEST_VALID_TIME_BIN, 1970-01-02) are maintained in ChunkTimeRange, ChunkRegistry is
+              only queried for the participants and data streams with time bins in the future, and
+              for pre-epoch data.
         Args:
             earliest: if True, will return earliest datetime; if False, will return latest datetime
             only_after_epoch: if True, will filter results only for datetimes after the Unix epoch
-                              (1970-01-01T00:00:00Z)
+                              (1970-01-02T00:00:00Z, the day after the epoch)
             only_before_now: if True, will filter results only for datetimes before now
         """
-        time_bins = self.chunk_registries.values_list("time_bin", flat=True)
-        comparator = operator.lt if earliest else operator.gt
+        aggregate = Min if earliest else Max
         now = timezone.now()
-        desired_time_bin = None
-        for time_bin in time_bins:
-            if only_after_epoch and time_bin.timestamp() <= 0:
-                continue
-            if only_before_now and time_bin > now:
-                continue
-            if desired_time_bin is None:
-                desired_time_bin = time_bin
-                continue
-            if comparator(desired_time_bin, time_bin):
-                continue
-            desired_time_bin = time_bin
-        return desired_time_bin
+        if only_after_epoch:
+            if earliest or not only_before_now:
+                time_bin = self.chunk_time_ranges.aggregate(
+                    time_bin=aggregate("earliest_time_bin" if earliest else "latest_time_bin")
+                )["time_bin"]
+                if earliest and only_before_now and time_bin is not None and time_bin > now:
+                    return None  # all of the data is in the future
+                return time_bin
+            return self._get_latest_time_bin_before(now)
+        
+        # the pre-epoch data was requested
+        time_bins = self.chunk_registries.all()
+        if only_before_now:
+            time_bins = time_bins.filter(time_bin__lte=now)
+        return time_bins.aggregate(time_bin=aggregate("time_bin"))["time_bin"]
+    
+    def _get_latest_time_bin_before(self, now: datetime) -> Optional[datetime]:
+        """ The latest valid time bin that is not after now.  Devices with their clock set to the
+        future can upload data with time bins in the future, the latest earlier time bin of those
+        participants' data streams has to be found in ChunkRegistry, one stream at a time. """
+        latest = self.chunk_time_ranges.filter(latest_time_bin__lte=now).aggregate(
+            time_bin=Max("latest_time_bin")
+        )["time_bin"]
+        # data streams with data before and after now, data streams entirely in the future are skipped.
+        future_time_ranges = self.chunk_time_ranges.filter(
+            latest_time_bin__gt=now, earliest_time_bin__lte=now
+        ).values_list("participant_id", "data_type", "earliest_time_bin")
+        for participant_id, data_type, earliest_time_bin in future_time_ranges:
+            if latest is None or earliest_time_bin > latest:
+                latest = earliest_time_bin
+            # only a later time bin than the latest found so far can change the result.
+            time_bin = self.chunk_registries.filter(
+                participant_id=participant_id, data_type=data_type, time_bin__gt=latest,
+                time_bin__lte=now,
+            ).aggregate(time_bin=Max("time_bin"))["time_bin"]
+            if time_bin is not None:
+                latest = time_bin
+        return latest
     
     def notification_events(self, **archived_event_filter_kwargs):
         from database.schedule_models import ArchivedEvent
@@ -167,10 +196,20 @@ class Study(TimestampedModel):
         return gettz(self.timezone_name)
     
     def filtered_participants(self, contains_string: str):
-        return (
-            Participant.objects.filter(study_id=self.id)
-                       .filter(Q(patient_id__icontains=contains_string) |
-                               Q(os_type__icontains=contains_string))
+        """ Participants whose patient id or os type contains the string, case-insensitively. """
+        participants = Participant.objects.filter(study_id=self.id)
+        if not contains_string:
+            return participants
+        # There are only a few os types, matching them here leaves the patient_id__icontains as the
+        # only LIKE in the query, which postgres can answer from the trigram index on patient_id.
+        os_types = [
+            os_type for os_type, _ in Participant.OS_TYPE_CHOICES
+            if os_type and contains_string.lower() in os_type.lower()
+        ]
+        if not os_types:
+            return participants.filter(patient_id__icontains=contains_string)
+        return participants.filter(
+            Q(patient_id__icontains=contains_string) | Q(os_type__in=os_types)
         )
 
 
@@ -10,6 +10,7 @@ from constants.researcher_constants import ResearcherRole
 from database.common_models import UtilityModel
 from database.models import TimestampedModel
 from database.validators import ID_VALIDATOR, STANDARD_BASE_64_VALIDATOR, URL_SAFE_BASE_64_VALIDATOR
+from libs.key_caches import clear_participant_key_caches, PRIVATE_KEY_CACHE
 from libs.security import (compare_password, device_hash, generate_easy_alphanumeric_string,
     generate_hash_and_salt, generate_random_string, generate_user_hash_and_salt)
 
@@ -122,6 +123,12 @@ class Participant(AbstractPasswordUser):
     # "Unregistered" means the participant is blocked from uploading further data.
     unregistered = models.BooleanField(default=False)
     
+    class Meta:
+        # The participants table on the study page sorts by creation date by default, and pages
+        # through it with a keyset (see api.study_api.get_values_for_participants_table).  The
+        # patient_id search has a postgres trigram index, see migration 0070.
+        indexes = [models.Index(fields=["study", "created_on"], name="participant_study_created")]
+    
     @classmethod
     def create_with_password(cls, **kwargs) -> Tuple[str, str]:
         """ Creates a new participant with randomly generated patient_id and password. """
@@ -166,8 +173,17 @@ class Participant(AbstractPasswordUser):
         ).order_by("-scheduled_time")
     
     def get_private_key(self):
-        from libs.s3 import get_client_private_key  # weird import triangle
-        return get_client_private_key(self.patient_id, self.study.object_id)
+        """ The participant's RSA private key, retrieved from S3 and cached in memory. """
+        private_key = PRIVATE_KEY_CACHE.get((self.patient_id,))
+        if private_key is None:
+            from libs.s3 import get_client_private_key  # weird import triangle
+            private_key = get_client_private_key(self.patient_id, self.study.object_id)
+            PRIVATE_KEY_CACHE.set((self.patient_id,), private_key)
+        return private_key
+    
+    def clear_key_caches(self):
+        """ Drops this participant's cached encryption keys, call when their device changes. """
+        clear_participant_key_caches(self.patient_id)
     
     def __str__(self):
         return f'{self.patient_id} of Study "{self.study.name}"'
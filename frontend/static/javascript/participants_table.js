@@ -1,9 +1,34 @@
 $(document).ready(function(){
+    // The server returns a cursor for the page after each page it sends, passing it back makes the
+    // server read the next page with a keyset instead of an offset.  Cursors are only valid for the
+    // sort order and search they were made with, so they are stored under all three.
+    var cursors = {};
+    var pendingCursorKeys = {};
+    function cursorKey(order, search, start) {
+        return JSON.stringify([order[0].column, order[0].dir, search.value, start]);
+    }
+
     // Set up the main list of participants using DataTables
     $("#participantList").DataTable({
         "processing": true,
         "serverSide": true,
-        "ajax": "/study/" + studyId + "/get_participants_api",
+        "ajax": {
+            "url": "/study/" + studyId + "/get_participants_api",
+            "data": function(d) {
+                var cursor = cursors[cursorKey(d.order, d.search, d.start)];
+                if (cursor) {
+                    d.cursor = cursor;
+                }
+                pendingCursorKeys[d.draw] = cursorKey(d.order, d.search, d.start + d.length);
+            },
+            "dataSrc": function(json) {
+                if (json.next_cursor) {
+                    cursors[pendingCursorKeys[json.draw]] = json.next_cursor;
+                }
+                delete pendingCursorKeys[json.draw];
+                return json.data;
+            },
+        },
         "columnDefs": [
             // Format the second column (index 1) to be a link to the View Participant page
             {"targets": 1, "render": function(data, type, row, meta) {
@@ -1,8 +1,9 @@
 import json
 import traceback
+from hashlib import sha256
 from os import urandom
 from sys import version_info
-from typing import List, Tuple
+from typing import Generator, Iterable, List, Tuple
 
 from Crypto.PublicKey import RSA as old_RSA
 from Cryptodome.Cipher import AES
@@ -14,6 +15,7 @@ from database.profiling_models import (DecryptionKeyError, EncryptionErrorMetada
     LineEncryptionError)
 from database.study_models import Study
 from database.user_models import Participant
+from libs.key_caches import AES_KEY_CACHE, STUDY_ENCRYPTION_KEY_CACHE
 from libs.security import Base64LengthException, decode_base64, encode_base64, PaddingException
 
 
@@ -81,6 +83,17 @@ def get_RSA_cipher(key: bytes) -> old_RSA._RSAobj:
 ################################################################################
 
 
+def get_study_encryption_key(study_object_id: str) -> bytes:
+    """ The study's encryption key, from the study key cache if possible. """
+    encryption_key = STUDY_ENCRYPTION_KEY_CACHE.get(study_object_id)
+    if encryption_key is None:
+        encryption_key = Study.objects.filter(
+            object_id=study_object_id
+        ).values_list('encryption_key', flat=True).get().encode()
+        STUDY_ENCRYPTION_KEY_CACHE.set(study_object_id, encryption_key)
+    return encryption_key
+
+
 def encrypt_for_server(input_string: bytes, study_object_id: str) -> bytes:
     """
     Encrypts config using the ENCRYPTION_KEY, prepends the generated initialization vector.
@@ -88,24 +101,66 @@ def encrypt_for_server(input_string: bytes, study_object_id: str) -> bytes:
     """
     if not isinstance(study_object_id, str):
         raise Exception(f"received non-string object {study_object_id}")
-    encryption_key = Study.objects.get(object_id=study_object_id).encryption_key.encode()  # bytes
+    encryption_key = get_study_encryption_key(study_object_id)  # bytes
     iv = urandom(16)  # bytes
     return iv + AES.new(encryption_key, AES.MODE_CFB, segment_size=8, IV=iv).encrypt(input_string)
 
 
+def encrypt_for_server_stream(
+    blocks: Iterable[bytes], study_object_id: str
+) -> Generator[bytes, None, None]:
+    """ As encrypt_for_server, but takes the data as an iterable of blocks and yields the encrypted
+    data block by block, starting with the initialization vector. """
+    if not isinstance(study_object_id, str):
+        raise Exception(f"received non-string object {study_object_id}")
+    encryption_key = get_study_encryption_key(study_object_id)
+    iv = urandom(16)
+    cipher = AES.new(encryption_key, AES.MODE_CFB, segment_size=8, IV=iv)
+    yield iv
+    for block in blocks:
+        yield cipher.encrypt(block)
+
+
 def decrypt_server(data: bytes, study_object_id: str) -> bytes:
     """ Decrypts config encrypted by the encrypt_for_server function. """
     if not isinstance(study_object_id, str):
         raise TypeError(f"received non-string object {study_object_id}")
     
-    encryption_key = Study.objects.filter(
-        object_id=study_object_id
-    ).values_list('encryption_key', flat=True).get().encode()
+    encryption_key = get_study_encryption_key(study_object_id)
     iv = data[:16]
-    data = data[16:]  # gr arg, memcopy operation...
+    data = memoryview(data)[16:]  # slicing a memoryview does not copy the data
     return AES.new(encryption_key, AES.MODE_CFB, segment_size=8, IV=iv).decrypt(data)
 
 
+def decrypt_server_stream(
+    encrypted_blocks: Iterable[bytes], study_object_id: str, encryption_key: bytes = None
+) -> Generator[bytes, None, None]:
+    """ As decrypt_server, but takes the encrypted data as an iterable of blocks (of any size) and
+    yields the decrypted data block by block, so the whole file is never held in memory.  Pass the
+    study's encryption_key if it is already known, otherwise it is looked up. """
+    if not isinstance(study_object_id, str):
+        raise TypeError(f"received non-string object {study_object_id}")
+    
+    if encryption_key is None:
+        encryption_key = get_study_encryption_key(study_object_id)
+    iv = b""
+    cipher = None
+    for block in encrypted_blocks:
+        if cipher is None:
+            # the iv is the first 16 bytes, which may be split across blocks.
+            iv_bytes_needed = 16 - len(iv)
+            iv += block[:iv_bytes_needed]
+            if len(iv) < 16:
+                continue
+            cipher = AES.new(encryption_key, AES.MODE_CFB, segment_size=8, IV=iv)
+            block = memoryview(block)[iv_bytes_needed:]
+        if block:
+            yield cipher.decrypt(block)
+    
+    if cipher is None:
+        raise ValueError("Incorrect IV length (it must be 16 bytes long)")
+
+
 ########################### User/Device Decryption #############################
 
 
@@ -127,7 +182,7 @@ def decrypt_device_file(file_name: str, original_data: bytes, participant: Parti
     bad_lines = []
     error_types = []
     error_count = 0
-    good_lines = []
+    decoded_lines = []
     
     # don't refactor to pop the decryption key line out of the file_data list, this list
     # can be thousands of lines.  Also, this line is a 2x memcopy with N new bytes objects.
@@ -136,10 +191,16 @@ def decrypt_device_file(file_name: str, original_data: bytes, participant: Parti
     if not file_data:
         raise HandledError("The file had no data in it.  Return 200 to delete file from device.")
     
-    private_key_cipher = participant.get_private_key()
-    aes_decryption_key = extract_aes_key(
-        file_name, file_data, participant, private_key_cipher, original_data
-    )
+    # Devices reuse their (encrypted) AES key for many files, decrypting it is expensive and only
+    # successfully decrypted and validated keys are cached.
+    aes_key_cache_key = (participant.patient_id, sha256(file_data[0]).digest())
+    aes_decryption_key = AES_KEY_CACHE.get(aes_key_cache_key)
+    if aes_decryption_key is None:
+        private_key_cipher = participant.get_private_key()
+        aes_decryption_key = extract_aes_key(
+            file_name, file_data, participant, private_key_cipher, original_data
+        )
+        AES_KEY_CACHE.set(aes_key_cache_key, aes_decryption_key)
     
     for i, line in enumerate(file_data):
         # we need to skip the first line (the decryption key), but need real index values in i
@@ -156,7 +217,8 @@ def decrypt_device_file(file_name: str, original_data: bytes, participant: Parti
             continue
         
         try:
-            good_lines.append(decrypt_device_line(participant.patient_id, aes_decryption_key, line))
+            # lines are validated and decoded here, and decrypted together after the loop.
+            decoded_lines.append(decode_device_line(participant.patient_id, line))
         except Exception as error_orig:
             error_string = str(error_orig)
             error_count += 1
@@ -263,7 +325,7 @@ def decrypt_device_file(file_name: str, original_data: bytes, participant: Parti
         )
     
     # join should be rather well optimized and not cause O(n^2) total memory copies
-    return b"\n".join(good_lines)
+    return b"\n".join(decrypt_device_lines(aes_decryption_key, decoded_lines))
 
 
 def extract_aes_key(
@@ -345,7 +407,12 @@ def decrypt_device_line(patient_id, key, data: bytes) -> bytes:
         value 1 is the symmetric key, encrypted with the patient's public key.
         value 2 is the initialization vector for the AES CBC cipher.
         value 3 is the config, encrypted using AES CBC, with the provided key and iv. """
-    # orig_data = data
+    return decrypt_device_lines(key, [decode_device_line(patient_id, data)])[0]
+
+
+def decode_device_line(patient_id, data: bytes) -> Tuple[bytes, bytes]:
+    """ Splits and base64 decodes a line of a device file into its iv and encrypted data, raising
+    the line's error if it cannot be decrypted. """
     iv, data = data.split(b":")
     iv = decode_base64(iv)
     data = decode_base64(data)
@@ -365,34 +432,38 @@ def decrypt_device_line(patient_id, key, data: bytes) -> bytes:
         print("\n\n")
         data = data[:-overflow_bytes]
     
-    try:
-        decipherer = AES.new(key, mode=AES.MODE_CBC, IV=iv)
-        decrypted = decipherer.decrypt(data)
-    except Exception:
-        if iv is None:
-            len_iv = "None"
-        else:
-            len_iv = len(iv)
-        if data is None:
-            len_data = "None"
-        else:
-            len_data = len(data)
-        if key is None:
-            len_key = "None"
-        else:
-            len_key = len(key)
-        # these print statements cause problems in getting encryption errors because the print
-        # statement will print to an ascii formatted log file on the server, which causes
-        # ascii encoding error.  Enable them for debugging only. (leave uncommented for Sentry.)
-        # print("length iv: %s, length data: %s, length key: %s" % (len_iv, len_data, len_key))
-        # print('%s %s %s' % (patient_id, key, orig_data))
-        raise
+    # (this is the error message pycryptodome raises when creating the cipher)
+    if len(iv) != 16:
+        raise ValueError("Incorrect IV length (it must be 16 bytes long)")
+    
+    return iv, data
+
+
+def decrypt_device_lines(key: bytes, decoded_lines: List[Tuple[bytes, bytes]]) -> List[bytes]:
+    """ Decrypts the (iv, data) pairs from decode_device_line, returns a list of decrypted lines.
+    
+    Each line is a separate AES CBC message, decrypting them one at a time means creating a cipher
+    object per line.  Instead, all lines are decrypted at once: CBC decryption of a block is the
+    ECB decryption of that block XORed with the preceding ciphertext block (the iv for the first
+    block of a line), so we ECB-decrypt all of the data in one call and XOR it with a buffer of
+    the preceding blocks, as (large) integers. """
+    if not decoded_lines:
+        return []
     
-    # PKCS5 Padding: The last byte of the byte-string contains the number of bytes at the end of the
-    # bytestring that are padding.  As string slicing in python are a copy operation we will
-    # detect the fast-path case of no change so that we can skip it
-    num_padding_bytes = decrypted[-1]
-    if num_padding_bytes:
-        decrypted = decrypted[0: -num_padding_bytes]
+    ciphertext = b"".join(data for _, data in decoded_lines)
+    preceding_blocks = b"".join(iv + data[:-16] for iv, data in decoded_lines)
+    decrypted = (
+        int.from_bytes(AES.new(key, mode=AES.MODE_ECB).decrypt(ciphertext), "big")
+        ^ int.from_bytes(preceding_blocks, "big")
+    ).to_bytes(len(ciphertext), "big")
+    del ciphertext, preceding_blocks
     
-    return decrypted
+    # PKCS5 Padding: The last byte of each line contains the number of bytes at the end of the
+    # line that are padding.
+    lines = []
+    start = 0
+    for _, data in decoded_lines:
+        end = start + len(data)
+        lines.append(decrypted[start:max(start, end - decrypted[end - 1])])
+        start = end
+    return lines
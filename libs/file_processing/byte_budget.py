@@ -0,0 +1,26 @@
+from threading import Lock
+
+
+class ByteBudget:
+    """ A thread-safe count of the bytes of file data in flight, limited to a budget.  Used by file
+    processing to decide when more files can be admitted into memory. """
+    
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.in_flight = 0
+        self.peak = 0
+        self._lock = Lock()
+    
+    def try_acquire(self, byte_count: int) -> bool:
+        """ Adds byte_count to the bytes in flight if it fits in the budget, returns success. An
+        acquisition larger than the whole budget succeeds only when nothing else is in flight. """
+        with self._lock:
+            if self.in_flight and self.in_flight + byte_count > self.budget:
+                return False
+            self.in_flight += byte_count
+            self.peak = max(self.peak, self.in_flight)
+            return True
+    
+    def release(self, byte_count: int):
+        with self._lock:
+            self.in_flight -= byte_count
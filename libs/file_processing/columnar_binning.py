@@ -0,0 +1,199 @@
+from collections import defaultdict
+from typing import DefaultDict, Iterator, List, Optional, Tuple
+
+from constants.data_processing_constants import CHUNK_TIMESLICE_QUANTUM
+from libs.file_processing.utility_functions_csvs import construct_csv_string_from_lines
+
+# numpy is not a requirement of the frontend servers, it is present on data processing servers
+# because forest depends on it.  If it is missing the columnar engine simply reports itself as
+# unavailable and file processing uses the row-by-row code.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+COLUMNAR_ENGINE_AVAILABLE = numpy is not None
+
+"""
+The columnar engine is an alternative to csv_to_list + binify_csv_rows for csv files that need no
+per-stream data fixes.  Instead of turning every line of a file into a list of bytes objects it
+finds line and first-column boundaries with vectorized operations on the file's bytes, parses the
+timestamp column into an int64 array, and computes time bins, sort order and bin boundaries from
+those arrays.  The file's bytes are only sliced again when the final chunk csv is constructed.
+
+Output is byte-identical to the row-by-row code.  Anything the engine can't reproduce exactly
+(non-digit timestamps, timestamps that don't fit in an int64 or can't be formatted as a date) makes
+it decline the file, and the caller falls back to the row-by-row code.
+"""
+
+NEWLINE = ord(b"\n")
+COMMA = ord(b",")
+ZERO = ord(b"0")
+
+# int("9" * 18) fits in an int64, we don't try to handle anything longer.
+MAX_TIMESTAMP_DIGITS = 18
+# datetime.utcfromtimestamp fails past the year 9999, in milliseconds.
+MAX_TIMESTAMP_MILLISECONDS = 253402300800000
+
+
+class ColumnarBin:
+    """ The rows of one data bin, stored as line offsets into the decrypted source file(s) plus
+    the parsed timestamp of each line.  A bin can contain segments from multiple files. """
+
+    __slots__ = ("segments",)
+
+    def __init__(self):
+        # list of (source bytes, line starts, first column ends, line ends, timestamps)
+        self.segments: List[Tuple[bytes, "numpy.ndarray", "numpy.ndarray", "numpy.ndarray", "numpy.ndarray"]] = []
+
+    def __len__(self):
+        return sum(len(segment[4]) for segment in self.segments)
+
+    def add_segment(self, source: bytes, starts, field_ends, ends, timestamps):
+        self.segments.append((source, starts, field_ends, ends, timestamps))
+
+    def extend(self, other: "ColumnarBin"):
+        self.segments.extend(other.segments)
+
+    def iter_rows(self) -> Iterator[List[bytes]]:
+        """ Yields each row as a list of bytes, exactly as csv_to_list would have, in file order.
+        Used when a bin also contains rows from the row-by-row code. """
+        for source, starts, _, ends, _ in self.segments:
+            for start, end in zip(starts.tolist(), ends.tolist()):
+                yield source[start:end].split(b",")
+
+    def sorted_lines(self) -> List[bytes]:
+        """ Returns the lines of this bin, with the "UTC time" column inserted as the second column,
+        stably sorted by timestamp.  Matches the lines of convert_unix_to_human_readable_timestamps,
+        stably sorted by timestamp. """
+        if not self.segments:
+            return []
+
+        lines = []
+        for source, starts, field_ends, ends, timestamps in self.segments:
+            lines.extend(_construct_lines(source, starts, field_ends, ends, timestamps))
+
+        all_timestamps = numpy.concatenate([segment[4] for segment in self.segments])
+        return [lines[i] for i in numpy.argsort(all_timestamps, kind="stable").tolist()]
+
+    def sorted_runs(self) -> List[List[Tuple[int, bytes]]]:
+        """ Returns one run of (timestamp, line) tuples per source file, each stably sorted by
+        timestamp, for merge_into_sorted_csv. Lines are as in sorted_lines. """
+        runs = []
+        for source, starts, field_ends, ends, timestamps in self.segments:
+            order = numpy.argsort(timestamps, kind="stable")
+            timestamps = timestamps[order]
+            runs.append(list(zip(
+                timestamps.tolist(),
+                _construct_lines(source, starts[order], field_ends[order], ends[order], timestamps),
+            )))
+        return runs
+
+    def construct_csv_string(self, updated_header: bytes) -> bytes:
+        """ The columnar equivalent of ensure_sorted_by_timestamp + construct_csv_string. """
+        return construct_csv_string_from_lines(updated_header, self.sorted_lines())
+
+
+def _construct_lines(source: bytes, starts, field_ends, ends, timestamps) -> List[bytes]:
+    """ Slices lines out of the source bytes, inserting the UTC time as the second column. """
+    return [
+        source[start:field_end] + b"," + utc_time + source[field_end:end]
+        for start, field_end, end, utc_time in
+        zip(starts.tolist(), field_ends.tolist(), ends.tolist(), format_utc_time_column(timestamps))
+    ]
+
+
+def format_utc_time_column(timestamps: "numpy.ndarray") -> List[bytes]:
+    """ Formats a column of unix millisecond timestamps as YYYY-MM-DDThh:mm:ss.mmm bytes. """
+    return numpy.datetime_as_string(
+        timestamps.astype("datetime64[ms]"), unit="ms"
+    ).astype("S23").tolist()
+
+
+def parse_timestamp_column(
+    buffer: "numpy.ndarray", starts: "numpy.ndarray", lengths: "numpy.ndarray"
+) -> Optional[Tuple["numpy.ndarray", "numpy.ndarray"]]:
+    """ Parses the digit strings at buffer[start:start + length] into integers.  Returns the full
+    values and the values of the first 10 digits (what clean_java_timecode uses), or None if any
+    field contains a non-digit character. """
+    values = numpy.zeros(len(starts), dtype=numpy.int64)
+    first_ten_values = numpy.zeros(len(starts), dtype=numpy.int64)
+    last_index = len(buffer) - 1
+
+    # one vectorized step per digit position rather than one python step per row.
+    for position in range(int(lengths.max())):
+        in_field = lengths > position
+        digits = buffer[numpy.minimum(starts + position, last_index)].astype(numpy.int64) - ZERO
+        if ((digits < 0) | (digits > 9))[in_field].any():
+            return None
+        values = numpy.where(in_field, values * 10 + digits, values)
+        if position < 10:
+            first_ten_values = numpy.where(in_field, first_ten_values * 10 + digits, first_ten_values)
+
+    return values, first_ten_values
+
+
+def binify_csv_columnar(
+    file_contents: bytes, study_id: str, user_id: str, data_type: str, header: bytes
+) -> Optional[DefaultDict[tuple, ColumnarBin]]:
+    """ Columnar version of csv_to_list + binify_csv_rows.  Expects the header to be the first line
+    of file_contents, header is the already-cleaned header used in the data bin key.
+    Returns a dict of form {(study_id, user_id, data_type, time_bin, header): ColumnarBin}, or None
+    if the file can't be handled by this engine. """
+    ret = defaultdict(ColumnarBin)
+
+    buffer = numpy.frombuffer(file_contents, dtype=numpy.uint8)
+    newlines = numpy.flatnonzero(buffer == NEWLINE)
+    if len(newlines) == 0:
+        return ret  # just a header
+
+    # every line after the header, including a possibly empty final line.
+    starts = newlines + 1
+    ends = numpy.append(newlines[1:], len(buffer))
+
+    # the first column ends at the first comma on the line, or at the end of the line.
+    commas = numpy.append(numpy.flatnonzero(buffer == COMMA), len(buffer))
+    field_ends = numpy.minimum(commas[numpy.searchsorted(commas, starts)], ends)
+
+    # lines without a value in the first column (e.g. empty lines) are dropped, like binify_csv_rows
+    lengths = field_ends - starts
+    keep = lengths > 0
+    starts, field_ends, ends, lengths = starts[keep], field_ends[keep], ends[keep], lengths[keep]
+    if len(starts) == 0:
+        return ret
+
+    if lengths.max() > MAX_TIMESTAMP_DIGITS:
+        return None
+    parsed = parse_timestamp_column(buffer, starts, lengths)
+    if parsed is None:
+        return None
+    timestamps, first_ten_digits = parsed
+    if timestamps.max() >= MAX_TIMESTAMP_MILLISECONDS:
+        return None
+
+    # group rows by time bin, a stable sort retains the file order of rows inside each bin.
+    time_bins = first_ten_digits // CHUNK_TIMESLICE_QUANTUM
+    order = numpy.argsort(time_bins, kind="stable")
+    sorted_bins = time_bins[order]
+    boundaries = numpy.flatnonzero(numpy.diff(sorted_bins)) + 1
+
+    for group in numpy.split(order, boundaries):
+        time_bin = int(time_bins[group[0]])
+        ret[(study_id, user_id, data_type, time_bin, header)].add_segment(
+            file_contents, starts[group], field_ends[group], ends[group], timestamps[group]
+        )
+    return ret
+
+
+def merge_binned_rows(existing_rows: list or ColumnarBin, new_rows: list or ColumnarBin) -> list or ColumnarBin:
+    """ Combines the rows of a data bin from two sources.  If both sources are columnar the result
+    stays columnar, otherwise everything is materialized into rows for the row-by-row code. """
+    if isinstance(existing_rows, ColumnarBin) and isinstance(new_rows, ColumnarBin):
+        existing_rows.extend(new_rows)
+        return existing_rows
+    if isinstance(existing_rows, list) and not existing_rows and isinstance(new_rows, ColumnarBin):
+        return new_rows
+
+    rows = list(existing_rows.iter_rows()) if isinstance(existing_rows, ColumnarBin) else existing_rows
+    rows.extend(new_rows.iter_rows() if isinstance(new_rows, ColumnarBin) else new_rows)
+    return rows
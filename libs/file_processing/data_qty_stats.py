@@ -1,8 +1,10 @@
 from collections import defaultdict
-from datetime import datetime, timedelta
-from typing import Optional
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional, Tuple
 
+from django.db import transaction
 from django.db.models.query import QuerySet
+from django.utils import timezone
 from pytz import utc
 
 from constants.data_processing_constants import CHUNK_TIMESLICE_QUANTUM
@@ -34,7 +36,8 @@ def calculate_data_quantity_stats(
         earliest_time_bin_number: Optional[int] = None,
         latest_time_bin_number: Optional[int] = None,
 ):
-    """ Update the SummaryStatisticDaily  stats for a participant, using ChunkRegistry data
+    """ Update the SummaryStatisticDaily  stats for a participant, using ChunkRegistry data.
+    This is a full recalculation, file processing uses update_data_quantity_stats.
     earliest_time_bin_number -- expressed in hours since 1/1/1970
     latest_time_bin_number -- expressed in hours since 1/1/1970 """
     study_timezone = participant.study.timezone
@@ -65,6 +68,80 @@ def calculate_data_quantity_stats(
         SummaryStatisticDaily.objects.update_or_create(**data_quantity)
 
 
+def update_data_quantity_stats(participant: Participant, file_size_deltas: Dict[Tuple[datetime, str], int]):
+    """ Applies changes in ChunkRegistry file sizes, keyed by (time_bin, data_type), to the
+    participant's SummaryStatisticDaily byte counts.  This avoids calculate_data_quantity_stats'
+    scan of every ChunkRegistry in the date range; days that don't have a SummaryStatisticDaily
+    yet, and byte counts that are NULL (Forest creates summaries without them), are calculated in
+    full. """
+    study_timezone = participant.study.timezone
+    daily_deltas = defaultdict(lambda: defaultdict(int))
+    for (time_bin, data_type), delta in file_size_deltas.items():
+        if delta and data_type in ALL_DATA_STREAMS:
+            daily_deltas[time_bin.astimezone(study_timezone).date()][data_type] += delta
+    if not daily_deltas:
+        return
+    
+    with transaction.atomic():
+        summaries = {
+            summary.date: summary for summary in SummaryStatisticDaily.objects.select_for_update()
+                .filter(participant=participant, date__in=list(daily_deltas))
+        }
+        updated_fields = {"last_updated"}
+        now = timezone.now()
+        uncounted = defaultdict(list)  # NULL byte counts, as data_type: [day, ...]
+        for day, summary in summaries.items():
+            for data_type, delta in daily_deltas[day].items():
+                field_name = f"beiwe_{data_type}_bytes"
+                total_bytes = getattr(summary, field_name)
+                if total_bytes is None:
+                    uncounted[data_type].append(day)
+                    continue
+                setattr(summary, field_name, total_bytes + delta)
+                updated_fields.add(field_name)
+            summary.last_updated = now  # bulk_update does not apply auto_now
+        
+        # a delta to a NULL byte count would drop the bytes of every chunk already registered that day
+        for data_type, days in uncounted.items():
+            daily_data_quantities = get_daily_data_quantities(participant, days, data_type=data_type)
+            field_name = f"beiwe_{data_type}_bytes"
+            for day in days:
+                setattr(summaries[day], field_name, daily_data_quantities[day][data_type])
+            updated_fields.add(field_name)
+        SummaryStatisticDaily.objects.bulk_update(summaries.values(), updated_fields)
+        
+        new_days = [day for day in daily_deltas if day not in summaries]
+        if new_days:
+            create_data_quantity_stats(participant, new_days)
+
+
+def create_data_quantity_stats(participant: Participant, days: List[date]):
+    """ Creates SummaryStatisticDaily byte counts for the given days from ChunkRegistry data. """
+    daily_data_quantities = get_daily_data_quantities(participant, days)
+    new_summaries = []
+    for day in days:
+        summary = SummaryStatisticDaily(participant=participant, date=day)
+        for data_type, total_bytes in daily_data_quantities[day].items():
+            if data_type in ALL_DATA_STREAMS:
+                setattr(summary, f"beiwe_{data_type}_bytes", total_bytes)
+        new_summaries.append(summary)
+    SummaryStatisticDaily.objects.bulk_create(new_summaries)
+
+
+def get_daily_data_quantities(participant: Participant, days: List[date], data_type: str = None):
+    """ The participant's byte counts from ChunkRegistry data, as populate_data_quantity, covering
+    the given days (optionally only one data type). """
+    study_timezone = participant.study.timezone
+    query = ChunkRegistry.objects.filter(
+        participant=participant,
+        time_bin__gte=utc_datetime_of_local_midnight_date(min(days), study_timezone),
+        time_bin__lt=utc_datetime_of_local_midnight_date(max(days) + timedelta(days=1), study_timezone),
+    )
+    if data_type is not None:
+        query = query.filter(data_type=data_type)
+    return populate_data_quantity(query, study_timezone)
+
+
 def utc_datetime_of_local_midnight_date(local_date, local_timezone):
     local_midnight = datetime.combine(local_date, datetime.min.time()).replace(tzinfo=local_timezone)
     return local_midnight.astimezone(utc)
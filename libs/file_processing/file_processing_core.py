@@ -1,22 +1,28 @@
-from collections import defaultdict
-from datetime import datetime
-from multiprocessing.pool import ThreadPool
-from typing import DefaultDict
+from collections import defaultdict, deque
+from datetime import datetime, timedelta
+from multiprocessing.pool import AsyncResult, ThreadPool
+from typing import DefaultDict, Deque, Dict, Generator, List, Tuple
 
 from cronutils.error_handler import ErrorHandler
 from django.core.exceptions import ValidationError
+from django.utils import timezone
 
-from config.settings import CONCURRENT_NETWORK_OPS, FILE_PROCESS_PAGE_SIZE
+from config.settings import (COLUMNAR_FILE_PROCESSING, CONCURRENT_NETWORK_OPS,
+    FILE_PROCESS_MEMORY_BUDGET, FILE_PROCESS_MERGE_QUEUE_DEPTH, FILE_PROCESS_PAGE_SIZE,
+    FILE_PROCESS_QUEUE_DEPTH)
 from constants.data_processing_constants import CHUNK_TIMESLICE_QUANTUM, CHUNKS_FOLDER
 from constants.data_stream_constants import (ACCELEROMETER, ANDROID_LOG_FILE, CALL_LOG, IDENTIFIERS,
     SURVEY_DATA_FILES, SURVEY_TIMINGS, WIFI)
 from database.data_access_models import ChunkRegistry, FileToProcess
+from database.profiling_models import UploadTracking
 from database.system_models import FileProcessLock
 from database.user_models import Participant
-from libs.file_processing.batched_network_operations import batch_upload
+from libs.file_processing.byte_budget import ByteBudget
+from libs.file_processing.columnar_binning import (binify_csv_columnar, COLUMNAR_ENGINE_AVAILABLE,
+    merge_binned_rows)
 from libs.file_processing.data_fixes import (fix_app_log_file, fix_call_log_csv, fix_identifier_csv,
     fix_survey_timings, fix_wifi_csv)
-from libs.file_processing.data_qty_stats import calculate_data_quantity_stats
+from libs.file_processing.data_qty_stats import update_data_quantity_stats
 from libs.file_processing.exceptions import BadTimecodeError, ProcessingOverlapError
 from libs.file_processing.file_for_processing import FileForProcessing
 from libs.file_processing.uploader import PrepareDataForeUpload
@@ -24,6 +30,7 @@ from libs.file_processing.utility_functions_csvs import (clean_java_timecode, cs
     unix_time_to_string)
 from libs.file_processing.utility_functions_simple import (binify_from_timecode,
     resolve_survey_id_from_file_name)
+from libs.s3 import s3_get_size
 
 
 """########################## Hourly Update Tasks ###########################"""
@@ -52,120 +59,279 @@ def process_file_chunks():
         raise ProcessingOverlapError("Data processing overlapped with a previous data indexing run.")
     FileProcessLock.lock()
     
+    # the pipeline's thread pools are reused for every participant.
+    pipeline = FileProcessingPipeline(error_handler)
     try:
-        number_bad_files = 0
-        
         # Get the list of participants with open files to process
         participants = Participant.objects.filter(files_to_process__isnull=False).distinct()
         print("processing files for the following users: %s" % ",".join(participants.values_list('patient_id', flat=True)))
         
         for participant in participants:
-            while True:
-                previous_number_bad_files = number_bad_files
-                starting_length = participant.files_to_process.exclude(deleted=True).count()
-                
-                print("%s processing %s, %s files remaining" % (datetime.now(), participant.patient_id, starting_length))
-                
-                # Process the desired number of files and calculate the number of unprocessed files
-                number_bad_files += do_process_user_file_chunks(
-                        page_size=FILE_PROCESS_PAGE_SIZE,
-                        error_handler=error_handler,
-                        position=number_bad_files,
-                        participant=participant,
-                )
-                
-                # If no files were processed, quit processing
-                if (participant.files_to_process.exclude(deleted=True).count() == starting_length
-                        and previous_number_bad_files == number_bad_files):
-                    # Cases:
-                    #   every file broke, might as well fail here, and would cause infinite loop otherwise.
-                    #   no new files.
-                    break
+            pipeline.process_participant(participant)
     finally:
+        pipeline.close()
         FileProcessLock.unlock()
+        print("file processing stats:", pipeline.get_stats())
     
     error_handler.raise_errors()
 
 
-def do_process_user_file_chunks(
-        page_size: int, error_handler: ErrorHandler, position: int, participant: Participant
-):
-    """
-    Run through the files to process, pull their data, put it into s3 bins. Run the file through
-    the appropriate logic path based on file type.
-
-    If a file is empty put its ftp object to the empty_files_list, we can't delete objects
-    in-place while iterating over the db.
-
-    All files except for the audio recording files are in the form of CSVs, most of those files
-    can be separated by "time bin" (separated into one-hour chunks) and concatenated and sorted
-    trivially. A few files, call log, identifier file, and wifi log, require some triage
-    beforehand.  The debug log cannot be correctly sorted by time for all elements, because it
-    was not actually expected to be used by researchers, but is apparently quite useful.
+class ProcessingPage:
+    """ The binified data of a group of files that is merged into chunks and uploaded together. """
+    
+    def __init__(self):
+        # Declare a defaultdict of a pair of lists (rows, ftps), the rows may be replaced by a ColumnarBin
+        self.all_binified_data = defaultdict(lambda: [[], []])
+        self.ftps_to_remove = set()
+        self.survey_id_dict = {}
+        # changes in ChunkRegistry file sizes, keyed by (time_bin, data_type), for the data quantity stats
+        self.file_size_deltas = defaultdict(int)
+        self.file_count = 0
+        # the estimated size of the page's files, which is held in the pipeline's byte budget
+        # until the page has been uploaded.
+        self.byte_count = 0
 
-    Any errors are themselves concatenated using the passed in error handler.
 
-    In a single call to this function, page_size files will be processed,at the position specified.
-    This is expected to exclude files that have previously errored in file processing.
-    (some conflicts can be most easily resolved by just delaying a file until the next processing
-    period, and it solves )
+class FileProcessingPipeline:
     """
-    # Declare a defaultdict of a tuple of 2 lists
-    all_binified_data = defaultdict(lambda: ([], []))
-    ftps_to_remove = set()
-    # The ThreadPool enables downloading multiple files simultaneously from the network, and continuing
-    # to download files as other files are being processed, making the code as a whole run faster.
-    # In principle we could make a global pool that is free-memory aware.
-    pool = ThreadPool(CONCURRENT_NETWORK_OPS)
-    survey_id_dict = {}
-    
-    # A Django query with a slice (e.g. .all()[x:y]) makes a LIMIT query, so it
-    # only gets from the database those FTPs that are in the slice.
-    # print(participant.as_unpacked_native_python())
-    print(len(participant.files_to_process.exclude(deleted=True).all()))
-    print(page_size)
-    print(position)
-    
-    # TODO: investigate, comment.  ordering by path results in files grouped by type and
-    # chronological order, which is perfect for download efficiency... right? would it break anthing?
-    files_to_process = participant.files_to_process \
-        .exclude(deleted=True)  #.order_by("s3_file_path", "created_on")
-    
-    # This pool pulls in data for each FileForProcessing on a background thread and instantiates it.
-    # Instantiating a FileForProcessing object queries S3 for the File's data. (network request))
-    files_for_processing = pool.map(
-        FileForProcessing, files_to_process[position: position + page_size], chunksize=1
-    )
+    Processes files as a pipeline of stages that run at the same time:
+        1) Download: FileForProcessing objects are instantiated on the download pool, this
+           retrieves (and decrypts) the file from S3.  Up to FILE_PROCESS_QUEUE_DEPTH files are
+           downloaded ahead of the parsing stage.
+        2) Parse: files are parsed and binified on the calling thread into the current page.  A
+           page is complete when its files reach half of FILE_PROCESS_MEMORY_BUDGET bytes, or it
+           contains FILE_PROCESS_PAGE_SIZE files.
+        3) Merge and upload: a complete page is merged into existing chunks and uploaded on the
+           upload pool, and its ChunkRegistries and FileToProcess objects are updated, while the
+           next page is downloaded and parsed.  Up to FILE_PROCESS_MERGE_QUEUE_DEPTH complete pages
+           are queued for this stage, and up to FILE_PROCESS_UPLOAD_QUEUE_DEPTH merged chunks are
+           queued for upload.
+    
+    Files are only admitted into the download stage when their size (from UploadTracking, or from
+    S3) fits into FILE_PROCESS_MEMORY_BUDGET; bytes stay in flight until their page has been
+    uploaded.  Files larger than half the budget are processed alone, as their own page, once
+    everything else has finished.
+    
+    Pages are merged and uploaded one at a time, in order, so two pages never update the same chunk
+    at the same time.  The pools are created once and reused for every page and participant; call
+    close() when done.
+    """
+    
+    def __init__(self, error_handler: ErrorHandler):
+        self.error_handler = error_handler
+        self.download_pool = ThreadPool(CONCURRENT_NETWORK_OPS)
+        self.upload_pool = ThreadPool(CONCURRENT_NETWORK_OPS)
+        # a single thread runs the merge and upload stage, one page at a time, in order.
+        self.page_pool = ThreadPool(1)
+        self.byte_budget = ByteBudget(FILE_PROCESS_MEMORY_BUDGET)
+        self.page_budget = FILE_PROCESS_MEMORY_BUDGET // 2
+        # pages that have been submitted to the merge and upload stage, oldest first.
+        self.pending_pages: Deque[AsyncResult] = deque()
+        self.oversized_file_count = 0
+        # (estimated size, download) of files that have been admitted and not yet parsed.
+        self.downloads: Deque[Tuple[int, AsyncResult]] = deque()
+    
+    @property
+    def in_flight_bytes(self) -> int:
+        """ The (estimated) bytes of file data currently admitted for processing. """
+        return self.byte_budget.in_flight
+    
+    def get_stats(self) -> dict:
+        """ The memory budget, the peak (estimated) bytes of file data in flight, and the number of
+        oversized files that were processed alone, over the life of this pipeline. """
+        return {
+            "memory_budget": self.byte_budget.budget,
+            "peak_in_flight_bytes": self.byte_budget.peak,
+            "oversized_files": self.oversized_file_count,
+        }
+    
+    def close(self):
+        self.wait_for_pending_pages()
+        for pool in (self.download_pool, self.upload_pool, self.page_pool):
+            pool.close()
+            pool.terminate()
     
-    for file_for_processing in files_for_processing:
-        with error_handler:
+    def process_participant(self, participant: Participant, time_limit: timedelta = None):
+        """
+        Run through the participant's files to process, pull their data, put it into s3 bins. Run
+        the file through the appropriate logic path based on file type.
+        
+        All files except for the audio recording files are in the form of CSVs, most of those files
+        can be separated by "time bin" (separated into one-hour chunks) and concatenated and sorted
+        trivially. A few files, call log, identifier file, and wifi log, require some triage
+        beforehand.  The debug log cannot be correctly sorted by time for all elements, because it
+        was not actually expected to be used by researchers, but is apparently quite useful.
+        
+        Any errors are themselves concatenated using the error handler.  Files that fail are left in
+        place and are retried on the next run.  When a time_limit is given no new files are started
+        after it has passed, the remaining files are processed on the next run.
+        """
+        deadline = datetime.now() + time_limit if time_limit is not None else None
+        print("%s processing %s, %s files remaining" % (
+            datetime.now(), participant.patient_id,
+            participant.files_to_process.exclude(deleted=True).count()
+        ))
+        
+        page = ProcessingPage()
+        for file_to_process, file_size in self.iterate_files_to_process(participant):
+            if deadline is not None and datetime.now() > deadline:
+                print("%s time limit reached for %s" % (datetime.now(), participant.patient_id))
+                break
+            
+            if file_size > self.page_budget:
+                # case: an oversized file. Finish everything in progress, then process it alone.
+                page = self.flush(participant, page)
+                self.wait_for_pending_pages()
+                self.oversized_file_count += 1
+                print("%s processing oversized file %s, %s bytes" % (
+                    datetime.now(), file_to_process.s3_file_path, file_size
+                ))
+                self.admit(file_to_process, file_size)
+                page = self.flush(participant, page)
+                self.wait_for_pending_pages()
+                continue
+            
+            # wait until the file fits in the byte budget, doing whatever work frees up memory.
+            while not self.byte_budget.try_acquire(file_size):
+                if self.downloads:
+                    page = self.parse_next_download(participant, page)
+                elif self.pending_pages:
+                    self.wait_for_pending_pages(len(self.pending_pages) - 1)
+                else:
+                    page = self.submit_page(participant, page)
+            self.admit(file_to_process, file_size, acquired=True)
+            
+            if len(self.downloads) >= FILE_PROCESS_QUEUE_DEPTH:
+                page = self.parse_next_download(participant, page)
+        
+        self.flush(participant, page)
+        self.wait_for_pending_pages()
+    
+    def admit(self, file_to_process: FileToProcess, file_size: int, acquired: bool = False):
+        """ Starts downloading a file, its size is held in the byte budget until it is uploaded. """
+        if not acquired:
+            self.byte_budget.try_acquire(file_size)
+        self.downloads.append(
+            (file_size, self.download_pool.apply_async(FileForProcessing, (file_to_process,)))
+        )
+    
+    def parse_next_download(self, participant: Participant, page: ProcessingPage) -> ProcessingPage:
+        """ Parses the oldest download into the page, submits the page for upload if it is full.
+        Returns the current page. """
+        file_size, download = self.downloads.popleft()
+        page.byte_count += file_size
+        with self.error_handler:
+            file_for_processing = download.get()
+            page.file_count += 1
             process_one_file(
-                file_for_processing, survey_id_dict, all_binified_data, ftps_to_remove
+                file_for_processing, page.survey_id_dict, page.all_binified_data, page.ftps_to_remove,
+                page.file_size_deltas
             )
-    pool.close()
-    pool.terminate()
+        
+        if page.byte_count >= self.page_budget or page.file_count >= FILE_PROCESS_PAGE_SIZE:
+            return self.submit_page(participant, page)
+        return page
     
-    # there are several failure modes and success modes, information for what to do with different
-    # files percolates back to here.  Delete various database objects accordingly.
-    more_ftps_to_remove, number_bad_files, earliest_time_bin, latest_time_bin = upload_binified_data(
-        all_binified_data, error_handler, survey_id_dict
-    )
-    ftps_to_remove.update(more_ftps_to_remove)
+    def flush(self, participant: Participant, page: ProcessingPage) -> ProcessingPage:
+        """ Parses all admitted downloads and submits the final page.  Returns a new page. """
+        while self.downloads:
+            page = self.parse_next_download(participant, page)
+        return self.submit_page(participant, page)
+    
+    def iterate_files_to_process(self, participant: Participant) -> Generator[Tuple[FileToProcess, int], None, None]:
+        """ Yields the participant's files to process in order of creation, with their estimated
+        size, querying the database a page at a time.  Files uploaded while processing is underway
+        are picked up at the end. """
+        last_pk = 0
+        while True:
+            files_to_process = list(
+                participant.files_to_process.exclude(deleted=True).filter(pk__gt=last_pk)
+                .order_by("pk").select_related("study")[:FILE_PROCESS_PAGE_SIZE]
+            )
+            if not files_to_process:
+                return
+            file_sizes = self.get_file_sizes(participant, files_to_process)
+            for file_to_process in files_to_process:
+                yield file_to_process, file_sizes[file_to_process.pk]
+            last_pk = files_to_process[-1].pk
     
-    # Update the data quantity stats, if it actually processed any files
-    if len(files_to_process) > 0:
-        calculate_data_quantity_stats(participant,
-                                      earliest_time_bin_number=earliest_time_bin,
-                                      latest_time_bin_number=latest_time_bin)
+    def get_file_sizes(self, participant: Participant, files_to_process: List[FileToProcess]) -> Dict[int, int]:
+        """ Returns the sizes of files, by FileToProcess pk.  Sizes are from UploadTracking where
+        available (its paths don't have the study object id prefix), otherwise from S3. """
+        pks_by_path = {
+            file_to_process.s3_file_path.split("/", 1)[-1]: file_to_process.pk
+            for file_to_process in files_to_process
+        }
+        file_sizes = {
+            pks_by_path[file_path]: file_size for file_path, file_size in
+            UploadTracking.objects.filter(participant=participant, file_path__in=pks_by_path)
+                .values_list("file_path", "file_size")
+        }
+        missing = [ftp for ftp in files_to_process if ftp.pk not in file_sizes]
+        for file_to_process, file_size in zip(missing, self.download_pool.map(get_s3_file_size, missing)):
+            file_sizes[file_to_process.pk] = file_size
+        return file_sizes
+    
+    def submit_page(self, participant: Participant, page: ProcessingPage) -> ProcessingPage:
+        """ Submits a page to the merge and upload stage, returns a new page. """
+        # wait for room in the merge and upload queue, the page pool keeps pages in order.
+        self.wait_for_pending_pages(FILE_PROCESS_MERGE_QUEUE_DEPTH - 1)
+        if page.file_count:
+            print("%s uploading %s files, %s bytes in flight" % (
+                datetime.now(), page.file_count, self.in_flight_bytes
+            ))
+            self.pending_pages.append(
+                self.page_pool.apply_async(self.upload_page, (participant, page))
+            )
+        else:
+            self.byte_budget.release(page.byte_count)
+        return ProcessingPage()
     
-    # Actually delete the processed FTPs from the database
-    FileToProcess.objects.filter(pk__in=ftps_to_remove).delete()
-    return number_bad_files
+    def wait_for_pending_pages(self, keep: int = 0):
+        """ Waits for the oldest pending pages until at most keep pages are still pending. """
+        while len(self.pending_pages) > max(keep, 0):
+            pending_page = self.pending_pages.popleft()
+            with self.error_handler:
+                pending_page.get()
+    
+    def upload_page(self, participant: Participant, page: ProcessingPage):
+        """ The merge and upload stage, runs on the page pool. """
+        try:
+            self._upload_page(participant, page)
+        finally:
+            self.byte_budget.release(page.byte_count)
+    
+    def _upload_page(self, participant: Participant, page: ProcessingPage):
+        # there are several failure modes and success modes, information for what to do with different
+        # files percolates back to here.  Delete various database objects accordingly.
+        try:
+            more_ftps_to_remove, _, _, _ = upload_binified_data(
+                page.all_binified_data, self.error_handler, page.survey_id_dict, self.upload_pool,
+                page.file_size_deltas
+            )
+        finally:
+            # Update the data quantity stats with the changes to file sizes.  This must happen even
+            # if an upload failed: the deltas of the chunks that were registered (and of unchunkable
+            # files, registered during parsing) would be 0 when the page's files are retried.
+            update_data_quantity_stats(participant, page.file_size_deltas)
+        page.ftps_to_remove.update(more_ftps_to_remove)
+        
+        # Actually delete the processed FTPs from the database
+        FileToProcess.objects.filter(pk__in=page.ftps_to_remove).delete()
+
+
+def get_s3_file_size(file_to_process: FileToProcess) -> int:
+    """ The size of a file to process on S3, 0 if it can't be determined (the download will fail
+    and report the error). """
+    try:
+        return s3_get_size(file_to_process.s3_file_path)
+    except Exception:
+        return 0
 
 
 def process_one_file(
         file_for_processing: FileForProcessing, survey_id_dict: dict, all_binified_data: DefaultDict,
-        ftps_to_remove: set
+        ftps_to_remove: set, file_size_deltas: DefaultDict
 ):
     """ This function is the inner loop of the chunking process. """
     
@@ -177,7 +343,7 @@ def process_one_file(
     if file_for_processing.chunkable:
         process_chunkable_file(file_for_processing, survey_id_dict, all_binified_data, ftps_to_remove)
     else:
-        process_unchunkable_file(file_for_processing, ftps_to_remove)
+        process_unchunkable_file(file_for_processing, ftps_to_remove, file_size_deltas)
 
 
 def process_chunkable_file(
@@ -199,11 +365,15 @@ def process_chunkable_file(
         ftps_to_remove.add(file_for_processing.file_to_process.id)
 
 
-def process_unchunkable_file(file_for_processing: FileForProcessing, ftps_to_remove: set):
+def process_unchunkable_file(
+    file_for_processing: FileForProcessing, ftps_to_remove: set, file_size_deltas: DefaultDict
+):
     # case: unchunkable data file
     timestamp = clean_java_timecode(
         file_for_processing.file_to_process.s3_file_path.rsplit("/", 1)[-1][:-4]
     )
+    # the time bin of the ChunkRegistry, for the data quantity stats
+    time_bin = timezone.make_aware(datetime.utcfromtimestamp(timestamp), timezone.utc)
     # Since we aren't binning the data by hour, just create a ChunkRegistry that
     # points to the already existing S3 file.
     try:
@@ -215,6 +385,7 @@ def process_unchunkable_file(file_for_processing: FileForProcessing, ftps_to_rem
             file_for_processing.file_to_process.participant.pk,
             file_for_processing.file_contents,
         )
+        file_size_deltas[(time_bin, file_for_processing.data_type)] += len(file_for_processing.file_contents)
         ftps_to_remove.add(file_for_processing.file_to_process.id)
     except ValidationError as ve:
         if len(ve.messages) != 1:
@@ -225,44 +396,49 @@ def process_unchunkable_file(file_for_processing: FileForProcessing, ftps_to_rem
         # we detect this specific case and update the registry with the new file size
         # (hopefully it doesn't actually change)
         if 'Chunk registry with this Chunk path already exists.' in ve.messages:
-            ChunkRegistry.update_registered_unchunked_data(
-                file_for_processing.data_type,
-                file_for_processing.file_to_process.s3_file_path,
-                file_for_processing.file_contents,
-            )
+            file_size_deltas[(time_bin, file_for_processing.data_type)] += \
+                ChunkRegistry.update_registered_unchunked_data(
+                    file_for_processing.data_type,
+                    file_for_processing.file_to_process.s3_file_path,
+                    file_for_processing.file_contents,
+                )
             ftps_to_remove.add(file_for_processing.file_to_process.id)
         else:
             # any other errors, add
             raise
 
 
-
-
-def upload_binified_data(binified_data, error_handler, survey_id_dict):
+def upload_binified_data(
+    binified_data, error_handler, survey_id_dict, pool: ThreadPool, file_size_deltas: DefaultDict
+):
     """ Takes in binified csv data and handles uploading/downloading+updating
         older data to/from S3 for each chunk.
-        Returns a set of concatenations that have succeeded and can be removed.
-        Returns the number of failed FTPS so that we don't retry them.
-        Returns the earliest and latest time bins handled
-        Raises any errors on the passed in ErrorHandler."""
-    # failed_ftps = set([])
-    # ftps_to_retire = set([])
-    # upload_these = []
-    
-    # # Track the earliest and latest time bins, to return them at the end of the function
-    # earliest_time_bin = None
-    # latest_time_bin = None
-    uploads = PrepareDataForeUpload(binified_data, error_handler, survey_id_dict)
-    
-    pool = ThreadPool(CONCURRENT_NETWORK_OPS)
-    errors = pool.map(batch_upload, uploads.upload_these, chunksize=1)
-    for err_ret in errors:
+        Registers every uploaded chunk in bulk, and adds the change in file size of every chunk
+        that was registered to file_size_deltas.
+        Raises any upload or registration error.
+        Returns the result of PrepareDataForeUpload.get_retirees, the first element is the set of
+        FTP pks that have succeeded and can be removed. """
+    uploads = PrepareDataForeUpload(binified_data, error_handler, survey_id_dict, pool)
+    results = uploads.wait_for_uploads()
+    
+    # register everything that was uploaded successfully in one transaction, record the changes in
+    # file size of everything that was registered, then raise any error.
+    failed_registrations = ChunkRegistry.bulk_register_chunked_data(
+        new_chunks=[ret['chunk'] for ret in results if ret['chunk'] and ret['chunk'].pk is None],
+        updated_chunks=[ret['chunk'] for ret in results if ret['chunk'] and ret['chunk'].pk is not None],
+    )
+    unregistered_chunks = {id(chunk) for chunk, _ in failed_registrations}
+    for ret in results:
+        if ret['chunk'] and id(ret['chunk']) not in unregistered_chunks:
+            file_size_deltas[(ret['chunk'].time_bin, ret['chunk'].data_type)] += ret['file_size_delta']
+    for err_ret in results:
         if err_ret['exception']:
             print(err_ret['traceback'])
             raise err_ret['exception']
+    for chunk, exception in failed_registrations:
+        print("FAILED TO REGISTER: %s" % chunk.chunk_path)
+        raise exception
     
-    pool.close()
-    pool.terminate()
     # The things in ftps to retire that are not in failed ftps.
     # len(failed_ftps) will become the number of files to skip in the next iteration.
     return uploads.get_retirees()
@@ -294,8 +470,9 @@ def append_binified_csvs(old_binified_rows: DefaultDict[tuple, list],
     """ Appends binified rows to an existing binified row data structure.
         Should be in-place. """
     for data_bin, rows in new_binified_rows.items():
-        old_binified_rows[data_bin][0].extend(rows)  # Add data rows
-        old_binified_rows[data_bin][1].append(file_for_processing.pk)  # Add ftp
+        binned_rows_and_ftps = old_binified_rows[data_bin]
+        binned_rows_and_ftps[0] = merge_binned_rows(binned_rows_and_ftps[0], rows)  # Add data rows
+        binned_rows_and_ftps[1].append(file_for_processing.pk)  # Add ftp
 
 
 # TODO: stick on FileForProcessing
@@ -304,6 +481,12 @@ def process_csv_data(file_for_processing: FileForProcessing):
         catches csv files with known problems and runs the correct logic.
         Returns None If the csv has no data in it. """
     
+    if COLUMNAR_FILE_PROCESSING and COLUMNAR_ENGINE_AVAILABLE and columnar_engine_applies(file_for_processing):
+        columnar_ret = process_csv_data_columnar(file_for_processing)
+        # None means the columnar engine declined the file, continue on the row-by-row code.
+        if columnar_ret is not None:
+            return columnar_ret
+    
     if file_for_processing.file_to_process.participant.os_type == Participant.ANDROID_API:
         # Do fixes for Android
         if file_for_processing.data_type == ANDROID_LOG_FILE:
@@ -359,3 +542,36 @@ def process_csv_data(file_for_processing: FileForProcessing):
         )
     else:
         return None, None
+
+
+"""############################ Columnar CSVs ###############################"""
+
+def columnar_engine_applies(file_for_processing: FileForProcessing) -> bool:
+    """ The columnar engine only handles files that need no data fixes (see process_csv_data). """
+    if file_for_processing.data_type in (IDENTIFIERS, SURVEY_TIMINGS):
+        return False
+    if file_for_processing.file_to_process.participant.os_type == Participant.ANDROID_API:
+        return file_for_processing.data_type not in (ANDROID_LOG_FILE, CALL_LOG, WIFI)
+    return True
+
+
+def process_csv_data_columnar(file_for_processing: FileForProcessing):
+    """ Columnar version of process_csv_data, returns the same values.  Returns None (instead of
+    a tuple) if the columnar engine could not handle the file. """
+    file_contents = file_for_processing.file_contents
+    header = file_contents[:file_contents.find(b"\n")] if b"\n" in file_contents else file_contents
+    header = b",".join([column_name.strip() for column_name in header.split(b",")])
+    
+    study_object_id = file_for_processing.file_to_process.study.object_id
+    patient_id = file_for_processing.file_to_process.participant.patient_id
+    binified_data = binify_csv_columnar(
+        file_contents, study_object_id, patient_id, file_for_processing.data_type, header
+    )
+    if binified_data is None:
+        return None
+    
+    # the ColumnarBins reference the file contents, we just don't need this reference.
+    file_for_processing.clear_file_content()
+    if not binified_data:
+        return None, None
+    return binified_data, (study_object_id, patient_id, file_for_processing.data_type, header)
@@ -1,30 +1,50 @@
-from typing import Dict, List, Set, Tuple
+import sys
+from collections import deque
+from multiprocessing.pool import AsyncResult, ThreadPool
+from operator import itemgetter
+from typing import Deque, Dict, List, Set, Tuple
 
 from botocore.exceptions import ReadTimeoutError
 from cronutils import ErrorHandler
+
+from config.settings import FILE_PROCESS_UPLOAD_QUEUE_DEPTH
 from constants.data_processing_constants import CHUNK_TIMESLICE_QUANTUM, CHUNKS_FOLDER
 
 from constants.data_stream_constants import SURVEY_DATA_FILES
-from database.data_access_models import ChunkRegistry
+from database.data_access_models import ChunkRegistry, ChunkTimeRange
 from database.study_models import Study
 from database.survey_models import Survey
 from database.user_models import Participant
+from libs.file_processing.batched_network_operations import batch_upload
+from libs.file_processing.columnar_binning import ColumnarBin
 from libs.file_processing.exceptions import ChunkFailedToExist, HeaderMismatchException
-from libs.file_processing.utility_functions_csvs import construct_csv_string, csv_to_list, unix_time_to_string
-from libs.file_processing.utility_functions_simple import (compress,
-    convert_unix_to_human_readable_timestamps, ensure_sorted_by_timestamp)
+from libs.file_processing.utility_functions_csvs import (append_to_sorted_csv,
+    construct_csv_string, construct_csv_string_from_lines, csv_to_list, merge_into_sorted_csv,
+    unix_time_to_string)
+from libs.file_processing.utility_functions_simple import (convert_unix_to_human_readable_timestamps,
+    ensure_sorted_by_timestamp)
 from libs.s3 import s3_retrieve
 
 
+# the number of chunk paths in each ChunkRegistry lookup query
+CHUNK_PATH_QUERY_BATCH_SIZE = 500
+
+
 class PrepareDataForeUpload:
     """ This class is consumes binified data and  """
     
-    def __init__(self, binified_data: Dict, error_handler: ErrorHandler, survey_id_dict: Dict):
+    def __init__(
+        self, binified_data: Dict, error_handler: ErrorHandler, survey_id_dict: Dict,
+        upload_pool: ThreadPool
+    ):
         self.failed_ftps = set()
         self.ftps_to_retire = set()
         
-        self.upload_these: List[Tuple[ChunkRegistry, str, bytes, str]] = []
-        # chunk, something?, file contents, study object id
+        # Finished chunks are handed straight to batch_upload on the upload pool; at most
+        # FILE_PROCESS_UPLOAD_QUEUE_DEPTH are in the queue (and in memory) at once.
+        self.upload_pool = upload_pool
+        self.uploads: Deque[AsyncResult] = deque()
+        self.upload_results: List[dict] = []
         
         # Track the earliest and latest time bins, to return them at the end of the function
         self.earliest_time_bin: int = None
@@ -33,8 +53,43 @@ class PrepareDataForeUpload:
         self.binified_data = binified_data
         self.error_handler = error_handler
         self.survey_id_dict = survey_id_dict
+        # pks of studies, participants and surveys, keyed by (model, identifier)
+        self.pk_cache: Dict[Tuple[type, str], int] = {}
+        # ChunkRegistries of the chunks in this page that already exist, keyed by chunk path
+        self.existing_chunks: Dict[str, ChunkRegistry] = {}
         self.iterate()
     
+    def resolve_pk(self, model: type, field_name: str, value: str) -> int:
+        """ Looks up the pk of a Study, Participant or Survey, once per page. """
+        key = (model, value)
+        if key not in self.pk_cache:
+            self.pk_cache[key] = model.objects.filter(**{field_name: value}).values_list("pk", flat=True).get()
+        return self.pk_cache[key]
+    
+    def queue_upload(self, chunk: ChunkRegistry or dict, chunk_path: str, new_contents: bytes, study_object_id: str):
+        """ Starts uploading a finished chunk, waits for the oldest upload if the queue is full. """
+        self.uploads.append(self.upload_pool.apply_async(
+            batch_upload, ((chunk, chunk_path, new_contents, study_object_id),)
+        ))
+        while len(self.uploads) > FILE_PROCESS_UPLOAD_QUEUE_DEPTH:
+            self.collect_upload(self.uploads.popleft())
+    
+    def wait_for_uploads(self) -> List[dict]:
+        """ Waits for all uploads to finish, returns the results of batch_upload. """
+        while self.uploads:
+            self.collect_upload(self.uploads.popleft())
+        return self.upload_results
+    
+    def collect_upload(self, upload: AsyncResult):
+        try:
+            self.upload_results.append(upload.get())
+        except Exception as e:
+            # batch_upload re-raises errors when its error sentry doesn't report them (e.g. in a
+            # shell), the other uploads must still be collected and registered.
+            self.upload_results.append(
+                {'exception': e, 'traceback': sys.exc_info(), 'chunk': None, 'file_size_delta': 0}
+            )
+    
     def get_retirees(self) -> Tuple[Set[int], int, int, int]:
         """ returns the ftp pks that have succeeded, the number of ftps that have failed, 
         and the earliest and the latest time bins """
@@ -42,10 +97,24 @@ class PrepareDataForeUpload:
             len(self.failed_ftps), self.earliest_time_bin, self.latest_time_bin
     
     def iterate(self):
+        self.existing_chunks = self.get_existing_chunks()
         for data_bin, (data_rows_list, ftp_list) in self.binified_data.items():
             with self.error_handler:
                 self.inner_iterate(data_bin, data_rows_list, ftp_list)
     
+    def get_existing_chunks(self) -> Dict[str, ChunkRegistry]:
+        """ Fetches the ChunkRegistries of every chunk in the page at once, keyed by chunk path. """
+        chunk_paths = list({
+            construct_s3_chunk_path(study_object_id, user_id, data_type, time_bin)
+            for study_object_id, user_id, data_type, time_bin, _ in self.binified_data
+        })
+        existing_chunks = {}
+        # batched to stay well under database query parameter limits
+        for i in range(0, len(chunk_paths), CHUNK_PATH_QUERY_BATCH_SIZE):
+            query = ChunkRegistry.objects.filter(chunk_path__in=chunk_paths[i:i + CHUNK_PATH_QUERY_BATCH_SIZE])
+            existing_chunks.update((chunk.chunk_path, chunk) for chunk in query)
+        return existing_chunks
+    
     def inner_iterate(self, data_bin, data_rows_list, ftp_list):
         """  """
         try:
@@ -56,15 +125,22 @@ class PrepareDataForeUpload:
             if self.latest_time_bin is None or time_bin > self.latest_time_bin:
                 self.latest_time_bin = time_bin
             
-            # data_rows_list may be a generator; here it is evaluated
-            updated_header = convert_unix_to_human_readable_timestamps(
-                original_header, data_rows_list
-            )
+            # data_rows_list may be a generator; here it is evaluated into (timestamp, line) tuples.
+            # ColumnarBins insert the UTC time column when they construct their lines, only the
+            # header is updated here.
+            if isinstance(data_rows_list, ColumnarBin):
+                updated_header, _ = convert_unix_to_human_readable_timestamps(original_header, [])
+            else:
+                updated_header, data_rows_list = convert_unix_to_human_readable_timestamps(
+                    original_header, data_rows_list
+                )
             chunk_path = construct_s3_chunk_path(study_object_id, user_id, data_type, time_bin)
             
             # two core cases
-            if ChunkRegistry.objects.filter(chunk_path=chunk_path).exists():
-                self.chunk_exists_case(chunk_path, study_object_id, updated_header, data_rows_list)
+            if chunk_path in self.existing_chunks:
+                self.chunk_exists_case(
+                    self.existing_chunks[chunk_path], study_object_id, updated_header, data_rows_list
+                )
             else:
                 self.chunk_not_exists_case(
                     chunk_path, study_object_id, updated_header, user_id, data_type,
@@ -92,32 +168,32 @@ class PrepareDataForeUpload:
         self, chunk_path: str, study_object_id: str, updated_header: str, user_id: str,
         data_type: str, original_header: bytes, time_bin: int, rows
     ):
-        ensure_sorted_by_timestamp(rows)
-        new_contents = construct_csv_string(updated_header, rows)
+        if isinstance(rows, ColumnarBin):
+            new_contents = rows.construct_csv_string(updated_header)
+        else:
+            rows.sort(key=itemgetter(0))
+            new_contents = construct_csv_string_from_lines(updated_header, [line for _, line in rows])
         if data_type in SURVEY_DATA_FILES:
             # We need to keep a mapping of files to survey ids, that is handled here.
             survey_id_hash = study_object_id, user_id, data_type, original_header
-            survey_id = Survey.objects.filter(object_id=self.survey_id_dict[survey_id_hash]
-                                             ).values_list("pk", flat=True).get()
+            survey_id = self.resolve_pk(Survey, "object_id", self.survey_id_dict[survey_id_hash])
         else:
             survey_id = None
         
-        # this object will eventually get **kwarg'd into ChunkRegistry.register_chunked_data
+        # this object will eventually get **kwarg'd into ChunkRegistry.build_chunked_data
         chunk_params = {
-            "study_id": Study.objects.filter(object_id=study_object_id).values_list("pk", flat=True).get(),
-            "participant_id": Participant.objects.filter(patient_id=user_id).values_list("pk", flat=True).get(),
+            "study_id": self.resolve_pk(Study, "object_id", study_object_id),
+            "participant_id": self.resolve_pk(Participant, "patient_id", user_id),
             "data_type": data_type,
             "chunk_path": chunk_path,
             "time_bin": time_bin,
             "survey_id": survey_id
         }
         
-        self.upload_these.append(
-            (chunk_params, chunk_path, compress(new_contents), study_object_id)
-        )
+        self.queue_upload(chunk_params, chunk_path, new_contents, study_object_id)
     
-    def chunk_exists_case(self, chunk_path: str, study_object_id: str, updated_header: str, rows):
-        chunk = ChunkRegistry.objects.get(chunk_path=chunk_path)
+    def chunk_exists_case(self, chunk: ChunkRegistry, study_object_id: str, updated_header: str, rows):
+        chunk_path = chunk.chunk_path
         
         try:
             s3_file_data = s3_retrieve(chunk_path, study_object_id, raw_path=True)
@@ -129,14 +205,16 @@ class PrepareDataForeUpload:
                 # Encountered this condition 11pm feb 7 2016, cause unknown, there was
                 # no python stacktrace.  Best guess is mongo blew up.
                 # If this happened, delete the ChunkRegistry and push this file upload to the next cycle
-                chunk.remove()  # this line of code is ancient and almost definitely wrong.
+                # deleting the chunk can shrink the participant's chunk time ranges.
+                chunk.delete()
+                ChunkTimeRange.recalculate_participant(chunk.participant)
                 raise ChunkFailedToExist(
                     "chunk %s does not actually point to a file, deleting DB entry, should run correctly on next index."
                     % chunk_path
                 )
             raise  # Raise original error if not 404 s3 error
         
-        old_header, old_rows = csv_to_list(s3_file_data)
+        old_header = s3_file_data.split(b"\n", 1)[0]
         
         if old_header != updated_header:
             # To handle the case where a file was on an hour boundary and placed in
@@ -148,12 +226,33 @@ class PrepareDataForeUpload:
                 '%s\nvs.\n%s\nin\n%s' % (old_header, updated_header, chunk_path)
             )
         
-        old_rows = list(old_rows)
-        old_rows.extend(rows)
-        ensure_sorted_by_timestamp(old_rows)
-        new_contents = construct_csv_string(updated_header, old_rows)
+        # The existing chunk is already sorted, merge the new data into it as sorted runs.  If all
+        # the new data comes after the chunk's last line we can simply append.
+        new_runs = sorted_runs(rows)
+        new_contents = append_to_sorted_csv(s3_file_data, new_runs)
+        if new_contents is None:
+            new_contents = merge_into_sorted_csv(s3_file_data, new_runs)
+        if new_contents is None:
+            # case: the existing chunk was somehow not sorted, resort everything.
+            old_rows = list(csv_to_list(s3_file_data)[1])
+            for run in new_runs:
+                old_rows.extend(line.split(b",") for _, line in run)
+            ensure_sorted_by_timestamp(old_rows)
+            new_contents = construct_csv_string(updated_header, old_rows)
         
-        self.upload_these.append((chunk, chunk_path, compress(new_contents), study_object_id))
+        if new_contents == s3_file_data:
+            # case: every new row is already in the chunk (e.g. a file was uploaded twice), there is
+            # nothing to upload and the ChunkRegistry does not change.
+            return
+        self.queue_upload(chunk, chunk_path, new_contents, study_object_id)
+
+
+def sorted_runs(rows: List[Tuple[int, bytes]] or ColumnarBin) -> List[List[Tuple[int, bytes]]]:
+    """ Converts new rows into sorted runs of (timestamp, line) for merge_into_sorted_csv. """
+    if isinstance(rows, ColumnarBin):
+        return rows.sorted_runs()
+    rows.sort(key=itemgetter(0))
+    return [rows]
 
 
 def construct_s3_chunk_path(
@@ -1,5 +1,7 @@
 from datetime import datetime
-from typing import Generator, List, Tuple
+from heapq import merge
+from operator import itemgetter
+from typing import Generator, List, Optional, Tuple
 
 from constants.datetime_constants import API_TIME_FORMAT
 from libs.file_processing.exceptions import BadTimecodeError
@@ -50,6 +52,13 @@ def isplit(source: bytes) -> Generator[bytes, None, None]:
 
 def construct_csv_string(header: bytes, rows_list: List[bytes]) -> bytes:
     """ Takes a header list and a bytes-list and returns a single string of a csv. Very performant."""
+    # this comprehension is always fastest, there is no advantage to inlining the creation of rows
+    return construct_csv_string_from_lines(header, [b",".join(row_items) for row_items in rows_list])
+
+
+def construct_csv_string_from_lines(header: bytes, lines: List[bytes]) -> bytes:
+    """ As construct_csv_string, but takes already-joined lines. Deduplicates the lines, retaining
+    the first instance of each. """
     
     def deduplicate(seq: List[bytes]):
         # highly optimized order preserving deduplication function.
@@ -59,15 +68,106 @@ def construct_csv_string(header: bytes, rows_list: List[bytes]) -> bytes:
         #  is very slightly faster on large counts.  tuple() *should* have lower memory overhead?
         return tuple(x for x in seq if not (x in seen or seen_add(x)))
     
-    # this comprehension is always fastest, there is no advantage to inlining the creation of rows
-    rows = [b",".join(row_items) for row_items in rows_list]
     # we need to ensure no duplicates
-    rows = deduplicate(rows)
-
+    rows = deduplicate(lines)
+    
     # the .join is at least 100x faster than a +=ing a ret string - I don't know how it made it
     # as long as it did as a += operation, I knew that was slow because of repeated calls to alloc.
     return header + b"\n" + b"\n".join(rows)
 
+
+def _merge_sorted_runs(runs: List[List[Tuple[int, bytes]]]) -> List[bytes]:
+    """ Merges sorted runs of (timestamp, line) into one list of lines, removing duplicates. """
+    # heapq.merge is stable across its inputs, lines of earlier runs come before lines of later runs
+    # with the same timestamp, just like a stable sort of the concatenated rows.  Identical lines
+    # always have identical timestamps, so deduplication only looks at lines with the same timestamp.
+    merged_lines = []
+    current_timestamp = None
+    seen = set()
+    for timestamp, line in merge(*runs, key=itemgetter(0)):
+        if timestamp != current_timestamp:
+            current_timestamp = timestamp
+            seen.clear()
+        if line in seen:
+            continue
+        seen.add(line)
+        merged_lines.append(line)
+    return merged_lines
+
+
+def first_column_int(line: bytes) -> int:
+    """ The integer value of the first column of a csv line, as in int(row[0]).  Raises a
+    ValueError if it is not an integer. """
+    comma = line.find(b",")
+    return int(line if comma == -1 else line[:comma])
+
+
+def merge_into_sorted_csv(existing_csv: bytes, new_runs: List[List[Tuple[int, bytes]]]) -> Optional[bytes]:
+    """ Merges new lines into an existing chunk csv, producing the same output as sorting all of the
+    rows with ensure_sorted_by_timestamp and calling construct_csv_string.
+    
+    The existing csv must be the output of that process: sorted by timestamp and deduplicated.
+    Each new run is a list of (timestamp, line) tuples sorted by timestamp, runs are merged in one
+    pass with duplicates removed during the merge.  Existing lines that come before all of the new
+    data are copied as a single slice, they are never split or parsed; almost all new data goes on
+    the end of a chunk, so the work done here grows with the new data, not the size of the chunk.
+    
+    Returns None if the existing csv turns out not to be sorted. """
+    new_runs = [run for run in new_runs if run]
+    header_end = existing_csv.find(b"\n")
+    if header_end == -1:
+        existing_csv += b"\n"
+        header_end = len(existing_csv) - 1
+    body_start = header_end + 1
+    
+    # Walk backwards from the end of the existing csv until we reach a line that sorts before all
+    # of the new data.  That line and everything before it is the untouched prefix.
+    earliest_new_timestamp = min(run[0][0] for run in new_runs) if new_runs else None
+    existing_tail = []
+    end = len(existing_csv)
+    prefix_end = body_start
+    while end >= body_start:
+        start = existing_csv.rfind(b"\n", header_end, end) + 1
+        line = existing_csv[start:end]
+        try:
+            timestamp = first_column_int(line)
+        except ValueError:
+            # ensure_sorted_by_timestamp drops lines like this (e.g. an empty last line).
+            end = start - 1
+            continue
+        
+        if earliest_new_timestamp is not None and timestamp < earliest_new_timestamp:
+            prefix_end = end
+            break
+        if existing_tail and timestamp > existing_tail[-1][0]:
+            return None  # not sorted, the caller needs to do a full sort.
+        existing_tail.append((timestamp, line))
+        end = start - 1
+    existing_tail.reverse()
+    
+    merged_lines = _merge_sorted_runs([existing_tail] + new_runs)
+    prefix = existing_csv[body_start:prefix_end]
+    merged = b"\n".join(merged_lines)
+    return existing_csv[:body_start] + b"\n".join(part for part in (prefix, merged) if part)
+
+
+def append_to_sorted_csv(existing_csv: bytes, new_runs: List[List[Tuple[int, bytes]]]) -> Optional[bytes]:
+    """ The fast path of merge_into_sorted_csv for new data that is entirely after the existing
+    data: the existing csv is not split or searched at all.  Returns None if the last line of the
+    existing csv is not strictly before the new data. """
+    new_runs = [run for run in new_runs if run]
+    if not new_runs:
+        return None
+    try:
+        last_existing_timestamp = first_column_int(existing_csv[existing_csv.rfind(b"\n") + 1:])
+    except ValueError:
+        return None
+    if existing_csv.find(b"\n") == -1 or last_existing_timestamp >= min(run[0][0] for run in new_runs):
+        return None
+    # none of the new lines can be a duplicate of an existing line, their timestamps all differ.
+    return existing_csv + b"\n" + b"\n".join(_merge_sorted_runs(new_runs))
+
+
 def clean_java_timecode(java_time_code_string: bytes or str) -> int:
     """ converts millisecond time (string) to an integer normal unix time. """
     try:
@@ -1,6 +1,4 @@
-from typing import List
-
-import zstd
+from typing import List, Tuple
 
 from constants.data_processing_constants import CHUNK_TIMESLICE_QUANTUM
 from constants.data_stream_constants import IDENTIFIERS, IOS_LOG_FILE, UPLOAD_FILE_TYPE_MAPPING
@@ -47,18 +45,36 @@ def ensure_sorted_by_timestamp(l: list):
         l.sort(key=lambda x: int(x[0]))
 
 
-def convert_unix_to_human_readable_timestamps(header: bytes, rows: list) -> List[bytes]:
-    """ Adds a new column to the end which is the unix time represented in
-    a human readable time format.  Returns an appropriately modified header. """
+# the ".mmm" suffix of every possible millisecond value, 0-padded.
+MILLISECOND_SUFFIXES = [b".%03d" % millisecond for millisecond in range(1000)]
+
+
+def convert_unix_to_human_readable_timestamps(
+    header: bytes, rows: list
+) -> Tuple[bytes, List[Tuple[int, bytes]]]:
+    """ Adds a new column after the timestamp which is the unix time represented in a human
+    readable time format.  Returns the modified header, and the timestamp and joined csv line of
+    each row, in the same order.  The rows are not modified. """
+    # Rows are sampled many times per second, formatting the date and time is by far the slowest
+    # part of this, so the formatted string of each second is cached.  (All rows in a chunk are from
+    # the same hour, this holds at most 3600 entries.)  The new column is added to the joined line,
+    # rows are never spliced.
+    second_strings = {}
+    lines = []
     for row in rows:
-        unix_millisecond = int(row[0])
-        time_string = unix_time_to_string(unix_millisecond // 1000)
-        # this line 0-pads millisecond values that have leading 0s.
-        time_string += b".%03d" % (unix_millisecond % 1000)
-        row.insert(1, time_string)
+        timestamp = int(row[0])
+        unix_second, millisecond = divmod(timestamp, 1000)
+        try:
+            second_string = second_strings[unix_second]
+        except KeyError:
+            second_string = second_strings[unix_second] = unix_time_to_string(unix_second)
+        utc_time = second_string + MILLISECOND_SUFFIXES[millisecond]
+        line = b",".join(row)
+        timestamp_end = len(row[0])
+        lines.append((timestamp, line[:timestamp_end] + b"," + utc_time + line[timestamp_end:]))
     header = header.split(b",")
     header.insert(1, b"UTC time")
-    return b",".join(header)
+    return b",".join(header), lines
 
 
 def binify_from_timecode(unix_ish_time_code_string: bytes) -> int:
@@ -71,14 +87,3 @@ def binify_from_timecode(unix_ish_time_code_string: bytes) -> int:
 def resolve_survey_id_from_file_name(name: str) -> str:
     return name.rsplit("/", 2)[1]
 
-
-def compress(data: bytes) -> bytes:
-    return zstd.compress(
-        data,
-        1,  # compression level (1 yields better compression on average across our data streams
-        0,  # auto-tune the number of threads based on cpu cores (no apparent drawbacks)
-    )
-
-
-def decompress(data: bytes) -> bytes:
-    return zstd.decompress(data)
@@ -0,0 +1,128 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+
+# Every upload from a device has to be decrypted with the participant's RSA private key (stored on
+# S3), which is used to decrypt the AES key line at the top of the file.  Devices reuse the same
+# encrypted AES key for many files, so both are cached in memory.  Entries are bounded in number,
+# the least recently used entries are dropped first.
+# (These caches are deliberately process-local, decrypted key material is never sent to a shared
+# cache server.)
+PRIVATE_KEY_CACHE_SIZE = 2000
+AES_KEY_CACHE_SIZE = 20000
+
+# Every file written to or read from S3 is encrypted with its study's encryption key, which is
+# cached so that it isn't queried from the database for every file.  Entries expire after this many
+# seconds, and are removed when a Study is saved.
+STUDY_ENCRYPTION_KEY_TTL = 300
+
+
+class LRUCache:
+    """ A thread-safe, size-bounded, least-recently-used cache.  Keys are tuples whose first element
+    is a patient_id, so that all entries for a participant can be removed. """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key: tuple):
+        """ Returns the cached value, or None. """
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: tuple, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def remove_participant(self, patient_id: str):
+        with self._lock:
+            for key in [key for key in self._data if key[0] == patient_id]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class TTLCache:
+    """ A thread-safe cache whose entries expire after ttl seconds. """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = {}
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        """ Returns the cached value, or None if it is absent or expired. """
+        with self._lock:
+            try:
+                expiration, value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            if monotonic() >= expiration:
+                del self._data[key]
+                self.misses += 1
+                return None
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (monotonic() + self.ttl, value)
+
+    def remove(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+# keys are (patient_id,), values are RSA key objects
+PRIVATE_KEY_CACHE = LRUCache(PRIVATE_KEY_CACHE_SIZE)
+# keys are (patient_id, sha256 of the encrypted key line), values are decrypted, validated AES keys
+AES_KEY_CACHE = LRUCache(AES_KEY_CACHE_SIZE)
+# keys are study object ids, values are encryption keys (bytes)
+STUDY_ENCRYPTION_KEY_CACHE = TTLCache(STUDY_ENCRYPTION_KEY_TTL)
+
+
+def clear_participant_key_caches(patient_id: str):
+    """ Drops all cached keys of a participant, call when their device or keys change. """
+    PRIVATE_KEY_CACHE.remove_participant(patient_id)
+    AES_KEY_CACHE.remove_participant(patient_id)
+
+
+def get_key_cache_stats() -> dict:
+    """ The hit and miss counts and size of each cache, for this process. """
+    return {
+        name: {"hits": cache.hits, "misses": cache.misses, "size": len(cache)}
+        for name, cache in (
+            ("private_keys", PRIVATE_KEY_CACHE),
+            ("aes_keys", AES_KEY_CACHE),
+            ("study_encryption_keys", STUDY_ENCRYPTION_KEY_CACHE),
+        )
+    }
@@ -1,10 +1,19 @@
+from itertools import islice
+from multiprocessing.pool import ThreadPool
+from threading import Lock
+from time import perf_counter
+from typing import BinaryIO, Generator, Iterable, List
+
 import boto3
+from botocore.config import Config
 from Cryptodome.PublicKey import RSA
 
 from config.settings import (BEIWE_SERVER_AWS_ACCESS_KEY_ID, BEIWE_SERVER_AWS_SECRET_ACCESS_KEY,
-    S3_BUCKET, S3_REGION_NAME)
-from libs.encryption import (decrypt_server, encrypt_for_server, generate_key_pairing,
-    get_RSA_cipher, prepare_X509_key_for_java)
+    CONCURRENT_NETWORK_OPS, S3_BUCKET, S3_CONNECT_TIMEOUT, S3_MAX_ATTEMPTS, S3_MAX_POOL_CONNECTIONS,
+    S3_READ_TIMEOUT, S3_REGION_NAME, S3_RETRY_MODE)
+from libs.encryption import (decrypt_server, decrypt_server_stream, encrypt_for_server,
+    encrypt_for_server_stream, generate_key_pairing, get_RSA_cipher, prepare_X509_key_for_java)
+from libs.key_caches import clear_participant_key_caches
 
 """
 Research on getting a stream into the decryption code of pycryptodome
@@ -19,41 +28,261 @@ it in like this:
 
 But that just results in this error from pycryptodome:
 TypeError: Object type <class 'botocore.response.StreamingBody'> cannot be passed to C code
+
+Instead, s3_retrieve_stream reads the StreamingBody in blocks and passes each block to the
+(stateful) cipher, see decrypt_server_stream.
 """
 
+# The block size, in bytes, used when reading and decrypting S3 objects as streams.
+S3_STREAM_BLOCK_SIZE = 1024 * 1024
+
+# Uploads of at least S3_MULTIPART_THRESHOLD bytes are encrypted and sent as S3 multipart uploads,
+# in parts of S3_MULTIPART_PART_SIZE bytes (S3's minimum part size is 5MB), with up to
+# S3_MULTIPART_CONCURRENCY parts being uploaded (and held in memory) at a time.  Smaller uploads
+# use a single put_object.
+S3_MULTIPART_THRESHOLD = 16 * 1024 * 1024
+S3_MULTIPART_PART_SIZE = 8 * 1024 * 1024
+S3_MULTIPART_CONCURRENCY = 4
+
 
 class S3VersionException(Exception): pass
 class NoSuchKeyException(Exception): pass
 
 
-conn = boto3.client(
-    's3',
-    aws_access_key_id=BEIWE_SERVER_AWS_ACCESS_KEY_ID,
-    aws_secret_access_key=BEIWE_SERVER_AWS_SECRET_ACCESS_KEY,
-    region_name=S3_REGION_NAME
-)
+class S3Metrics:
+    """ Call counts, retries, errors and latency of the S3 calls made by this process, by operation
+    (e.g. GetObject).  Latency is the time until the response headers are received, including
+    retries, it does not include reading the body of a GetObject. """
+    
+    def __init__(self):
+        self.operations = {}
+        self._lock = Lock()
+    
+    def record(self, operation: str, seconds: float, retries: int, error: bool):
+        with self._lock:
+            if operation not in self.operations:
+                self.operations[operation] = {
+                    "calls": 0, "retries": 0, "errors": 0, "total_seconds": 0.0, "max_seconds": 0.0,
+                }
+            metrics = self.operations[operation]
+            metrics["calls"] += 1
+            metrics["retries"] += retries
+            metrics["errors"] += error
+            metrics["total_seconds"] += seconds
+            metrics["max_seconds"] = max(metrics["max_seconds"], seconds)
+    
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {operation: dict(metrics) for operation, metrics in self.operations.items()}
+    
+    def clear(self):
+        with self._lock:
+            self.operations.clear()
+
+
+S3_METRICS = S3Metrics()
+
+
+def get_s3_metrics() -> dict:
+    return S3_METRICS.as_dict()
+
+
+def _start_call_timer(context: dict, **kwargs):
+    context["s3_metrics_start_time"] = perf_counter()
+
+
+def _call_seconds(context: dict) -> float:
+    start_time = context.get("s3_metrics_start_time")
+    return perf_counter() - start_time if start_time is not None else 0.0
+
+
+def _record_call(model, context: dict, parsed: dict, **kwargs):
+    retries = parsed.get("ResponseMetadata", {}).get("RetryAttempts", 0)
+    S3_METRICS.record(model.name, _call_seconds(context), retries, "Error" in parsed)
+
+
+def _record_call_error(event_name: str, context: dict, **kwargs):
+    """ after-call-error is emitted when a call raises without a response (e.g. connection errors
+    after all retries), it has no model, the operation is the last part of the event name. """
+    retries = max(context.get("retries", {}).get("attempt", 1) - 1, 0)
+    S3_METRICS.record(event_name.rsplit(".", 1)[-1], _call_seconds(context), retries, True)
+
+
+def s3_max_pool_connections() -> int:
+    """ Every thread accessing S3 needs a connection.  The largest fan out is a pool of
+    CONCURRENT_NETWORK_OPS threads that are each running a multipart upload. """
+    if S3_MAX_POOL_CONNECTIONS:
+        return S3_MAX_POOL_CONNECTIONS
+    # 10 is the botocore default.
+    return max(10, CONCURRENT_NETWORK_OPS * S3_MULTIPART_CONCURRENCY)
+
+
+def make_s3_client():
+    config = {
+        "max_pool_connections": s3_max_pool_connections(),
+        "connect_timeout": S3_CONNECT_TIMEOUT,
+        "read_timeout": S3_READ_TIMEOUT,
+        "retries": {"mode": S3_RETRY_MODE, "max_attempts": S3_MAX_ATTEMPTS},
+    }
+    # connections are always reused (http keep-alive), older versions of botocore do not support
+    # tcp keepalive, which keeps idle connections from being dropped.
+    if "tcp_keepalive" in Config.OPTION_DEFAULTS:
+        config["tcp_keepalive"] = True
+    
+    client = boto3.client(
+        's3',
+        aws_access_key_id=BEIWE_SERVER_AWS_ACCESS_KEY_ID,
+        aws_secret_access_key=BEIWE_SERVER_AWS_SECRET_ACCESS_KEY,
+        region_name=S3_REGION_NAME,
+        config=Config(**config),
+    )
+    client.meta.events.register("before-parameter-build.s3", _start_call_timer)
+    client.meta.events.register("after-call.s3", _record_call)
+    client.meta.events.register("after-call-error.s3", _record_call_error)
+    return client
+
+
+# The client is thread-safe, it is shared by all threads in a process.
+conn = make_s3_client()
 
 
 def s3_upload(key_path: str, data_string: bytes, study_object_id: str, raw_path=False) -> None:
     if not raw_path:
         key_path = study_object_id + "/" + key_path
     
-    data = encrypt_for_server(data_string, study_object_id)
-    conn.put_object(Body=data, Bucket=S3_BUCKET, Key=key_path)#, ContentType='string')
+    if len(data_string) < S3_MULTIPART_THRESHOLD:
+        data = encrypt_for_server(data_string, study_object_id)
+        conn.put_object(Body=data, Bucket=S3_BUCKET, Key=key_path)#, ContentType='string')
+    else:
+        encrypted_blocks = encrypt_for_server_stream(_split_blocks(data_string), study_object_id)
+        _multipart_upload(key_path, _join_parts(encrypted_blocks))
 
 
-def s3_retrieve(key_path: str, study_object_id: str, raw_path:bool=False, number_retries=3) -> bytes:
+def s3_upload_encrypted(key_path: str, encrypted_data: bytes) -> None:
+    """ Uploads data that is already encrypted with encrypt_for_server, key_path is the full path. """
+    if len(encrypted_data) < S3_MULTIPART_THRESHOLD:
+        conn.put_object(Body=encrypted_data, Bucket=S3_BUCKET, Key=key_path)
+    else:
+        # botocore does not accept memoryviews as request bodies, each part is copied as it is sent.
+        parts = _split_blocks(encrypted_data, S3_MULTIPART_PART_SIZE)
+        _multipart_upload(key_path, (bytes(part) for part in parts))
+
+
+def _split_blocks(
+    data: bytes, block_size: int = S3_STREAM_BLOCK_SIZE
+) -> Generator[memoryview, None, None]:
+    """ Slices data into blocks without copying it. """
+    view = memoryview(data)
+    for i in range(0, len(view), block_size):
+        yield view[i:i + block_size]
+
+
+def _join_parts(blocks: Iterable[bytes]) -> Generator[bytes, None, None]:
+    """ Regroups blocks of any size into multipart upload parts of S3_MULTIPART_PART_SIZE bytes (the
+    last part may be smaller). """
+    part_size = S3_MULTIPART_PART_SIZE
+    buffer = bytearray()
+    for block in blocks:
+        buffer += block
+        while len(buffer) >= part_size:
+            yield bytes(buffer[:part_size])
+            del buffer[:part_size]
+    if buffer:
+        yield bytes(buffer)
+
+
+def _multipart_upload(key_path: str, parts: Iterable[bytes]) -> None:
+    """ Uploads a file as an S3 multipart upload, parts are uploaded concurrently.  Failed requests
+    are retried by the client, see make_s3_client.  If a part can't be uploaded the multipart
+    upload is aborted. """
+    upload_id = conn.create_multipart_upload(Bucket=S3_BUCKET, Key=key_path)["UploadId"]
+    
+    def upload_part(part_number_and_data) -> dict:
+        part_number, data = part_number_and_data
+        response = conn.upload_part(
+            Body=data, Bucket=S3_BUCKET, Key=key_path, UploadId=upload_id, PartNumber=part_number
+        )
+        return {"ETag": response["ETag"], "PartNumber": part_number}
+    
+    completed_parts: List[dict] = []
+    pool = ThreadPool(S3_MULTIPART_CONCURRENCY)
+    try:
+        # parts are read from the iterable (i.e. generated) only when there is a thread to upload
+        # them, which bounds memory use.
+        numbered_parts = enumerate(parts, start=1)
+        while True:
+            batch = list(islice(numbered_parts, S3_MULTIPART_CONCURRENCY))
+            if not batch:
+                break
+            completed_parts.extend(pool.map(upload_part, batch))
+        conn.complete_multipart_upload(
+            Bucket=S3_BUCKET, Key=key_path, UploadId=upload_id,
+            MultipartUpload={"Parts": completed_parts},
+        )
+    except BaseException:
+        conn.abort_multipart_upload(Bucket=S3_BUCKET, Key=key_path, UploadId=upload_id)
+        raise
+    finally:
+        pool.close()
+        pool.terminate()
+
+
+def s3_retrieve(key_path: str, study_object_id: str, raw_path:bool=False) -> bytes:
     """ Takes an S3 file path (key_path), and a study ID.  Takes an optional argument, raw_path,
     which defaults to false.  When set to false the path is prepended to place the file in the
     appropriate study_id folder. """
     if not raw_path:
         key_path = study_object_id + "/" + key_path
-    encrypted_data = _do_retrieve(S3_BUCKET, key_path, number_retries=number_retries)['Body'].read()
+    encrypted_data = _do_retrieve(S3_BUCKET, key_path)['Body'].read()
     return decrypt_server(encrypted_data, study_object_id)
 
 
-def _do_retrieve(bucket_name, key_path, number_retries=3):
-    """ Run-logic to do a data retrieval for a file in an S3 bucket."""
+def s3_retrieve_stream(
+    key_path: str, study_object_id: str, raw_path: bool = False, block_size: int = S3_STREAM_BLOCK_SIZE,
+    encryption_key: bytes = None,
+) -> Generator[bytes, None, None]:
+    """ As s3_retrieve, but returns a generator of blocks of the decrypted file, memory use is
+    bounded by the block size instead of the size of the file.  The request is made immediately,
+    so errors like NoSuchKeyException are raised here rather than during iteration.  Pass the
+    study's encryption_key to avoid looking it up (e.g. on a thread that can't query the database). """
+    if not raw_path:
+        key_path = study_object_id + "/" + key_path
+    body = _do_retrieve(S3_BUCKET, key_path)['Body']
+    return _decrypt_body(body, study_object_id, block_size, encryption_key)
+
+
+def s3_retrieve_to_file(
+    key_path: str, study_object_id: str, sink: BinaryIO, raw_path: bool = False,
+    block_size: int = S3_STREAM_BLOCK_SIZE,
+) -> int:
+    """ Writes the decrypted file to sink (anything with a write method, e.g. an open file), block
+    by block.  Returns the number of bytes written. """
+    size = 0
+    for block in s3_retrieve_stream(key_path, study_object_id, raw_path=raw_path, block_size=block_size):
+        sink.write(block)
+        size += len(block)
+    return size
+
+
+def _decrypt_body(
+    body, study_object_id: str, block_size: int, encryption_key: bytes = None
+) -> Generator[bytes, None, None]:
+    try:
+        yield from decrypt_server_stream(
+            iter(lambda: body.read(block_size), b""), study_object_id, encryption_key
+        )
+    finally:
+        body.close()
+
+
+def s3_get_size(key_path: str) -> int:
+    """ The size of an object on S3, in bytes (as stored, i.e. encrypted). """
+    return conn.head_object(Bucket=S3_BUCKET, Key=key_path)["ContentLength"]
+
+
+def _do_retrieve(bucket_name, key_path):
+    """ Run-logic to do a data retrieval for a file in an S3 bucket.  Failed requests are retried by
+    the client, see make_s3_client. """
     try:
         return conn.get_object(Bucket=bucket_name, Key=key_path, ResponseContentType='string')
     
@@ -61,10 +290,6 @@ def _do_retrieve(bucket_name, key_path, number_retries=3):
         # Some error types cannot be imported because they are generated at runtime through a factory
         if boto_error_unknowable_type.__class__.__name__ == "NoSuchKey":
             raise NoSuchKeyException(f"{bucket_name}: {key_path}")
-        # usually we want to try again
-        if number_retries > 0:
-            print("s3_retrieve failed, retrying on %s" % key_path)
-            return _do_retrieve(bucket_name, key_path, number_retries=number_retries - 1)
         # unknown cases: explode.
         raise
 
@@ -142,6 +367,7 @@ def create_client_key_pair(patient_id, study_id):
     public, private = generate_key_pairing()
     s3_upload("keys/" + patient_id + "_private", private, study_id)
     s3_upload("keys/" + patient_id + "_public", public, study_id)
+    clear_participant_key_caches(patient_id)
 
 
 def get_client_public_key_string(patient_id, study_id) -> str:
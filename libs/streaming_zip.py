@@ -1,18 +1,27 @@
 import json
+from collections import deque
+from io import SEEK_CUR, SEEK_END, SEEK_SET, UnsupportedOperation
 from multiprocessing.pool import ThreadPool
-from typing import Tuple
-from zipfile import ZIP_STORED, ZipFile
+from queue import Queue
+from time import localtime
+from typing import Generator, Iterable, List, Tuple
+from zipfile import ZIP_STORED, ZipFile, ZipInfo
 
+from config.settings import DATA_ACCESS_API_PREFETCH_BYTES, DATA_ACCESS_API_PREFETCH_WORKERS
 from constants.data_stream_constants import (IMAGE_FILE, SURVEY_ANSWERS, SURVEY_TIMINGS,
     VOICE_RECORDING)
 from database.study_models import Study
-from libs.s3 import s3_retrieve
-from libs.streaming_bytes_io import StreamingBytesIO
+from libs.s3 import s3_retrieve_stream
 
 
 class DummyError(Exception): pass
 
 
+# The expected size of files with an unknown size (ChunkRegistry.file_size is not populated on
+# older chunks), used by prefetching_zip_generator.
+UNKNOWN_FILE_SIZE_ESTIMATE = 1024 * 1024
+
+
 def determine_file_name(chunk):
     """ Generates the correct file name to provide the file with in the zip file.
         (This also includes the folder location files in the zip.) """
@@ -55,119 +64,176 @@ def determine_file_name(chunk):
                             str(chunk["time_bin"]).replace(":", "_"), extension)
 
 
-def batch_retrieve_s3(chunk: dict) -> Tuple[dict, bytes]:
-    """ Data is returned in the form (chunk_object, file_data). """
-    return chunk, s3_retrieve(
-        chunk["chunk_path"],
-        study_object_id=Study.objects.get(id=chunk["study_id"]).object_id,
-        raw_path=True,
-    )
+def write_zip_entry(zip_input: ZipFile, file_name: str, blocks: Iterable[bytes], expected_size: int = 0):
+    """ As ZipFile.writestr, but takes the file contents as blocks, which are written as they
+    arrive.  expected_size is only used to decide whether the entry needs zip64 extensions. """
+    zinfo = ZipInfo(file_name, date_time=localtime()[:6])
+    zinfo.compress_type = zip_input.compression
+    zinfo.external_attr = 0o600 << 16
+    zinfo.file_size = expected_size
+    with zip_input.open(zinfo, mode="w") as f:
+        for block in blocks:
+            f.write(block)
+
+
+class ZipStreamOutput:
+    """ A file-like object for a ZipFile to write to.  Written data is collected, without being
+    copied, until it is taken with pop_pieces.
+    
+    Data that has not been taken yet can be overwritten, and that is all a ZipFile seeks for: when
+    an entry is closed it goes back and rewrites the entry's local header with the CRC and sizes.
+    (Given unseekable output ZipFile writes data descriptors instead, leaving zeros in the local
+    headers, and streaming unzip clients such as Java's ZipInputStream reject STORED entries like
+    that.)  Entries must be closed before their data is taken. """
+    
+    # writes smaller than this (zip headers) are combined into one mutable piece
+    SMALL_WRITE_SIZE = 64 * 1024
+    
+    def __init__(self):
+        self.position = 0
+        self.size = 0
+        # tuples of (offset, data), small writes are combined into bytearrays, which can be
+        # overwritten.  Larger writes are kept as they are.
+        self.pieces = []
+    
+    def write(self, data: bytes) -> int:
+        size = len(data)
+        if self.position != self.size:
+            self._overwrite(data)
+        elif size < self.SMALL_WRITE_SIZE:
+            if self.pieces and isinstance(self.pieces[-1][1], bytearray):
+                self.pieces[-1][1].extend(data)
+            else:
+                self.pieces.append((self.size, bytearray(data)))
+            self.size += size
+        else:
+            self.pieces.append((self.size, data))
+            self.size += size
+        self.position += size
+        return size
+    
+    def _overwrite(self, data: bytes):
+        for offset, piece in reversed(self.pieces):
+            if offset <= self.position:
+                start = self.position - offset
+                if not isinstance(piece, bytearray) or start + len(data) > len(piece):
+                    raise UnsupportedOperation("only zip headers can be overwritten")
+                piece[start:start + len(data)] = data
+                return
+        raise UnsupportedOperation("data that has been taken can't be overwritten")
+    
+    def tell(self) -> int:
+        return self.position
+    
+    def seek(self, offset: int, whence: int = SEEK_SET) -> int:
+        if whence == SEEK_CUR:
+            offset += self.position
+        elif whence == SEEK_END:
+            offset += self.size
+        if not (self.pieces[0][0] if self.pieces else self.size) <= offset <= self.size:
+            raise UnsupportedOperation("data that has been taken can't be seeked to")
+        self.position = offset
+        return offset
+    
+    def flush(self):
+        pass
+    
+    def pop_pieces(self) -> List[bytes]:
+        pieces = [bytes(piece) if isinstance(piece, bytearray) else piece for _, piece in self.pieces]
+        self.pieces = []
+        return pieces
+
+
+def retrieve_decrypted_blocks(chunk_path: str, study_object_id: str, encryption_key: bytes, blocks: Queue):
+    """ Runs on a prefetch thread, puts the decrypted blocks of a file on blocks as they are read,
+    followed by None (also after an error, which is raised when the result is retrieved). """
+    try:
+        for block in s3_retrieve_stream(chunk_path, study_object_id, raw_path=True, encryption_key=encryption_key):
+            blocks.put(block)
+    finally:
+        blocks.put(None)
 
 
 # Note: you cannot access the request context inside a generator function
-def zip_generator(files_list, construct_registry=False):
-    """ Pulls in data from S3 in a multithreaded network operation, constructs a zip file of that
-    data. This is a generator, advantage is it starts returning data (file by file, but wrapped
-    in zip compression) almost immediately. """
-    
-    processed_files = set()
-    duplicate_files = set()
-    pool = ThreadPool(3)
-    # 3 Threads has been heuristically determined to be a good value, it does not cause the server
-    # to be overloaded, and provides more-or-less the maximum data download speed.  This was tested
-    # on an m4.large instance (dual core, 8GB of ram).
+def prefetching_zip_generator(
+    files_list: Iterable[dict],
+    construct_registry: bool = False,
+    prefetch_workers: int = DATA_ACCESS_API_PREFETCH_WORKERS,
+    prefetch_bytes: int = DATA_ACCESS_API_PREFETCH_BYTES,
+) -> Generator[bytes, None, None]:
+    """ Streams a zip file of the files in files_list (ChunkRegistry values dicts), in order.
+    
+    Files are downloaded and decrypted ahead of being added to the zip file by prefetch_workers
+    threads.  Downloads are started while the expected size of the files that are downloading or
+    waiting to be added is under prefetch_bytes (the next file is always downloaded).  Each study's
+    object id and encryption key are looked up once, the download threads don't query the
+    database.  The download threads hand over each decrypted block as it is read, and blocks are
+    written to the zip file as they arrive.  A file's data is yielded once its entry is complete
+    (its local header holds the CRC), large blocks are yielded as they are, without being copied. """
+    output = ZipStreamOutput()
+    zip_input = ZipFile(output, mode="w", compression=ZIP_STORED, allowZip64=True)
     file_registry = {}
+    file_names = set()
+    study_keys = {}
+    # tuples of (file name, Queue of the file's blocks, AsyncResult of the download, expected size),
+    # in order.
+    pending = deque()
+    pending_bytes = 0
+    pool = ThreadPool(prefetch_workers)
+    
+    def get_study_keys(study_id: int) -> Tuple[str, bytes]:
+        """ The study's object id and encryption key, passed to the download threads so that they
+        never look up the key (a download can outlast the key cache). """
+        if study_id not in study_keys:
+            study_object_id, encryption_key = Study.objects.filter(id=study_id).values_list(
+                "object_id", "encryption_key"
+            ).get()
+            study_keys[study_id] = (study_object_id, encryption_key.encode())
+        return study_keys[study_id]
     
-    zip_output = StreamingBytesIO()
-    zip_input = ZipFile(zip_output, mode="w", compression=ZIP_STORED, allowZip64=True)
+    def add_next_file() -> List[bytes]:
+        nonlocal pending_bytes
+        file_name, blocks, download, expected_size = pending.popleft()
+        pending_bytes -= expected_size
+        write_zip_entry(zip_input, file_name, iter(blocks.get, None), expected_size)
+        download.get()  # raises any error from the download, before the entry's data is yielded
+        return output.pop_pieces()
     
     try:
-        # chunks_and_content is a list of tuples, of the chunk and the content of the file.
-        # chunksize (which is a keyword argument of imap, not to be confused with Beiwe Chunks)
-        # is the size of the batches that are handed to the pool. We always want to add the next
-        # file to retrieve to the pool asap, so we want a chunk size of 1.
-        # (In the documentation there are comments about the timeout, it is irrelevant under this construction.)
-        chunks_and_content = pool.imap_unordered(batch_retrieve_s3, files_list, chunksize=1)
-        total_size = 0
-        for chunk, file_contents in chunks_and_content:
+        for chunk in files_list:
             if construct_registry:
                 file_registry[chunk['chunk_path']] = chunk["chunk_hash"]
+            # files with duplicate names are not included, don't download them.
             file_name = determine_file_name(chunk)
-            if file_name in processed_files:
-                duplicate_files.add((file_name, chunk['chunk_path']))
+            if file_name in file_names:
                 continue
-            processed_files.add(file_name)
+            file_names.add(file_name)
             
-            zip_input.writestr(file_name, file_contents)
-            # These can be large, and we don't want them sticking around in memory as we wait for the yield
-            del file_contents, chunk
+            # add any files that are ready, then wait until there is room for this file.
+            while pending and pending[0][2].ready():
+                yield from add_next_file()
+            expected_size = chunk.get("file_size") or UNKNOWN_FILE_SIZE_ESTIMATE
+            while pending and pending_bytes + expected_size > prefetch_bytes:
+                yield from add_next_file()
             
-            x = zip_output.getvalue()
-            total_size += len(x)
-            # print "%s: %sK, %sM" % (random_id, total_size / 1024, total_size / 1024 / 1024)
-            yield x  # yield the (compressed) file information
-            del x
-            zip_output.empty()
-
+            blocks = Queue()
+            download = pool.apply_async(
+                retrieve_decrypted_blocks,
+                (chunk["chunk_path"], *get_study_keys(chunk["study_id"]), blocks),
+            )
+            pending.append((file_name, blocks, download, expected_size))
+            pending_bytes += expected_size
+        
+        while pending:
+            yield from add_next_file()
+        
         if construct_registry:
             zip_input.writestr("registry", json.dumps(file_registry))
-            yield zip_output.getvalue()
-            zip_output.empty()
+            yield from output.pop_pieces()
         
         # close, then yield all remaining data in the zip.
         zip_input.close()
-        yield zip_output.getvalue()
-    except DummyError:
-        # The try-except-finally block is here to guarantee the Threadpool is closed and terminated.
-        # we don't handle any errors, we just re-raise any error that shows up.
-        # (with statement does not work.)
-        raise
+        yield from output.pop_pieces()
     finally:
-        # We rely on the finally block to ensure that the threadpool will be closed and terminated,
-        # and also to print an error to the log if we need to.
         pool.close()
         pool.terminate()
-
-
-# delete zip_generator_for_pipeline only by reverting the commit
-def zip_generator_for_pipeline(files_list):
-    pool = ThreadPool(3)
-    zip_output = StreamingBytesIO()
-    zip_input = ZipFile(zip_output, mode="w", compression=ZIP_STORED, allowZip64=True)
-    try:
-        # chunks_and_content is a list of tuples, of the chunk and the content of the file.
-        # chunksize (which is a keyword argument of imap, not to be confused with Beiwe Chunks)
-        # is the size of the batches that are handed to the pool. We always want to add the next
-        # file to retrieve to the pool asap, so we want a chunk size of 1.
-        # (In the documentation there are comments about the timeout, it is irrelevant under this construction.)
-        chunks_and_content = pool.imap_unordered(batch_retrieve_pipeline_s3, files_list, chunksize=1)
-        for pipeline_upload, file_contents in chunks_and_content:
-            # file_name = determine_file_name(chunk)
-            zip_input.writestr("data/" + pipeline_upload.file_name, file_contents)
-            # These can be large, and we don't want them sticking around in memory as we wait for the yield
-            del file_contents, pipeline_upload
-            yield zip_output.getvalue()  # yield the (compressed) file information
-            zip_output.empty()
-        
-        # close, then yield all remaining data in the zip.
-        zip_input.close()
-        yield zip_output.getvalue()
-    
-    except DummyError:
-        # The try-except-finally block is here to guarantee the Threadpool is closed and terminated.
-        # we don't handle any errors, we just re-raise any error that shows up.
-        # (with statement does not work.)
-        raise
-    finally:
-        # We rely on the finally block to ensure that the threadpool will be closed and terminated,
-        # and also to print an error to the log if we need to.
-        pool.close()
-        pool.terminate()
-
-
-def batch_retrieve_pipeline_s3(pipeline_upload):
-    """ Data is returned in the form (chunk_object, file_data). """
-    study = Study.objects.get(id = pipeline_upload.study_id)
-    return pipeline_upload, s3_retrieve(pipeline_upload.s3_path,
-                                        study.object_id,
-                                        raw_path=True)
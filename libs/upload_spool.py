@@ -0,0 +1,252 @@
+import fcntl
+import json
+import os
+from hashlib import sha256
+from multiprocessing.pool import ThreadPool
+from time import time
+from typing import List, Optional
+
+from django.db import DatabaseError, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from config.settings import CONCURRENT_NETWORK_OPS, UPLOAD_SPOOL_DIRECTORY
+from database.data_access_models import FileToProcess
+from database.profiling_models import UploadTracking
+from database.user_models import Participant
+from libs.encryption import encrypt_for_server
+from libs.s3 import s3_upload_encrypted
+
+
+"""
+The upload spool lets the upload endpoint return as soon as an uploaded file is safely on the
+server's local disk, instead of after the S3 upload and database inserts.  Spooled files are
+uploaded to S3 and registered (FileToProcess and UploadTracking) in batches by
+flush_upload_spool, run by services/upload_spool_flusher.py.
+
+Each spooled upload is a single file, written under a temporary name, fsynced, and then linked to
+its final name (which is derived from the file's S3 path), so a spooled upload is either complete
+or absent.  The file contains a line of json metadata followed by the data, encrypted with
+encrypt_for_server as it would be on S3.
+
+Spooled uploads that can't be read (e.g. a truncated file) or registered (e.g. the participant was
+deleted while the upload was in the spool) are moved to the quarantine subdirectory, so that they
+don't block the rest of the spool.  They have already been acknowledged to the device, they need
+to be inspected by hand.
+
+Enabled by the UPLOAD_SPOOL_DIRECTORY setting.
+"""
+
+SPOOL_FILE_EXTENSION = ".upload"
+TEMPORARY_FILE_EXTENSION = ".tmp"
+LOCK_FILE_NAME = ".flush_lock"
+QUARANTINE_DIRECTORY_NAME = "quarantine"
+# the number of spooled uploads that are uploaded and registered together
+SPOOL_FLUSH_BATCH_SIZE = 100
+# temporary files are the remnants of a crash if they are older than this, in seconds
+STALE_TEMPORARY_FILE_AGE = 60 * 60
+
+
+class SpooledFileExists(Exception): pass
+class SpooledFilesQuarantined(Exception): pass
+
+
+class SpooledUpload:
+    def __init__(self, spool_path: str, metadata: dict, encrypted_data: bytes):
+        self.spool_path = spool_path
+        self.s3_file_path = metadata["s3_file_path"]  # includes the study object id
+        self.study_id = metadata["study_id"]
+        self.participant_id = metadata["participant_id"]
+        self.file_size = metadata["file_size"]
+        self.timestamp = parse_datetime(metadata["timestamp"])
+        self.encrypted_data = encrypted_data
+
+
+def upload_spool_enabled() -> bool:
+    return bool(UPLOAD_SPOOL_DIRECTORY)
+
+
+def spool_file_path(s3_file_path: str, spool_directory: str = None) -> str:
+    spool_directory = spool_directory or UPLOAD_SPOOL_DIRECTORY
+    return os.path.join(spool_directory, sha256(s3_file_path.encode()).hexdigest() + SPOOL_FILE_EXTENSION)
+
+
+def is_spooled(file_path: str, study_object_id: str) -> bool:
+    """ Whether an upload is in the spool, waiting to be flushed. """
+    s3_file_path = FileToProcess.normalize_s3_file_path(file_path, study_object_id)
+    return os.path.exists(spool_file_path(s3_file_path))
+
+
+def spool_upload(
+    file_path: str, file_contents: bytes, participant: Participant, spool_directory: str = None
+):
+    """ Durably writes an upload to the spool.  Raises SpooledFileExists if the file is already
+    spooled. """
+    spool_directory = spool_directory or UPLOAD_SPOOL_DIRECTORY
+    study_object_id = participant.study.object_id
+    s3_file_path = FileToProcess.normalize_s3_file_path(file_path, study_object_id)
+    metadata = {
+        "s3_file_path": s3_file_path,
+        "study_id": participant.study_id,
+        "participant_id": participant.pk,
+        "file_size": len(file_contents),
+        "timestamp": timezone.now().isoformat(),
+    }
+
+    final_path = spool_file_path(s3_file_path, spool_directory)
+    temporary_path = f"{final_path}.{os.getpid()}.{time()}{TEMPORARY_FILE_EXTENSION}"
+    try:
+        with open(temporary_path, "wb") as f:
+            f.write(json.dumps(metadata).encode() + b"\n")
+            f.write(encrypt_for_server(file_contents, study_object_id))
+            f.flush()
+            os.fsync(f.fileno())
+        # linking fails if the destination exists, so concurrent uploads of the same file can't
+        # overwrite each other.
+        try:
+            os.link(temporary_path, final_path)
+        except FileExistsError:
+            raise SpooledFileExists(s3_file_path)
+    finally:
+        try:
+            os.remove(temporary_path)
+        except FileNotFoundError:
+            pass
+
+    # the new directory entry is durable once the directory is synced.
+    directory_fd = os.open(spool_directory, os.O_RDONLY)
+    try:
+        os.fsync(directory_fd)
+    finally:
+        os.close(directory_fd)
+
+
+def read_spooled_upload(spool_path: str) -> SpooledUpload:
+    with open(spool_path, "rb") as f:
+        metadata = json.loads(f.readline())
+        return SpooledUpload(spool_path, metadata, f.read())
+
+
+def quarantine_spooled_file(spool_path: str, error: Exception, quarantined: List[str]):
+    """ Moves a spooled upload that can't be flushed out of the spool, adds it to quarantined. """
+    quarantine_directory = os.path.join(os.path.dirname(spool_path), QUARANTINE_DIRECTORY_NAME)
+    os.makedirs(quarantine_directory, exist_ok=True)
+    quarantine_path = os.path.join(quarantine_directory, os.path.basename(spool_path))
+    os.replace(spool_path, quarantine_path)
+    print(f"spooled file {spool_path} could not be flushed, moved to {quarantine_path}: {error!r}")
+    quarantined.append(f"{quarantine_path}: {error!r}")
+
+
+def flush_upload_spool(spool_directory: str = None) -> Optional[int]:
+    """ Uploads and registers all spooled uploads.  Returns the number of uploads flushed, or None
+    if another process is already flushing this spool.
+    Uploads that can't be read or registered are quarantined, once everything else has been flushed
+    they are reported by raising SpooledFilesQuarantined. """
+    spool_directory = spool_directory or UPLOAD_SPOOL_DIRECTORY
+
+    with open(os.path.join(spool_directory, LOCK_FILE_NAME), "w") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+
+        remove_stale_temporary_files(spool_directory)
+        spool_paths = sorted(
+            (entry.path for entry in os.scandir(spool_directory) if entry.name.endswith(SPOOL_FILE_EXTENSION)),
+            key=os.path.getmtime,
+        )
+
+        flushed = 0
+        quarantined = []
+        pool = ThreadPool(CONCURRENT_NETWORK_OPS)
+        try:
+            for i in range(0, len(spool_paths), SPOOL_FLUSH_BATCH_SIZE):
+                spooled_uploads = []
+                for path in spool_paths[i:i + SPOOL_FLUSH_BATCH_SIZE]:
+                    try:
+                        spooled_uploads.append(read_spooled_upload(path))
+                    except Exception as e:
+                        quarantine_spooled_file(path, e, quarantined)
+                flushed += flush_batch(spooled_uploads, pool, quarantined)
+        finally:
+            pool.close()
+            pool.terminate()
+
+    if quarantined:
+        raise SpooledFilesQuarantined("\n".join(quarantined))
+    return flushed
+
+
+def flush_batch(spooled_uploads: List[SpooledUpload], pool: ThreadPool, quarantined: List[str]) -> int:
+    """ Uploads a batch of spooled uploads to S3, then registers them in the database and removes
+    them from the spool.  Uploads that fail to upload stay in the spool for the next flush, uploads
+    that can't be registered are quarantined. """
+
+    def upload(spooled_upload: SpooledUpload) -> bool:
+        try:
+            s3_upload_encrypted(spooled_upload.s3_file_path, spooled_upload.encrypted_data)
+            return True
+        except Exception as e:
+            print(f"upload of spooled file {spooled_upload.s3_file_path} failed: {e}")
+            return False
+
+    uploaded = [
+        spooled_upload for spooled_upload, success in zip(spooled_uploads, pool.map(upload, spooled_uploads))
+        if success
+    ]
+
+    # A file can already be registered if a previous flush was interrupted after registration.
+    already_registered = set(FileToProcess.objects.filter(
+        s3_file_path__in=[spooled_upload.s3_file_path for spooled_upload in uploaded]
+    ).values_list("s3_file_path", flat=True))
+    new_uploads = [u for u in uploaded if u.s3_file_path not in already_registered]
+
+    # the participant may have been deleted while the upload was in the spool.
+    participant_ids = set(Participant.objects.filter(
+        pk__in={u.participant_id for u in new_uploads}
+    ).values_list("pk", flat=True))
+    for spooled_upload in [u for u in new_uploads if u.participant_id not in participant_ids]:
+        quarantine_spooled_file(
+            spooled_upload.spool_path, Participant.DoesNotExist(spooled_upload.participant_id), quarantined
+        )
+        new_uploads.remove(spooled_upload)
+        uploaded.remove(spooled_upload)
+
+    try:
+        with transaction.atomic():
+            register_spooled_uploads(new_uploads)
+    except DatabaseError:
+        # register them one at a time, so that one bad upload doesn't block the others.
+        for spooled_upload in new_uploads:
+            try:
+                with transaction.atomic():
+                    register_spooled_uploads([spooled_upload])
+            except DatabaseError as e:
+                quarantine_spooled_file(spooled_upload.spool_path, e, quarantined)
+                uploaded.remove(spooled_upload)
+
+    for spooled_upload in uploaded:
+        os.remove(spooled_upload.spool_path)
+    return len(uploaded)
+
+
+def register_spooled_uploads(spooled_uploads: List[SpooledUpload]):
+    FileToProcess.objects.bulk_create([
+        FileToProcess(s3_file_path=u.s3_file_path, study_id=u.study_id, participant_id=u.participant_id)
+        for u in spooled_uploads
+    ])
+    UploadTracking.objects.bulk_create([
+        UploadTracking(
+            file_path=u.s3_file_path.split("/", 1)[1],  # without the study object id
+            file_size=u.file_size,
+            timestamp=u.timestamp,
+            participant_id=u.participant_id,
+        ) for u in spooled_uploads
+    ])
+
+
+def remove_stale_temporary_files(spool_directory: str):
+    for entry in os.scandir(spool_directory):
+        if entry.name.endswith(TEMPORARY_FILE_EXTENSION) and \
+                time() - entry.stat().st_mtime > STALE_TEMPORARY_FILE_AGE:
+            os.remove(entry.path)
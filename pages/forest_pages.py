@@ -19,7 +19,7 @@ from database.user_models import Participant
 from forms.django_forms import CreateTasksForm
 from libs.http_utils import easy_url
 from libs.internal_types import ParticipantQuerySet, ResearcherRequest
-from libs.streaming_zip import zip_generator
+from libs.streaming_zip import prefetching_zip_generator
 from libs.utils.date_utils import daterange
 from middleware.abort_middleware import abort
 from serializers.forest_serializers import ForestTaskCsvSerializer, ForestTaskSerializer
@@ -182,7 +182,7 @@ def download_task_data(request: ResearcherRequest, study_id, forest_task_externa
     
     chunks = ChunkRegistry.objects.filter(participant=tracker.participant).values(*CHUNK_FIELDS)
     f = FileResponse(
-        zip_generator(chunks),
+        prefetching_zip_generator(chunks.iterator()),
         content_type="zip",
         as_attachment=True,
         filename=f"{tracker.get_slug()}.zip",
@@ -0,0 +1,502 @@
+"""
+Benchmarks file processing with synthetic device data for every data stream.
+
+Run it like any other script:
+    python run_script.py benchmark_file_processing [--rows N] [--files N] [--output path.json]
+
+This script creates its own temporary SQLite database (it refuses to run against postgres) and
+replaces the S3 connection with an in-memory stand-in, so it never touches real data.  Files are
+encrypted and decrypted exactly as they are in production.
+
+For every data stream (with Android and iOS variants where the apps differ) it reports these
+stages, each with rows/sec, bytes/sec, peak RSS and database query count:
+    download - FileForProcessing: retrieval from the S3 stand-in and decryption.
+    process_csv_data - the whole parsing step, including data fixes and binning.
+    csv_to_list, data_fix, binify_csv_rows, convert_unix_to_human_readable_timestamps,
+    sort_by_timestamp, construct_csv_string_from_lines - the individual steps of processing.
+    pipeline - FileProcessingPipeline end to end: download, parse, merge, upload, registration.
+    pipeline_merge - the pipeline again, on csv files whose rows fall between the rows of the first
+        files, so every chunk already exists and the new rows are merged into it.
+
+Results are printed as a table and written as json (default: benchmark_file_processing.json),
+compare the json from two releases to find regressions.
+"""
+import argparse
+import json
+import platform
+import sys
+from collections import defaultdict
+from copy import deepcopy
+from datetime import datetime
+from operator import itemgetter
+from random import Random
+from tempfile import TemporaryDirectory
+from threading import Lock
+from time import perf_counter
+from typing import Callable, List, Tuple
+from unittest.mock import patch
+
+from cronutils.error_handler import ErrorHandler
+from django.db import connection
+from django.db.backends.utils import CursorWrapper
+
+from config.settings import COLUMNAR_FILE_PROCESSING
+from constants.data_stream_constants import (ACCELEROMETER, ALL_DATA_STREAMS, AMBIENT_AUDIO,
+    ANDROID_LOG_FILE, BLUETOOTH, CALL_LOG, DATA_STREAM_TO_S3_FILE_NAME_STRING,
+    DEVICE_IDENTIFIERS_HEADER, DEVICEMOTION, GPS, GYRO, IDENTIFIERS, IMAGE_FILE, IOS_LOG_FILE,
+    MAGNETOMETER, POWER_STATE, PROXIMITY, REACHABILITY, SURVEY_ANSWERS, SURVEY_DATA_FILES,
+    SURVEY_TIMINGS, TEXTS_LOG, VOICE_RECORDING, WIFI)
+from database.data_access_models import FileToProcess
+from database.study_models import Study
+from database.survey_models import Survey
+from database.tableau_api_models import ForestParam
+from database.user_models import Participant
+from libs.file_processing.data_fixes import (fix_app_log_file, fix_call_log_csv, fix_identifier_csv,
+    fix_survey_timings, fix_wifi_csv)
+from libs.file_processing.file_for_processing import FileForProcessing
+from libs.file_processing.file_processing_core import (binify_csv_rows, FileProcessingPipeline,
+    process_csv_data)
+from libs.file_processing.utility_functions_csvs import construct_csv_string_from_lines, csv_to_list
+from libs.file_processing.utility_functions_simple import convert_unix_to_human_readable_timestamps
+from libs.s3 import s3_upload
+from libs.security import generate_easy_alphanumeric_string
+from scripts.benchmark_helpers import get_peak_rss, reset_peak_rss
+from tests.helpers import DummyS3Client
+
+
+ANDROID = "android"
+IOS = "ios"
+START_TIMESTAMP = 1601863200000  # 2020-10-05T02:00:00Z, in milliseconds
+
+#
+## Synthetic data
+#
+
+# Which operating system's app produces each data stream, and the stream's csv header.  Streams
+# with a header of None are binary files.
+STREAM_HEADERS = {
+    (ACCELEROMETER, ANDROID): b"timestamp,accuracy,x,y,z",
+    (ACCELEROMETER, IOS): b"timestamp,x,y,z",
+    (AMBIENT_AUDIO, ANDROID): None,
+    (ANDROID_LOG_FILE, ANDROID): b"first line of the log",  # fix_app_log_file replaces it
+    (BLUETOOTH, ANDROID): b"timestamp,hashed MAC,RSSI",
+    (CALL_LOG, ANDROID): b"hashed phone number,call type,timestamp,duration in seconds",
+    (DEVICEMOTION, IOS): b"timestamp,roll,pitch,yaw,rotation_rate_x,rotation_rate_y,rotation_rate_z,"
+                         b"gravity_x,gravity_y,gravity_z,user_accel_x,user_accel_y,user_accel_z,"
+                         b"magnetic_field_calibration_accuracy,magnetic_field_x,magnetic_field_y,"
+                         b"magnetic_field_z",
+    (GPS, ANDROID): b"timestamp,latitude,longitude,altitude,accuracy",
+    (GPS, IOS): b"timestamp,latitude,longitude,altitude,accuracy",
+    (GYRO, ANDROID): b"timestamp,accuracy,x,y,z",
+    (GYRO, IOS): b"timestamp,x,y,z",
+    (IDENTIFIERS, ANDROID): DEVICE_IDENTIFIERS_HEADER.strip().encode(),
+    (IDENTIFIERS, IOS): DEVICE_IDENTIFIERS_HEADER.strip().encode(),
+    (IMAGE_FILE, IOS): None,
+    (IOS_LOG_FILE, IOS): b"timestamp,launchId,memory,battery,event,msg,d1,d2,d3,d4",
+    (MAGNETOMETER, IOS): b"timestamp,x,y,z",
+    (POWER_STATE, ANDROID): b"timestamp,event",
+    (POWER_STATE, IOS): b"timestamp,event,level",
+    (PROXIMITY, IOS): b"timestamp,event",
+    (REACHABILITY, IOS): b"timestamp,event",
+    (SURVEY_ANSWERS, ANDROID): b"question id,question type,question text,question answer options,answer",
+    (SURVEY_ANSWERS, IOS): b"question id,question type,question text,question answer options,answer",
+    (SURVEY_TIMINGS, ANDROID): b"timestamp,question id,question type,question text,question answer options,answer,event",
+    (SURVEY_TIMINGS, IOS): b"timestamp,question id,question type,question text,question answer options,answer,event",
+    (TEXTS_LOG, ANDROID): b"timestamp,hashed phone number,sent vs received,message length,time sent",
+    (VOICE_RECORDING, ANDROID): None,
+    (VOICE_RECORDING, IOS): None,
+    (WIFI, ANDROID): b"hashed MAC,frequency,RSSI",
+}
+
+# milliseconds between rows, high frequency sensors are sampled several times per second.
+ROW_INTERVALS = defaultdict(lambda: 1000, {
+    ACCELEROMETER: 100, GYRO: 100, MAGNETOMETER: 100, DEVICEMOTION: 100, GPS: 1000,
+})
+
+# identifiers and survey answers files are a single row, wifi is one scan.
+SINGLE_ROW_STREAMS = {IDENTIFIERS, SURVEY_ANSWERS}
+
+
+def synthetic_row(data_stream: str, os_type: str, timestamp: int, random: Random) -> bytes:
+    """ One row of plausible data, in the column order of the stream's header. """
+    r = random.random
+    if data_stream in (ACCELEROMETER, GYRO):
+        values = b"%.6f,%.6f,%.6f" % (r() * 2 - 1, r() * 2 - 1, r() * 20 - 10)
+        return b"%d,unknown,%s" % (timestamp, values) if os_type == ANDROID else b"%d,%s" % (timestamp, values)
+    if data_stream == MAGNETOMETER:
+        return b"%d,%.6f,%.6f,%.6f" % (timestamp, r() * 100, r() * 100, r() * 100)
+    if data_stream == DEVICEMOTION:
+        return b"%d," % timestamp + b",".join(b"%.6f" % r() for _ in range(16))
+    if data_stream == GPS:
+        return b"%d,%.7f,%.7f,%.3f,%.1f" % (timestamp, 42 + r(), -71 - r(), r() * 50, r() * 30)
+    if data_stream == BLUETOOTH:
+        return b"%d,%032x,-%d" % (timestamp, random.getrandbits(128), random.randint(30, 100))
+    if data_stream == CALL_LOG:
+        return b"%032x,Outgoing Call,%d,%d" % (random.getrandbits(128), timestamp, random.randint(0, 600))
+    if data_stream == TEXTS_LOG:
+        return b"%d,%032x,sent SMS,%d,%d" % (timestamp, random.getrandbits(128), random.randint(1, 160), timestamp)
+    if data_stream == WIFI:
+        return b"%032x,%d,-%d" % (random.getrandbits(128), random.choice((2412, 5180)), random.randint(30, 90))
+    if data_stream == POWER_STATE:
+        return b"%d,Screen turned on" % timestamp + (b",0.%d" % random.randint(10, 99) if os_type == IOS else b"")
+    if data_stream in (PROXIMITY, REACHABILITY):
+        return b"%d,%s" % (timestamp, random.choice((b"NearUser", b"NotNearUser", b"wifi", b"cellular")))
+    if data_stream == IOS_LOG_FILE:
+        return b"%d,ABCDEF12-3456,%d,0.%d,didEnterBackground,,,,," % (
+            timestamp, random.randint(10000, 99999), random.randint(10, 99)
+        )
+    if data_stream == SURVEY_TIMINGS:
+        return b"%d,%032x,radio_button,How are you?,Fine;Not fine,Fine,user answered" % (
+            timestamp, random.getrandbits(128)
+        )
+    if data_stream == SURVEY_ANSWERS:
+        return b"%032x,radio_button,How are you?,Fine;Not fine,Fine" % random.getrandbits(128)
+    if data_stream == IDENTIFIERS:
+        return b"patient,%032x,,device,%s,10,product,brand,hardware,manufacturer,model,2.4" % (
+            random.getrandbits(128), os_type.encode()
+        )
+    raise Exception(f"no synthetic data for {data_stream}")
+
+
+def synthetic_file(
+    data_stream: str, os_type: str, patient_id: str, survey_object_id: str, timestamp: int,
+    row_count: int, random: Random
+) -> Tuple[str, bytes]:
+    """ Returns the s3 path (as uploaded by the app, without the study object id) and contents of a
+    synthetic file. """
+    folder = DATA_STREAM_TO_S3_FILE_NAME_STRING[data_stream]
+    header = STREAM_HEADERS[(data_stream, os_type)]
+
+    if data_stream == IDENTIFIERS:
+        # the identifiers file has its timestamp (in seconds) in the file name
+        path = f"{patient_id}/identifiers_{timestamp // 1000}.csv"
+    elif data_stream in SURVEY_DATA_FILES:
+        path = f"{patient_id}/{folder}/{survey_object_id}/{timestamp}.csv"
+    elif data_stream in (VOICE_RECORDING, IMAGE_FILE):
+        path = f"{patient_id}/{folder}/{survey_object_id}/{timestamp}.{'mp4' if os_type == ANDROID else 'wav'}"
+    elif data_stream == AMBIENT_AUDIO:
+        path = f"{patient_id}/{folder}/{timestamp}.mp4"
+    else:
+        path = f"{patient_id}/{folder}/{timestamp}.csv"
+
+    if data_stream == ANDROID_LOG_FILE:
+        lines = [header] + [
+            b"%d %s" % (timestamp + i * ROW_INTERVALS[data_stream], random.choice((
+                b"Beiwe: app started", b"Timer: alarm fired", b"bluetooth Failure, device is off",
+                b"uploading files",
+            ))) for i in range(row_count)
+        ]
+        return path, b"\n".join(lines)
+    if header is None:
+        # binary files (audio, images), the contents are irrelevant
+        return path, bytes(random.getrandbits(8) for _ in range(row_count * 32))
+
+    row_count = 1 if data_stream in SINGLE_ROW_STREAMS else row_count
+    rows = [
+        synthetic_row(data_stream, os_type, timestamp + i * ROW_INTERVALS[data_stream], random)
+        for i in range(row_count)
+    ]
+    # the wifi file (as written by the app) ends in a newline
+    return path, header + b"\n" + b"\n".join(rows) + (b"\n" if data_stream == WIFI else b"")
+
+
+#
+## Measurement
+#
+
+class QueryCounter:
+    """ Counts database queries from all threads, the pipeline runs queries on its thread pools. """
+
+    def __init__(self):
+        self.count = 0
+        self._lock = Lock()
+        self._execute = CursorWrapper.execute
+        self._executemany = CursorWrapper.executemany
+
+    def __enter__(self):
+        counter = self
+
+        def execute(cursor, *args, **kwargs):
+            with counter._lock:
+                counter.count += 1
+            return counter._execute(cursor, *args, **kwargs)
+
+        def executemany(cursor, *args, **kwargs):
+            with counter._lock:
+                counter.count += 1
+            return counter._executemany(cursor, *args, **kwargs)
+
+        self.patches = [patch.object(CursorWrapper, "execute", execute),
+                        patch.object(CursorWrapper, "executemany", executemany)]
+        for p in self.patches:
+            p.start()
+        return self
+
+    def __exit__(self, *args):
+        for p in self.patches:
+            p.stop()
+
+
+def measure(
+    results: List[dict], data_stream: str, os_type: str, stage: str, function: Callable,
+    files: int, rows: int, byte_count: int
+):
+    """ Runs function once, appends the measurements to results. """
+    reset_peak_rss()
+    with QueryCounter() as query_counter:
+        start = perf_counter()
+        function()
+        seconds = perf_counter() - start
+    results.append({
+        "data_stream": data_stream,
+        "os": os_type,
+        "stage": stage,
+        "files": files,
+        "rows": rows,
+        "bytes": byte_count,
+        "seconds": round(seconds, 6),
+        "rows_per_second": round(rows / seconds, 1) if seconds and rows else None,
+        "bytes_per_second": round(byte_count / seconds, 1) if seconds else None,
+        "peak_rss_bytes": get_peak_rss(),
+        "db_queries": query_counter.count,
+    })
+
+
+#
+## The benchmark
+#
+
+def benchmark_stream(
+    results: List[dict], study, survey, data_stream: str, os_type: str, file_count: int,
+    row_count: int, random: Random
+):
+    participant = Participant(
+        patient_id=generate_easy_alphanumeric_string(),
+        os_type=Participant.ANDROID_API if os_type == ANDROID else Participant.IOS_API,
+        study=study,
+        device_id="benchmark",
+    )
+    participant.set_password("benchmark")  # saves
+
+    # one file per hour, like the apps upload
+    files = upload_synthetic_files(
+        study, survey, participant, data_stream, os_type, START_TIMESTAMP, file_count, row_count, random
+    )
+    files_to_process = list(participant.files_to_process.order_by("pk").select_related("study", "participant"))
+
+    total_bytes = sum(len(contents) for _, contents in files)
+    # binary files have no rows
+    is_csv = STREAM_HEADERS[(data_stream, os_type)] is not None
+    total_rows = count_rows(files) if is_csv else 0
+
+    files_for_processing = []
+    measure(
+        results, data_stream, os_type, "download",
+        lambda: files_for_processing.extend(FileForProcessing(ftp) for ftp in files_to_process),
+        file_count, total_rows, total_bytes
+    )
+
+    if is_csv:
+        # process_csv_data modifies the FileForProcessing, give it copies.
+        copies = [FileForProcessing.__new__(FileForProcessing) for _ in files_for_processing]
+        for copy, original in zip(copies, files_for_processing):
+            copy.__dict__.update(original.__dict__)
+        measure(
+            results, data_stream, os_type, "process_csv_data",
+            lambda: [process_csv_data(copy) for copy in copies], file_count, total_rows, total_bytes
+        )
+        benchmark_steps(results, data_stream, os_type, files_for_processing, total_rows, total_bytes)
+
+    files_for_processing.clear()
+    benchmark_pipeline(results, data_stream, os_type, "pipeline", participant, file_count, total_rows, total_bytes)
+
+    if is_csv:
+        # the same hours again, offset so that the new rows fall between the existing rows.
+        overlap_offset = 1000 + ROW_INTERVALS[data_stream] // 2
+        files = upload_synthetic_files(
+            study, survey, participant, data_stream, os_type, START_TIMESTAMP + overlap_offset,
+            file_count, row_count, random
+        )
+        benchmark_pipeline(
+            results, data_stream, os_type, "pipeline_merge", participant, file_count, count_rows(files),
+            sum(len(contents) for _, contents in files)
+        )
+
+
+def upload_synthetic_files(
+    study, survey, participant: Participant, data_stream: str, os_type: str, start_timestamp: int,
+    file_count: int, row_count: int, random: Random
+) -> List[Tuple[str, bytes]]:
+    """ Uploads one synthetic file per hour and creates their FileToProcess objects. """
+    files = [
+        synthetic_file(
+            data_stream, os_type, participant.patient_id, survey.object_id,
+            start_timestamp + i * 3600 * 1000, row_count, random
+        )
+        for i in range(file_count)
+    ]
+    for path, contents in files:
+        s3_upload(path, contents, study.object_id)
+        FileToProcess.append_file_for_processing(path, study.object_id, participant=participant)
+    return files
+
+
+def count_rows(files: List[Tuple[str, bytes]]) -> int:
+    return sum(contents.rstrip(b"\n").count(b"\n") for _, contents in files)
+
+
+def benchmark_pipeline(
+    results: List[dict], data_stream: str, os_type: str, stage: str, participant: Participant,
+    file_count: int, total_rows: int, total_bytes: int
+):
+    """ Processes all of the participant's files with FileProcessingPipeline. """
+    pipeline = FileProcessingPipeline(ErrorHandler())
+    try:
+        measure(
+            results, data_stream, os_type, stage,
+            lambda: pipeline.process_participant(participant), file_count, total_rows, total_bytes
+        )
+    finally:
+        pipeline.close()
+    pipeline.error_handler.raise_errors()
+    if participant.files_to_process.exists():
+        raise Exception(f"{data_stream} ({os_type}): files were not processed")
+
+
+def benchmark_steps(
+    results: List[dict], data_stream: str, os_type: str, files_for_processing: list,
+    total_rows: int, total_bytes: int
+):
+    """ Measures the individual steps of process_csv_data and the uploader on all files at once. """
+    file_count = len(files_for_processing)
+    paths = [ffp.file_to_process.s3_file_path for ffp in files_for_processing]
+    contents = [ffp.file_contents for ffp in files_for_processing]
+    if data_stream == ANDROID_LOG_FILE:
+        measure(
+            results, data_stream, os_type, "data_fix",
+            lambda: [fix_app_log_file(c, p) for c, p in zip(contents, paths)],
+            file_count, total_rows, total_bytes
+        )
+        contents = [fix_app_log_file(c, p) for c, p in zip(contents, paths)]
+
+    parsed = []
+    measure(
+        results, data_stream, os_type, "csv_to_list",
+        lambda: parsed.extend((header, list(rows)) for header, rows in map(csv_to_list, contents)),
+        file_count, total_rows, total_bytes
+    )
+
+    fixes = {
+        (CALL_LOG, ANDROID): lambda header, rows, path: fix_call_log_csv(header, rows),
+        (WIFI, ANDROID): fix_wifi_csv,
+        (IDENTIFIERS, ANDROID): fix_identifier_csv,
+        (IDENTIFIERS, IOS): fix_identifier_csv,
+        (SURVEY_TIMINGS, ANDROID): fix_survey_timings,
+        (SURVEY_TIMINGS, IOS): fix_survey_timings,
+    }
+    if (data_stream, os_type) in fixes:
+        fix = fixes[(data_stream, os_type)]
+        fixed = deepcopy(parsed)
+        measure(
+            results, data_stream, os_type, "data_fix",
+            lambda: [fix(header, rows, path) for (header, rows), path in zip(fixed, paths)],
+            file_count, total_rows, total_bytes
+        )
+        parsed = [(fix(header, rows, path), rows) for (header, rows), path in zip(parsed, paths)]
+
+    all_rows = [row for _, rows in parsed for row in rows]
+    header = parsed[0][0]
+    binned = []
+    measure(
+        results, data_stream, os_type, "binify_csv_rows",
+        lambda: binned.extend(binify_csv_rows(all_rows, "study", "patient", data_stream, header).values()),
+        file_count, total_rows, total_bytes
+    )
+
+    # the remaining steps happen per chunk in the uploader, and the sort modifies the lines.
+    bins = []
+    measure(
+        results, data_stream, os_type, "convert_unix_to_human_readable_timestamps",
+        lambda: bins.extend(convert_unix_to_human_readable_timestamps(header, rows)[1] for rows in binned),
+        file_count, total_rows, total_bytes
+    )
+    for lines in bins:
+        # shuffle the lines of each chunk so that the sort has work to do.
+        Random(0).shuffle(lines)
+    measure(
+        results, data_stream, os_type, "sort_by_timestamp",
+        lambda: [lines.sort(key=itemgetter(0)) for lines in bins], file_count, total_rows, total_bytes
+    )
+    measure(
+        results, data_stream, os_type, "construct_csv_string_from_lines",
+        lambda: [construct_csv_string_from_lines(header, [line for _, line in lines]) for lines in bins],
+        file_count, total_rows, total_bytes
+    )
+
+
+def run_benchmark(file_count: int, row_count: int, data_streams: List[str]) -> dict:
+    study = Study.create_with_object_id(
+        name="benchmark study", encryption_key="thequickbrownfoxjumpsoverthelazy",
+        forest_param=ForestParam.objects.get(default=True),
+    )
+    survey = Survey.create_with_object_id(study=study, survey_type=Survey.TRACKING_SURVEY)
+    random = Random(0)
+    results = []
+    for data_stream, os_type in STREAM_HEADERS:
+        if data_stream in data_streams:
+            print(f"{datetime.now()} benchmarking {data_stream} ({os_type})")
+            benchmark_stream(results, study, survey, data_stream, os_type, file_count, row_count, random)
+
+    return {
+        "benchmark": "file_processing",
+        "created_on": datetime.now().isoformat(),
+        "python_version": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {
+            "files_per_stream": file_count,
+            "rows_per_file": row_count,
+            "columnar_file_processing": COLUMNAR_FILE_PROCESSING,
+        },
+        "results": results,
+    }
+
+
+def print_results(report: dict):
+    print()
+    print(f"{'stream':<18}{'os':<9}{'stage':<44}{'rows/s':>14}{'MB/s':>10}{'peak RSS MB':>13}{'queries':>9}")
+    for r in report["results"]:
+        print(
+            f"{r['data_stream']:<18}{r['os']:<9}{r['stage']:<44}{r['rows_per_second'] or 0:>14,.0f}"
+            f"{(r['bytes_per_second'] or 0) / 1024 / 1024:>10.2f}{r['peak_rss_bytes'] / 1024 / 1024:>13.1f}"
+            f"{r['db_queries']:>9}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="run_script.py benchmark_file_processing")
+    parser.add_argument("--files", type=int, default=4, help="files per data stream (one per hour)")
+    parser.add_argument("--rows", type=int, default=20000, help="rows per file")
+    parser.add_argument("--streams", nargs="*", default=ALL_DATA_STREAMS, choices=ALL_DATA_STREAMS)
+    parser.add_argument("--output", default="benchmark_file_processing.json")
+    args = parser.parse_args(sys.argv[2:])
+
+    if connection.vendor != "sqlite":
+        print("This benchmark creates a temporary SQLite database, it cannot run on a postgres deployment.")
+        exit(1)
+
+    # A temporary database on disk (not in memory) so that the pipeline's threads can share it.
+    with TemporaryDirectory() as database_folder, patch("libs.s3.conn", DummyS3Client()):
+        connection.settings_dict.setdefault("TEST", {})["NAME"] = f"{database_folder}/benchmark.sqlite"
+        old_database_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            report = run_benchmark(args.files, args.rows, args.streams)
+        finally:
+            connection.creation.destroy_test_db(old_database_name, verbosity=0)
+
+    print_results(report)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nresults written to {args.output}")
+
+
+main()
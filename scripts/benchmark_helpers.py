@@ -0,0 +1,26 @@
+""" Helpers shared by the benchmark scripts, this module is not a script itself. """
+import resource
+import sys
+
+
+def reset_peak_rss():
+    """ Resets the kernel's peak RSS (VmHWM) for this process, Linux only. """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def get_peak_rss() -> int:
+    """ Peak RSS in bytes since the last reset_peak_rss (or process start where that is not supported). """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # ru_maxrss is kilobytes on Linux, bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
@@ -0,0 +1,254 @@
+"""
+Benchmarks the zip file streamers used for data downloads (the data access API's get_data).
+
+Run it like any other script:
+    python run_script.py benchmark_zip_streamer [--files N] [--file-size BYTES] [--latency MS]
+        [--bandwidth MB/s] [--output path.json]
+
+This script creates its own temporary SQLite database (it refuses to run against postgres) and
+replaces the S3 connection with an in-memory stand-in that simulates network latency and bandwidth,
+so it never touches real data.  Files are encrypted and decrypted exactly as they are in production.
+
+It streams the same files through each zip generator and reports the time to the first byte, the
+total time, throughput, and peak RSS:
+    zip_generator - the original streamer (ThreadPool(3).imap_unordered, a study query per file),
+        kept in this script as the baseline.
+    prefetching_zip_generator - the streamer used by get_data, with the configured prefetch settings.
+
+Results are printed as a table and written as json (default: benchmark_zip_streamer.json).
+"""
+import argparse
+import json
+import platform
+import sys
+from datetime import datetime, timedelta
+from io import BytesIO
+from multiprocessing.pool import ThreadPool
+from os import urandom
+from tempfile import TemporaryDirectory
+from time import perf_counter, sleep
+from typing import Callable, Dict, List, Tuple
+from unittest.mock import patch
+from zipfile import ZIP_STORED, ZipFile
+
+from django.db import connection
+
+from config.settings import DATA_ACCESS_API_PREFETCH_BYTES, DATA_ACCESS_API_PREFETCH_WORKERS
+from constants.data_stream_constants import ACCELEROMETER
+from database.study_models import Study
+from database.tableau_api_models import ForestParam
+from libs.s3 import s3_retrieve_stream, s3_upload
+from libs.streaming_bytes_io import StreamingBytesIO
+from libs.streaming_zip import (determine_file_name, DummyError, prefetching_zip_generator,
+    write_zip_entry)
+from scripts.benchmark_helpers import get_peak_rss, reset_peak_rss
+
+
+class LatentLocalS3:
+    """ An in-memory stand-in for the boto3 S3 client that waits like a network connection would:
+    latency seconds per request, plus the transfer time at bandwidth bytes per second. """
+
+    def __init__(self, latency: float, bandwidth: float):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.objects: Dict[str, bytes] = {}
+
+    def put_object(self, Body: bytes, Bucket: str, Key: str, **kwargs):
+        self.objects[Key] = Body
+
+    def get_object(self, Bucket: str, Key: str, **kwargs):
+        sleep(self.latency + len(self.objects[Key]) / self.bandwidth)
+        return {"Body": BytesIO(self.objects[Key]), "ContentLength": len(self.objects[Key])}
+
+
+def batch_retrieve_s3(chunk: dict) -> Tuple[dict, List[bytes]]:
+    """ Data is returned in the form (chunk, blocks of the decrypted file). """
+    # the blocks are never joined, that would be another copy of the file.
+    return chunk, list(s3_retrieve_stream(
+        chunk["chunk_path"],
+        study_object_id=Study.objects.get(id=chunk["study_id"]).object_id,
+        raw_path=True,
+    ))
+
+
+# The original zip streamer, kept here as the benchmark's baseline (get_data uses
+# prefetching_zip_generator).
+def zip_generator(files_list, construct_registry=False):
+    """ Pulls in data from S3 in a multithreaded network operation, constructs a zip file of that
+    data. This is a generator, advantage is it starts returning data (file by file, but wrapped
+    in zip compression) almost immediately. """
+
+    processed_files = set()
+    duplicate_files = set()
+    pool = ThreadPool(3)
+    # 3 Threads has been heuristically determined to be a good value, it does not cause the server
+    # to be overloaded, and provides more-or-less the maximum data download speed.  This was tested
+    # on an m4.large instance (dual core, 8GB of ram).
+    file_registry = {}
+
+    zip_output = StreamingBytesIO()
+    zip_input = ZipFile(zip_output, mode="w", compression=ZIP_STORED, allowZip64=True)
+
+    try:
+        # chunks_and_content is a list of tuples, of the chunk and the content of the file.
+        # chunksize (which is a keyword argument of imap, not to be confused with Beiwe Chunks)
+        # is the size of the batches that are handed to the pool. We always want to add the next
+        # file to retrieve to the pool asap, so we want a chunk size of 1.
+        # (In the documentation there are comments about the timeout, it is irrelevant under this construction.)
+        chunks_and_content = pool.imap_unordered(batch_retrieve_s3, files_list, chunksize=1)
+        total_size = 0
+        for chunk, file_blocks in chunks_and_content:
+            if construct_registry:
+                file_registry[chunk['chunk_path']] = chunk["chunk_hash"]
+            file_name = determine_file_name(chunk)
+            if file_name in processed_files:
+                duplicate_files.add((file_name, chunk['chunk_path']))
+                continue
+            processed_files.add(file_name)
+
+            write_zip_entry(zip_input, file_name, file_blocks)
+            # These can be large, and we don't want them sticking around in memory as we wait for the yield
+            del file_blocks, chunk
+
+            x = zip_output.getvalue()
+            total_size += len(x)
+            # print "%s: %sK, %sM" % (random_id, total_size / 1024, total_size / 1024 / 1024)
+            yield x  # yield the (compressed) file information
+            del x
+            zip_output.empty()
+
+        if construct_registry:
+            zip_input.writestr("registry", json.dumps(file_registry))
+            yield zip_output.getvalue()
+            zip_output.empty()
+
+        # close, then yield all remaining data in the zip.
+        zip_input.close()
+        yield zip_output.getvalue()
+    except DummyError:
+        # The try-except-finally block is here to guarantee the Threadpool is closed and terminated.
+        # we don't handle any errors, we just re-raise any error that shows up.
+        # (with statement does not work.)
+        raise
+    finally:
+        # We rely on the finally block to ensure that the threadpool will be closed and terminated,
+        # and also to print an error to the log if we need to.
+        pool.close()
+        pool.terminate()
+
+
+def create_chunks(file_count: int, file_size: int) -> List[dict]:
+    """ Uploads the files to the S3 stand-in, returns them as ChunkRegistry values dicts. """
+    study = Study.create_with_object_id(
+        name="benchmark study", encryption_key="thequickbrownfoxjumpsoverthelazy",
+        forest_param=ForestParam.objects.get(default=True),
+    )
+    chunks = []
+    for i in range(file_count):
+        time_bin = datetime(2020, 10, 5) + timedelta(hours=i)
+        chunk_path = f"{study.object_id}/benchmark/{ACCELEROMETER}/{time_bin.isoformat()}.csv"
+        s3_upload(chunk_path, urandom(file_size), study.object_id, raw_path=True)
+        chunks.append({
+            "chunk_path": chunk_path,
+            "chunk_hash": str(i),
+            "data_type": ACCELEROMETER,
+            "participant__patient_id": "benchmark",
+            "study_id": study.id,
+            "survey__object_id": None,
+            "time_bin": time_bin,
+            "file_size": file_size,
+        })
+    return chunks
+
+
+def measure(name: str, generator_function: Callable, chunks: List[dict]) -> dict:
+    """ Consumes the whole zip file from a generator, as the web server would. """
+    reset_peak_rss()
+    start = perf_counter()
+    time_to_first_byte = None
+    total_bytes = 0
+    for data in generator_function(iter(chunks), construct_registry=True):
+        if time_to_first_byte is None and data:
+            time_to_first_byte = perf_counter() - start
+        total_bytes += len(data)
+    seconds = perf_counter() - start
+    return {
+        "generator": name,
+        "files": len(chunks),
+        "bytes": total_bytes,
+        "time_to_first_byte_seconds": round(time_to_first_byte, 6),
+        "seconds": round(seconds, 6),
+        "bytes_per_second": round(total_bytes / seconds, 1),
+        "peak_rss_bytes": get_peak_rss(),
+    }
+
+
+def run_benchmark(file_count: int, file_size: int, latency: float, bandwidth: float) -> dict:
+    chunks = create_chunks(file_count, file_size)
+    results = []
+    for name, generator_function in (
+        ("zip_generator", zip_generator),
+        ("prefetching_zip_generator", prefetching_zip_generator),
+    ):
+        print(f"{datetime.now()} benchmarking {name}")
+        results.append(measure(name, generator_function, chunks))
+
+    return {
+        "benchmark": "zip_streamer",
+        "created_on": datetime.now().isoformat(),
+        "python_version": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {
+            "files": file_count,
+            "file_size": file_size,
+            "latency_seconds": latency,
+            "bandwidth_bytes_per_second": bandwidth,
+            "prefetch_workers": DATA_ACCESS_API_PREFETCH_WORKERS,
+            "prefetch_bytes": DATA_ACCESS_API_PREFETCH_BYTES,
+        },
+        "results": results,
+    }
+
+
+def print_results(report: dict):
+    print()
+    print(f"{'generator':<28}{'first byte s':>14}{'total s':>10}{'MB/s':>10}{'peak RSS MB':>13}")
+    for r in report["results"]:
+        print(
+            f"{r['generator']:<28}{r['time_to_first_byte_seconds']:>14.3f}{r['seconds']:>10.3f}"
+            f"{r['bytes_per_second'] / 1024 / 1024:>10.2f}{r['peak_rss_bytes'] / 1024 / 1024:>13.1f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="run_script.py benchmark_zip_streamer")
+    parser.add_argument("--files", type=int, default=200)
+    parser.add_argument("--file-size", type=int, default=1024 * 1024, help="bytes per file")
+    parser.add_argument("--latency", type=float, default=20, help="milliseconds per S3 request")
+    parser.add_argument("--bandwidth", type=float, default=50, help="MB/s per S3 connection")
+    parser.add_argument("--output", default="benchmark_zip_streamer.json")
+    args = parser.parse_args(sys.argv[2:])
+
+    if connection.vendor != "sqlite":
+        print("This benchmark creates a temporary SQLite database, it cannot run on a postgres deployment.")
+        exit(1)
+
+    latency = args.latency / 1000
+    bandwidth = args.bandwidth * 1024 * 1024
+    # A temporary database on disk (not in memory) so that the zip_generator's threads can share it.
+    with TemporaryDirectory() as database_folder, \
+            patch("libs.s3.conn", LatentLocalS3(latency, bandwidth)):
+        connection.settings_dict.setdefault("TEST", {})["NAME"] = f"{database_folder}/benchmark.sqlite"
+        old_database_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            report = run_benchmark(args.files, args.file_size, latency, bandwidth)
+        finally:
+            connection.creation.destroy_test_db(old_database_name, verbosity=0)
+
+    print_results(report)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nresults written to {args.output}")
+
+
+main()
@@ -8,7 +8,8 @@ from typing import List
 from collections import Counter
 
 from constants.data_stream_constants import CHUNKABLE_FILES
-from database.data_access_models import ChunkRegistry, FileToProcess
+from database.data_access_models import ChunkRegistry, ChunkTimeRange, FileToProcess
+from database.user_models import Participant
 
 print("""
 This script can take quite a while to run, it depends on the size of the ChunkRegistry database table.
@@ -39,6 +40,9 @@ DEBUG = False
 if DEBUG:
     print("\nRUNNING IN DEBUG MODE, NO DESTRUCTIVE ACTIONS WILL BE TAKEN.\n")
 
+# participants who have had chunks deleted, their chunk time ranges are recalculated at the end.
+affected_participant_ids = set()
+
 
 def run():
     duplicate_chunks, duplicate_media = get_duplicates()
@@ -48,6 +52,10 @@ def run():
 
     fix_duplicates(duplicate_chunks)
 
+    print(f"Recalculating chunk time ranges for {len(affected_participant_ids)} participant(s).")
+    for participant in Participant.objects.filter(id__in=affected_participant_ids):
+        ChunkTimeRange.recalculate_participant(participant)
+
 
 def get_duplicates() -> (List[str], List[str]):
     print("Getting duplicates...")
@@ -112,6 +120,9 @@ def remove_all_but_one_chunk(chunk_path: str):
     print(remaining_id)
     print(f"Deleting {len(chunk_ids)} duplicate instance(s) for {chunk_path}.")
     if not DEBUG:
+        affected_participant_ids.update(
+            ChunkRegistry.objects.filter(id__in=chunk_ids).values_list("participant_id", flat=True)
+        )
         ChunkRegistry.objects.filter(id__in=chunk_ids).delete()
 
 
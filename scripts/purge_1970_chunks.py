@@ -1,5 +1,5 @@
 from constants.data_stream_constants import AMBIENT_AUDIO, IMAGE_FILE, VOICE_RECORDING
-from database.data_access_models import ChunkRegistry
+from database.data_access_models import ChunkRegistry, ChunkTimeRange
 
 from datetime import datetime
 import pytz
@@ -46,5 +46,7 @@ if bad_chunks:
     if y_n.lower() == "y":
         print("success case")
         ChunkRegistry.objects.filter(pk__in=[chunk.pk for chunk in bad_chunks]).delete()
+        for participant in {chunk.participant for chunk in bad_chunks}:
+            ChunkTimeRange.recalculate_participant(participant)
 else:
     print("No obviously corrupted chunk registries were found.")
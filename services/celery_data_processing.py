@@ -1,11 +1,12 @@
 from datetime import datetime, timedelta
 
-from config.settings import FILE_PROCESS_PAGE_SIZE
 from constants.celery_constants import DATA_PROCESSING_CELERY_QUEUE
 from database.user_models import Participant
 from libs.celery_control import (get_processing_active_job_ids, processing_celery_app,
     safe_apply_async)
-from libs.file_processing.file_processing_core import do_process_user_file_chunks
+from libs.file_processing.file_processing_core import FileProcessingPipeline
+from libs.key_caches import get_key_cache_stats
+from libs.s3 import get_s3_metrics
 from libs.sentry import make_error_sentry, SentryTypes
 
 
@@ -67,42 +68,26 @@ def celery_process_file_chunks(participant_id):
     # this probably has something to do with the fact that celery forks, so possibly picking
     # a different mode would impact this.  Or we can just exit the python process.
     try:
-        time_start = datetime.now()
         participant = Participant.objects.get(id=participant_id)
         
-        number_bad_files = 0
         error_sentry = make_error_sentry(
             sentry_type=SentryTypes.data_processing, tags={'user_id': participant.patient_id}
         )
         print("processing files for %s" % participant.patient_id)
         
-        while True:
-            previous_number_bad_files = number_bad_files
-            starting_length = participant.files_to_process.exclude(deleted=True).count()
-            
-            print("%s processing %s, %s files remaining" % (datetime.now(), participant.patient_id, starting_length))
-            number_bad_files += do_process_user_file_chunks(
-                    page_size=FILE_PROCESS_PAGE_SIZE,
-                    error_handler=error_sentry,
-                    position=number_bad_files,
-                    participant=participant,
-            )
-            # If no files were processed, quit processing
-            if participant.files_to_process.exclude(deleted=True).count() == starting_length:
-                if previous_number_bad_files == number_bad_files:
-                    # 2 Cases:
-                    #   1) every file broke, blow up. (would cause infinite loop otherwise).
-                    #   2) no new files.
-                    break
-                else:
-                    continue
-            
+        # this process exits after one participant (below), so its pipeline's pools are not reused.
+        pipeline = FileProcessingPipeline(error_sentry)
+        try:
             # put maximum time limit per user
-            if (time_start - datetime.now()).total_seconds() > 60*60*3:
-                break
+            pipeline.process_participant(participant, time_limit=timedelta(hours=3))
+        finally:
+            pipeline.close()
+            print("file processing stats:", pipeline.get_stats())
     except Exception as e:
         print(f"Error running data processing: {e}")
     finally:
+        print("key cache stats:", get_key_cache_stats())
+        print("s3 metrics:", get_s3_metrics())
         print(
             "Data processing task completed. Exiting to clean up memory. You can safely ignore the "
             "immediately following \"Worker exited prematurely: exitcode 0\" error message."
@@ -16,7 +16,8 @@ from constants.forest_constants import ForestTaskStatus, ForestTree
 from database.data_access_models import ChunkRegistry
 from database.tableau_api_models import ForestTask
 from libs.celery_control import forest_celery_app, safe_apply_async
-from libs.s3 import s3_retrieve
+from libs.key_caches import get_key_cache_stats
+from libs.s3 import get_s3_metrics, s3_retrieve_to_file
 from libs.sentry import make_error_sentry, SentryTypes
 from libs.streaming_zip import determine_file_name
 
@@ -153,6 +154,8 @@ def celery_run_forest(forest_task_id):
                 raise
     
     log("task.status:", task.status)
+    log("key cache stats:", get_key_cache_stats())
+    log("s3 metrics:", get_s3_metrics())
     if task.stacktrace:
         log("stacktrace:", task.stacktrace)
     
@@ -178,14 +181,19 @@ def create_local_data_files(task, chunks):
 def batch_create_file(singular_task_chunk):
     task: ForestTask  # chunk is a values dict
     task, chunk = singular_task_chunk
-    contents = s3_retrieve(chunk["chunk_path"], chunk["study__object_id"], raw_path=True)
     file_name = os.path.join(
         task.data_input_path,
         determine_file_name(chunk),
     )
     os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    # the file is decrypted straight to disk, block by block.
     with open(file_name, "xb") as f:
-        f.write(contents)
+        try:
+            s3_retrieve_to_file(chunk["chunk_path"], chunk["study__object_id"], f, raw_path=True)
+        except BaseException:
+            # don't leave a partial file behind, a retry would fail to create it.
+            os.remove(file_name)
+            raise
 
 
 def enqueue_forest_task(**kwargs):
@@ -0,0 +1,39 @@
+# add the root of the project into the path to allow cd-ing into this folder and running the script.
+from os.path import abspath
+from sys import path
+
+path.insert(0, abspath(__file__).rsplit('/', 2)[0])
+
+# Uploads files from the upload spool (see the UPLOAD_SPOOL_DIRECTORY setting) to S3 and queues them
+# for data processing.  Keep this running on every frontend server that has the upload spool enabled,
+# e.g. under supervisord.  Multiple copies on the same server are safe, only one flushes at a time.
+#   python services/upload_spool_flusher.py          runs forever
+#   python services/upload_spool_flusher.py once     flushes the spool once and exits
+from sys import argv
+from time import sleep
+
+from libs.sentry import make_error_sentry, SentryTypes
+from libs.upload_spool import flush_upload_spool, upload_spool_enabled
+
+# seconds between flushes.
+FLUSH_INTERVAL = 5
+
+
+def main():
+    if not upload_spool_enabled():
+        raise Exception("The upload spool is not enabled, set UPLOAD_SPOOL_DIRECTORY.")
+    
+    run_once = len(argv) > 1 and argv[1] == "once"
+    while True:
+        # errors are reported and suppressed, the files stay in the spool and are retried.
+        with make_error_sentry(sentry_type=SentryTypes.elastic_beanstalk):
+            flushed = flush_upload_spool()
+            if flushed:
+                print(f"flushed {flushed} uploads.")
+        if run_once:
+            return
+        sleep(FLUSH_INTERVAL)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 import subprocess
 from datetime import date, datetime
+from io import BytesIO
 
 from django.http.response import HttpResponse
 from django.utils import timezone
@@ -427,6 +428,16 @@ class DummyThreadPool():
         # does not use kwargs
         return map(func, iterable)
     
+    def map(self, func, iterable, **kwargs):
+        return list(map(func, iterable))
+    
+    def apply_async(self, func, args=(), kwds={}, **kwargs):
+        # like a real AsyncResult, an exception is raised when the result is retrieved.
+        try:
+            return DummyAsyncResult(func(*args, **kwds))
+        except Exception as e:
+            return DummyAsyncResult(None, exception=e)
+    
     # @staticmethod
     def terminate(self):
         pass
@@ -436,6 +447,63 @@ class DummyThreadPool():
         pass
 
 
+class DummyAsyncResult():
+    """ The result of DummyThreadPool.apply_async, which runs the function immediately. """
+    def __init__(self, value, exception: Exception = None) -> None:
+        self.value = value
+        self.exception = exception
+    
+    def ready(self):
+        return True
+    
+    def get(self, timeout=None):
+        if self.exception is not None:
+            raise self.exception
+        return self.value
+
+
+class DummyS3Client():
+    """ An in-memory stand-in for the boto3 S3 client, implementing the calls made in libs.s3.
+    Patch it in with patch("libs.s3.conn", DummyS3Client()). """
+    
+    def __init__(self, minimum_part_size: int = 5 * 1024 * 1024) -> None:
+        self.minimum_part_size = minimum_part_size
+        self.objects = {}
+        self.multipart_uploads = {}
+    
+    def put_object(self, Body, Bucket, Key, **kwargs):
+        self.objects[Key] = bytes(Body)
+    
+    def get_object(self, Bucket, Key, **kwargs):
+        return {"Body": BytesIO(self.objects[Key]), "ContentLength": len(self.objects[Key])}
+    
+    def head_object(self, Bucket, Key, **kwargs):
+        return {"ContentLength": len(self.objects[Key])}
+    
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        upload_id = generate_easy_alphanumeric_string()
+        self.multipart_uploads[upload_id] = {}
+        return {"UploadId": upload_id}
+    
+    def upload_part(self, Body, Bucket, Key, UploadId, PartNumber, **kwargs):
+        self.multipart_uploads[UploadId][PartNumber] = bytes(Body)
+        return {"ETag": f'"{UploadId}-{PartNumber}"'}
+    
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        uploaded_parts = self.multipart_uploads.pop(UploadId)
+        part_numbers = [part["PartNumber"] for part in MultipartUpload["Parts"]]
+        if part_numbers != sorted(part_numbers):
+            raise Exception("InvalidPartOrder")
+        parts = [uploaded_parts[part_number] for part_number in part_numbers]
+        # like S3, all but the last part must be at least the minimum part size
+        if any(len(part) < self.minimum_part_size for part in parts[:-1]):
+            raise Exception("EntityTooSmall")
+        self.objects[Key] = b"".join(parts)
+    
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        self.multipart_uploads.pop(UploadId, None)
+
+
 def render_test_html_file(response: HttpResponse, url: str):
     print("\nwriting url:", url)
     
@@ -1,10 +1,14 @@
 import json
 from copy import copy
-from datetime import datetime
+from datetime import date, datetime, time, timedelta
 from io import BytesIO
+from os import listdir
+from tempfile import TemporaryDirectory
 from typing import List
 from unittest.mock import MagicMock, patch
 
+from Cryptodome.Cipher import AES
+from dateutil import tz
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.db import models
 from django.forms.fields import NullBooleanField
@@ -12,13 +16,16 @@ from django.http.response import FileResponse, HttpResponse, HttpResponseRedirec
 from django.urls import reverse
 from django.utils import timezone
 
+from api.dashboard_api import dashboard_daily_bytes_matrix, dashboard_participant_daily_bytes
+from api.study_api import get_values_for_participants_table
 from api.tableau_api import FINAL_SERIALIZABLE_FIELD_NAMES
 from config.jinja2 import easy_url
 from constants.celery_constants import (ANDROID_FIREBASE_CREDENTIALS, BACKEND_FIREBASE_CREDENTIALS,
     IOS_FIREBASE_CREDENTIALS)
 from constants.common_constants import BEIWE_PROJECT_ROOT
 from constants.dashboard_constants import COMPLETE_DATA_STREAM_DICT
-from constants.data_stream_constants import ALL_DATA_STREAMS, SURVEY_TIMINGS
+from constants.data_stream_constants import (ACCELEROMETER, ALL_DATA_STREAMS, GPS, SURVEY_TIMINGS,
+    WIFI)
 from constants.datetime_constants import API_DATE_FORMAT
 from constants.message_strings import (NEW_PASSWORD_8_LONG, NEW_PASSWORD_MISMATCH,
     NEW_PASSWORD_RULES_FAIL, PASSWORD_RESET_SUCCESS, TABLEAU_API_KEY_IS_DISABLED,
@@ -26,17 +33,20 @@ from constants.message_strings import (NEW_PASSWORD_8_LONG, NEW_PASSWORD_MISMATC
 from constants.researcher_constants import ALL_RESEARCHER_TYPES, ResearcherRole
 from constants.testing_constants import (ADMIN_ROLES, ALL_TESTING_ROLES, ANDROID_CERT, BACKEND_CERT,
     IOS_CERT, ResearcherRole)
-from database.data_access_models import ChunkRegistry, FileToProcess
-from database.profiling_models import DecryptionKeyError
+from database.data_access_models import ChunkRegistry, ChunkTimeRange, DataManifest, FileToProcess
+from database.profiling_models import DecryptionKeyError, UploadTracking
 from database.schedule_models import Intervention
 from database.security_models import ApiKey
 from database.study_models import DeviceSettings, Study, StudyField
 from database.survey_models import Survey
 from database.system_models import FileAsText
-from database.user_models import Participant, ParticipantFCMHistory, Researcher
+from database.tableau_api_models import SummaryStatisticDaily
+from database.user_models import Participant, ParticipantFCMHistory, ParticipantFieldValue, Researcher
 from libs.copy_study import format_study
-from libs.encryption import get_RSA_cipher
-from libs.security import generate_easy_alphanumeric_string
+from libs.encryption import decrypt_server, get_RSA_cipher
+from libs.security import encode_base64, generate_easy_alphanumeric_string
+from libs.upload_spool import (flush_upload_spool, QUARANTINE_DIRECTORY_NAME, SPOOL_FILE_EXTENSION,
+    spool_upload, SpooledFilesQuarantined)
 from tests.common import (BasicSessionTestCase, CommonTestCase, DataApiTest, ParticipantSessionTest,
     RedirectSessionApiTest, ResearcherSessionTest, SmartRequestsTestCase)
 from tests.helpers import DummyThreadPool
@@ -340,6 +350,65 @@ class TestDashboardStream(ResearcherSessionTest):
         for data_stream in ALL_DATA_STREAMS:
             resp = self.smart_get_status_code(200, self.session_study.id, data_stream)
             self.assert_present(COMPLETE_DATA_STREAM_DICT[data_stream], resp.content)
+    
+    def test_data_stream_bytes(self):
+        self.set_session_study_relation()
+        ChunkTimeRange.objects.create(
+            study=self.session_study,
+            participant=self.default_participant,
+            data_type=ACCELEROMETER,
+            earliest_time_bin=datetime(2020, 10, 1, 12, tzinfo=tz.UTC),
+            latest_time_bin=datetime(2020, 10, 5, 12, tzinfo=tz.UTC),
+        )
+        SummaryStatisticDaily.objects.create(
+            participant=self.default_participant, date=date(2020, 10, 4), beiwe_accelerometer_bytes=123456
+        )
+        resp = self.smart_get_status_code(200, self.session_study.id, ACCELEROMETER)
+        self.assert_present("123,456", resp.content)
+    
+    def test_daily_bytes_matrix(self):
+        participant_1 = self.generate_participant(self.session_study)
+        participant_2 = self.generate_participant(self.session_study)
+        other_study = self.generate_study("other study")
+        other_participant = self.generate_participant(other_study)
+        days = [date(2020, 10, 1), date(2020, 10, 2), date(2020, 10, 3)]
+        SummaryStatisticDaily.objects.create(participant=participant_1, date=days[1], beiwe_gps_bytes=5)
+        SummaryStatisticDaily.objects.create(participant=participant_2, date=days[0], beiwe_gps_bytes=0)
+        # no gps data, other study, outside of the dates
+        SummaryStatisticDaily.objects.create(participant=participant_2, date=days[2], beiwe_wifi_bytes=1)
+        SummaryStatisticDaily.objects.create(participant=other_participant, date=days[1], beiwe_gps_bytes=9)
+        SummaryStatisticDaily.objects.create(participant=participant_1, date=date(2020, 10, 4), beiwe_gps_bytes=9)
+        
+        self.assertEqual(
+            dashboard_daily_bytes_matrix(
+                self.session_study.id, [participant_1.id, participant_2.id, other_participant.id], GPS,
+                days, self.session_study.timezone,
+            ),
+            [[None, 5, None], [0, None, None], [None, None, None]],
+        )
+        self.assertEqual(
+            dashboard_daily_bytes_matrix(
+                self.session_study.id, [participant_1.id], GPS, [], self.session_study.timezone
+            ),
+            [[]],
+        )
+    
+    def test_daily_bytes_matrix_chunkregistry_fallback(self):
+        days = [date(2020, 10, 1), date(2020, 10, 2), date(2020, 10, 3)]
+        for day, file_size in ((days[0], 3), (days[0], 4), (days[1], 100), (days[2], 8)):
+            self.generate_chunk_registry(
+                self.session_study, self.default_participant, GPS, file_size=file_size,
+                time_bin=datetime.combine(day, time(12), tz.UTC),
+            )
+        # the summary byte count takes precedence, days without one or with NULL use the chunks
+        SummaryStatisticDaily.objects.create(participant=self.default_participant, date=days[1], beiwe_gps_bytes=5)
+        SummaryStatisticDaily.objects.create(participant=self.default_participant, date=days[2], beiwe_wifi_bytes=1)
+        self.assertEqual(
+            dashboard_daily_bytes_matrix(
+                self.session_study.id, [self.default_participant.id], GPS, days, self.session_study.timezone
+            ),
+            [[7, 5, 8]],
+        )
 
 
 # FIXME: this page renders with almost no data
@@ -349,6 +418,56 @@ class TestPatientDisplay(ResearcherSessionTest):
     def test_patient_display(self):
         self.set_session_study_relation()
         self.smart_get_status_code(200, self.session_study.id, self.default_participant.patient_id)
+    
+    def test_patient_display_bytes(self):
+        self.set_session_study_relation()
+        ChunkTimeRange.objects.create(
+            study=self.session_study,
+            participant=self.default_participant,
+            data_type=GPS,
+            earliest_time_bin=datetime(2020, 10, 1, 12, tzinfo=tz.UTC),
+            latest_time_bin=datetime(2020, 10, 5, 12, tzinfo=tz.UTC),
+        )
+        SummaryStatisticDaily.objects.create(
+            participant=self.default_participant, date=date(2020, 10, 4),
+            beiwe_gps_bytes=123456, beiwe_accelerometer_bytes=654321,
+        )
+        resp = self.smart_get_status_code(
+            200, self.session_study.id, self.default_participant.patient_id
+        )
+        self.assert_present("123,456", resp.content)
+        self.assert_present("654,321", resp.content)
+        self.assert_present("10/01/2020", resp.content)
+    
+    def test_participant_daily_bytes(self):
+        days = [date(2020, 10, 1), date(2020, 10, 2)]
+        SummaryStatisticDaily.objects.create(
+            participant=self.default_participant, date=days[0], beiwe_gps_bytes=5, beiwe_wifi_bytes=0
+        )
+        SummaryStatisticDaily.objects.create(
+            participant=self.default_participant, date=date(2020, 10, 3), beiwe_gps_bytes=9
+        )
+        self.assertEqual(
+            dashboard_participant_daily_bytes(self.default_participant.id, days, self.session_study.timezone),
+            {(GPS, days[0]): 5, (WIFI, days[0]): 0},
+        )
+        self.assertEqual(
+            dashboard_participant_daily_bytes(self.default_participant.id, [], self.session_study.timezone), {}
+        )
+    
+    def test_participant_daily_bytes_chunkregistry_fallback(self):
+        days = [date(2020, 10, 1), date(2020, 10, 2)]
+        for day, data_type, file_size in ((days[0], GPS, 100), (days[0], WIFI, 3), (days[1], GPS, 4)):
+            self.generate_chunk_registry(
+                self.session_study, self.default_participant, data_type, file_size=file_size,
+                time_bin=datetime.combine(day, time(12), tz.UTC),
+            )
+        # the gps summary byte count takes precedence, the NULL wifi count and the missing day don't
+        SummaryStatisticDaily.objects.create(participant=self.default_participant, date=days[0], beiwe_gps_bytes=5)
+        self.assertEqual(
+            dashboard_participant_daily_bytes(self.default_participant.id, days, self.session_study.timezone),
+            {(GPS, days[0]): 5, (WIFI, days[0]): 3, (GPS, days[1]): 4},
+        )
 
 
 # system_admin_pages.manage_researchers
@@ -1174,9 +1293,102 @@ class TestStudyParticipantApi(ResearcherSessionTest):
             "data": [[self.SOME_TIMESTAMP.strftime(API_DATE_FORMAT),
                       self.default_participant.patient_id,
                       True,
-                      "ANDROID"]]
+                      "ANDROID"]],
+            "next_cursor": None,
         }
         self.assertEqual(content, correct_content)
+    
+    def generate_table_participants(self) -> List[Participant]:
+        # created_on and os_type have ties, which are ordered by primary key
+        participants = []
+        for i, patient_id in enumerate(["dddd", "aaaa", "eeee", "bbbb", "cccc"]):
+            participant = self.generate_participant(self.session_study, patient_id, ios=i % 2 == 0)
+            participant.update(created_on=self.SOME_TIMESTAMP + timedelta(days=i // 2))
+            participants.append(participant)
+        participants[1].update(device_id="")
+        return participants
+    
+    def get_table(self, **parameters) -> dict:
+        resp = self.smart_get_status_code(
+            200, self.session_study.id, data={**self.DEFAULT_PARAMETERS, **parameters}
+        )
+        return json.loads(resp.content.decode())
+    
+    def test_keyset_pages_match_offset_pages(self):
+        self.set_session_study_relation(ResearcherRole.researcher)
+        self.generate_table_participants()
+        for column in range(4):
+            for direction in ("asc", "desc"):
+                sort = {self.COLUMN_ORDER_KEY: column, self.ORDER_DIRECTION_KEY: direction}
+                everyone = [row[1] for row in self.get_table(length=100, **sort)["data"]]
+                self.assertEqual(len(everyone), 5)
+                # follow the cursors through pages of 2, and compare with pages found by offset
+                pages, cursor = [], None
+                for start in (0, 2, 4):
+                    parameters = dict(start=start, length=2, **sort)
+                    if cursor:
+                        parameters["cursor"] = cursor
+                    content = self.get_table(**parameters)
+                    offset_content = self.get_table(start=start, length=2, **sort)
+                    self.assertEqual(content["data"], offset_content["data"])
+                    pages.extend(row[1] for row in content["data"])
+                    cursor = content["next_cursor"]
+                self.assertIsNone(cursor)
+                self.assertEqual(pages, everyone)
+    
+    def test_sort_ties_ordered_by_pk(self):
+        self.set_session_study_relation(ResearcherRole.researcher)
+        self.generate_table_participants()
+        for column, direction, patient_ids in (
+            (0, "asc", ["dddd", "aaaa", "eeee", "bbbb", "cccc"]),
+            (3, "desc", ["cccc", "eeee", "dddd", "bbbb", "aaaa"]),
+        ):
+            sort = {self.COLUMN_ORDER_KEY: column, self.ORDER_DIRECTION_KEY: direction}
+            content = self.get_table(length=100, **sort)
+            self.assertEqual([row[1] for row in content["data"]], patient_ids)
+    
+    def test_invalid_cursor_falls_back_to_offset(self):
+        self.set_session_study_relation(ResearcherRole.researcher)
+        self.generate_table_participants()
+        offset_page = self.get_table(start=2, length=2)["data"]
+        # a cursor from another sort order
+        other_sort_cursor = self.get_table(length=2, **{self.COLUMN_ORDER_KEY: 0})["next_cursor"]
+        for cursor in ("", "not json", "5", "[1, true]", "[1, true, 7, 1]", other_sort_cursor):
+            self.assertEqual(self.get_table(start=2, length=2, cursor=cursor)["data"], offset_page)
+    
+    def test_search(self):
+        self.set_session_study_relation(ResearcherRole.researcher)
+        self.generate_table_participants()
+        for search, patient_ids in (
+            ("AAA", ["aaaa"]),
+            ("and", ["bbbb", "aaaa"]),
+            ("os", ["eeee", "dddd", "cccc"]),
+            ("zzz", []),
+        ):
+            content = self.get_table(**{self.SEARCH_PARAMETER: search, self.ORDER_DIRECTION_KEY: "desc"})
+            self.assertEqual(content["recordsTotal"], 5)
+            self.assertEqual(content["recordsFiltered"], len(patient_ids))
+            self.assertEqual([row[1] for row in content["data"]], patient_ids)
+    
+    def test_field_values_and_interventions(self):
+        self.set_session_study_relation(ResearcherRole.researcher)
+        participants = self.generate_table_participants()
+        intervention = self.generate_intervention(self.session_study, "an intervention")
+        field_a = self.generate_study_field(self.session_study, "a field")
+        self.generate_study_field(self.session_study, "b field")
+        for participant in participants:
+            self.generate_intervention_date(participant, intervention)
+        ParticipantFieldValue.objects.create(participant=participants[1], field=field_a, value="hello")
+        
+        # the query count does not depend on the number of participants on the page
+        with self.assertNumQueries(4):
+            data, _ = get_values_for_participants_table(self.session_study, 0, 5, 1, False, "")
+        self.assertEqual(data[0][1:], [
+            "aaaa", False, "ANDROID", self.DEFAULT_DATE.strftime(API_DATE_FORMAT), "hello", None
+        ])
+        self.assertEqual(data[1][1:], [
+            "bbbb", True, "ANDROID", self.DEFAULT_DATE.strftime(API_DATE_FORMAT), None, None
+        ])
 
 
 class TestInterventionsPage(ResearcherSessionTest):
@@ -1865,8 +2077,8 @@ class TestGetData(DataApiTest):
         The database connection breaks throwing errors on queries that should succeed.
         The iterator inside the zip file generator generally fails, and the zip file is empty.
 
-    You Must Patch libs.streaming_zip.s3_retrieve
-        Otherwise s3_retrieve will fail due to the patch is tests.common.
+    You Must Patch libs.streaming_zip.s3_retrieve_stream
+        Otherwise s3_retrieve_stream will fail due to the patch is tests.common.
     """
     
     def test_s3_patch_present(self):
@@ -1973,6 +2185,8 @@ class TestGetData(DataApiTest):
         # Please retain this behavior and consult me (Eli, Biblicabeebli) during review.  This means a
         # change has occurred to the multithreading, and is probably related to an obscure but known
         # memory leak in the data access api download enpoint that is relevant on large downloads. """
+        # (prefetching_zip_generator does not query the database on its download threads, so with
+        # it the download succeeds.)
         try:
             self._test_downloads_and_file_naming()
         except AssertionError as e:
@@ -2011,10 +2225,10 @@ class TestGetData(DataApiTest):
         self.assertEqual(i2, 2)
         self.assert_present(b"registry{}", file_content)
     
-    @patch("libs.streaming_zip.s3_retrieve")
-    def _test_downloads_and_file_naming(self, s3_retrieve: MagicMock):
+    @patch("libs.streaming_zip.s3_retrieve_stream")
+    def _test_downloads_and_file_naming(self, s3_retrieve_stream: MagicMock):
         # basics
-        s3_retrieve.return_value = self.SIMPLE_FILE_CONTENTS
+        s3_retrieve_stream.return_value = [self.SIMPLE_FILE_CONTENTS]
         self.set_session_study_relation(ResearcherRole.researcher)
         
         # need to test all data types
@@ -2023,12 +2237,12 @@ class TestGetData(DataApiTest):
             file_contents = self.generate_chunkregistry_and_download(data_type, path, time_bin)
             # this is an 'in' test because the file name is part of the zip file, as cleartext
             self.assertIn(output_name.encode(), file_contents)
-            self.assertIn(s3_retrieve.return_value, file_contents)
+            self.assertIn(self.SIMPLE_FILE_CONTENTS, file_contents)
     
-    @patch("libs.streaming_zip.s3_retrieve")
-    def _test_data_streams(self, s3_retrieve: MagicMock):
+    @patch("libs.streaming_zip.s3_retrieve_stream")
+    def _test_data_streams(self, s3_retrieve_stream: MagicMock):
         # basics
-        s3_retrieve.return_value = self.SIMPLE_FILE_CONTENTS
+        s3_retrieve_stream.return_value = [self.SIMPLE_FILE_CONTENTS]
         self.set_session_study_relation(ResearcherRole.researcher)
         file_path = "some_file_path.csv"
         basic_args = ("accelerometer", file_path, "2020-10-05 02:00Z")
@@ -2059,10 +2273,10 @@ class TestGetData(DataApiTest):
         )
         self.assertEqual(file_contents, self.EMPTY_ZIP)
     
-    @patch("libs.streaming_zip.s3_retrieve")
-    def _test_registry_doesnt_download(self, s3_retrieve: MagicMock):
+    @patch("libs.streaming_zip.s3_retrieve_stream")
+    def _test_registry_doesnt_download(self, s3_retrieve_stream: MagicMock):
         # basics
-        s3_retrieve.return_value = self.SIMPLE_FILE_CONTENTS
+        s3_retrieve_stream.return_value = [self.SIMPLE_FILE_CONTENTS]
         self.set_session_study_relation(ResearcherRole.researcher)
         file_path = "some_file_path.csv"
         basic_args = ("accelerometer", file_path, "2020-10-05 02:00Z")
@@ -2097,10 +2311,10 @@ class TestGetData(DataApiTest):
             *basic_args, registry="", status_code=400
         )
     
-    @patch("libs.streaming_zip.s3_retrieve")
-    def _test_time_bin(self, s3_retrieve: MagicMock):
+    @patch("libs.streaming_zip.s3_retrieve_stream")
+    def _test_time_bin(self, s3_retrieve_stream: MagicMock):
         # basics
-        s3_retrieve.return_value = self.SIMPLE_FILE_CONTENTS
+        s3_retrieve_stream.return_value = [self.SIMPLE_FILE_CONTENTS]
         self.set_session_study_relation(ResearcherRole.researcher)
         basic_args = ("accelerometer", "some_file_path.csv", "2020-10-05 02:00Z")
         
@@ -2175,10 +2389,10 @@ class TestGetData(DataApiTest):
             *basic_args, query_time_bin_start="2020-10-05 01:00:00", status_code=400
         )
     
-    @patch("libs.streaming_zip.s3_retrieve")
-    def _test_user_query(self, s3_retrieve: MagicMock):
+    @patch("libs.streaming_zip.s3_retrieve_stream")
+    def _test_user_query(self, s3_retrieve_stream: MagicMock):
         # basics
-        s3_retrieve.return_value = self.SIMPLE_FILE_CONTENTS
+        s3_retrieve_stream.return_value = [self.SIMPLE_FILE_CONTENTS]
         self.set_session_study_relation(ResearcherRole.researcher)
         basic_args = ("accelerometer", "some_file_path.csv", "2020-10-05 02:00Z")
         
@@ -2282,6 +2496,175 @@ class TestGetData(DataApiTest):
         return b"".join(bytes_list)
 
 
+
+class TestGetDataManifest(DataApiTest):
+    ENDPOINT_NAME = "data_access_api.get_data_manifest"
+    
+    def generate_chunks(self) -> List[ChunkRegistry]:
+        return [
+            self.generate_chunk_registry(
+                self.session_study, self.default_participant, "accelerometer", path=f"path{i}.csv",
+                hash_value=f"hash{i}", time_bin=f"2020-10-05 0{i}:00Z", file_size=i + 1,
+            )
+            for i in range(3)
+        ]
+    
+    def test_no_relation(self):
+        resp = self.smart_post(study_pk=self.session_study.id)
+        self.assertEqual(resp.status_code, 403)
+        self.assertFalse(DataManifest.objects.exists())
+    
+    def test_empty(self):
+        self.set_session_study_relation(ResearcherRole.researcher)
+        resp = self.smart_post(study_pk=self.session_study.id)
+        self.assertEqual(resp.status_code, 200)
+        manifest_json = json.loads(resp.content)
+        self.assertEqual(manifest_json["files"], [])
+        manifest = DataManifest.objects.get(token=manifest_json["token"])
+        self.assertEqual(manifest.study, self.session_study)
+        self.assertEqual(manifest.researcher, self.session_researcher)
+        self.assertEqual(manifest.get_chunk_ids(), [])
+    
+    def test_files(self):
+        self.set_session_study_relation(ResearcherRole.researcher)
+        chunks = self.generate_chunks()
+        resp = self.smart_post(study_pk=self.session_study.id)
+        self.assertEqual(resp.status_code, 200)
+        manifest_json = json.loads(resp.content)
+        self.assertEqual(
+            manifest_json["files"],
+            [
+                {
+                    "index": i,
+                    "file_name": f"{self.default_participant.patient_id}/accelerometer/"
+                                 f"2020-10-05 0{i}_00_00+00_00.csv",
+                    "chunk_path": f"path{i}.csv",
+                    "chunk_hash": f"hash{i}",
+                    "file_size": i + 1,
+                }
+                for i in range(3)
+            ]
+        )
+        manifest = DataManifest.objects.get(token=manifest_json["token"])
+        self.assertEqual(manifest.get_chunk_ids(), [chunk.pk for chunk in chunks])
+    
+    def test_registry_and_query(self):
+        self.set_session_study_relation(ResearcherRole.researcher)
+        self.generate_chunks()
+        resp = self.smart_post(
+            study_pk=self.session_study.id,
+            registry=json.dumps({"path0.csv": "hash0"}),
+            time_end="2020-10-05T01:00:00",
+        )
+        self.assertEqual(resp.status_code, 200)
+        files = json.loads(resp.content)["files"]
+        self.assertEqual([f["chunk_path"] for f in files], ["path1.csv"])
+    
+    def test_expired_manifests_are_deleted(self):
+        self.set_session_study_relation(ResearcherRole.researcher)
+        old_manifest = DataManifest.create_for_chunks(self.session_study, self.session_researcher, [])
+        old_manifest.update(expires=timezone.now() - timedelta(seconds=1))
+        self.smart_post(study_pk=self.session_study.id)
+        self.assertFalse(DataManifest.objects.filter(pk=old_manifest.pk).exists())
+        self.assertEqual(DataManifest.objects.count(), 1)
+
+
+class TestGetDataRange(DataApiTest):
+    """ See the warnings on TestGetData, the same patches are required here. """
+    ENDPOINT_NAME = "data_access_api.get_data_range"
+    
+    SIMPLE_FILE_CONTENTS = b"this is the file content you are looking for"
+    
+    def setUp(self) -> None:
+        super().setUp()
+        self.set_session_study_relation(ResearcherRole.researcher)
+        self.chunks = [
+            self.generate_chunk_registry(
+                self.session_study, self.default_participant, "accelerometer", path=f"path{i}.csv",
+                hash_value=f"hash{i}", time_bin=f"2020-10-05 0{i}:00Z",
+            )
+            for i in range(4)
+        ]
+        self.manifest = DataManifest.create_for_chunks(
+            self.session_study, self.session_researcher, [chunk.pk for chunk in self.chunks]
+        )
+    
+    def file_name(self, i: int) -> bytes:
+        return f"{self.default_participant.patient_id}/accelerometer/2020-10-05 0{i}_00_00+00_00.csv".encode()
+    
+    @patch("libs.streaming_zip.s3_retrieve_stream")
+    @patch("libs.streaming_zip.ThreadPool")
+    def download(self, threadpool: MagicMock, s3_retrieve_stream: MagicMock, status_code=200, **post_kwargs):
+        threadpool.return_value = DummyThreadPool()
+        s3_retrieve_stream.return_value = [self.SIMPLE_FILE_CONTENTS]
+        post_kwargs.setdefault("manifest_token", self.manifest.token)
+        resp = self.smart_post(study_pk=self.session_study.id, **post_kwargs)
+        self.assertEqual(resp.status_code, status_code)
+        if status_code != 200:
+            return None
+        return b"".join(resp.streaming_content)
+    
+    def test_whole_manifest(self):
+        zip_file = self.download()
+        for i in range(4):
+            self.assert_present(self.file_name(i), zip_file)
+        self.assert_present(b'"path3.csv": "hash3"', zip_file)
+    
+    def test_range(self):
+        zip_file = self.download(start="1", end="3", web_form="")
+        for i in (1, 2):
+            self.assert_present(self.file_name(i), zip_file)
+        for i in (0, 3):
+            self.assert_not_present(self.file_name(i), zip_file)
+        # the files are in manifest order
+        self.assertLess(zip_file.index(self.file_name(1)), zip_file.index(self.file_name(2)))
+    
+    def test_manifest_parsed_once(self):
+        with patch.object(
+            DataManifest, "get_chunk_ids", autospec=True, side_effect=DataManifest.get_chunk_ids
+        ) as get_chunk_ids:
+            zip_file = self.download()
+        get_chunk_ids.assert_called_once()
+        self.assert_present(self.file_name(3), zip_file)
+    
+    def test_range_past_the_end(self):
+        zip_file = self.download(start="3", end="100", web_form="")
+        self.assert_present(self.file_name(3), zip_file)
+        self.assert_not_present(self.file_name(2), zip_file)
+    
+    def test_empty_range(self):
+        self.assertEqual(self.download(start="2", end="2", web_form=""), TestGetData.EMPTY_ZIP)
+    
+    def test_deleted_chunks_are_skipped(self):
+        self.chunks[1].delete()
+        zip_file = self.download(web_form="")
+        self.assert_not_present(self.file_name(1), zip_file)
+        self.assert_present(self.file_name(2), zip_file)
+    
+    def test_chunks_in_range_batches(self):
+        with patch("database.data_access_models.DATA_MANIFEST_QUERY_BATCH_SIZE", 3):
+            chunk_ids = [chunk["pk"] for chunk in self.manifest.chunks_in_range(0, 4)]
+        self.assertEqual(chunk_ids, [chunk.pk for chunk in self.chunks])
+    
+    def test_invalid_ranges(self):
+        self.download(status_code=400, start="a")
+        self.download(status_code=400, start="-1")
+        self.download(status_code=400, start="3", end="2")
+    
+    def test_bad_token(self):
+        self.download(status_code=404, manifest_token="not a token")
+        self.download(status_code=404, manifest_token="")
+    
+    def test_expired(self):
+        self.manifest.update(expires=timezone.now() - timedelta(seconds=1))
+        self.download(status_code=404)
+    
+    def test_other_researchers_manifest(self):
+        other_researcher = self.generate_researcher()
+        self.manifest.update(researcher=other_researcher)
+        self.download(status_code=404)
+
+
 class TestParticipantSetPassword(ParticipantSessionTest):
     ENDPOINT_NAME = "mobile_api.set_password"
     
@@ -2493,6 +2876,63 @@ class TestMobileUpload(ParticipantSessionTest):
         )
         self.assert_no_files_to_process
 
+    
+    @patch("libs.upload_spool.s3_upload_encrypted")
+    @patch("database.user_models.Participant.get_private_key")
+    def test_upload_spool(self, get_private_key: MagicMock, s3_upload_encrypted: MagicMock):
+        get_private_key.return_value = self.PRIVATE_KEY
+        aes_key = b"0123456789abcdef"
+        iv = b"fedcba9876543210"
+        data = AES.new(aes_key, AES.MODE_CBC, iv=iv).encrypt(b"a,b,c" + bytes([11]) * 11)
+        encrypted_file = b"\n".join([
+            encode_base64(self.PUBLIC_KEY.encrypt(encode_base64(aes_key), None)[0]),
+            encode_base64(iv) + b":" + encode_base64(data),
+        ])
+        file_name = f"{self.session_participant.patient_id}_accel_1601863200000.csv"
+        
+        with TemporaryDirectory() as spool_directory, \
+                patch("libs.upload_spool.UPLOAD_SPOOL_DIRECTORY", spool_directory):
+            self.smart_post_status_code(200, file_name=file_name, file=encrypted_file.decode())
+            # the file is confirmed to the device before it is on S3 or in FileToProcess
+            self.assert_no_files_to_process
+            s3_upload_encrypted.assert_not_called()
+            self.assertEqual(len(listdir(spool_directory)), 1)
+            # a repeated upload of a spooled file is a duplicate
+            self.smart_post_status_code(200, file_name=file_name, file=encrypted_file.decode())
+            self.assertEqual(len(listdir(spool_directory)), 1)
+            
+            self.assertEqual(flush_upload_spool(), 1)
+            self.assert_one_file_to_process
+            s3_file_path = FileToProcess.objects.get().s3_file_path
+            self.assertEqual(s3_file_path, f"{self.session_study.object_id}/{file_name.replace('_', '/')}")
+            self.assertEqual(UploadTracking.objects.get().file_size, len(b"a,b,c"))
+            key_path, encrypted_data = s3_upload_encrypted.call_args[0]
+            self.assertEqual(key_path, s3_file_path)
+            self.assertEqual(decrypt_server(encrypted_data, self.session_study.object_id), b"a,b,c")
+            self.assertEqual(listdir(spool_directory), [".flush_lock"])
+    
+    @patch("libs.upload_spool.s3_upload_encrypted")
+    def test_upload_spool_quarantine(self, s3_upload_encrypted: MagicMock):
+        deleted_participant = self.generate_participant(self.session_study)
+        with TemporaryDirectory() as spool_directory:
+            spool_upload("a/accel/1.csv", b"a,b,c", self.session_participant, spool_directory)
+            spool_upload("b/accel/1.csv", b"a,b,c", deleted_participant, spool_directory)
+            spool_upload("c/accel/1.csv", b"a,b,c", self.session_participant, spool_directory)
+            with open(f"{spool_directory}/truncated{SPOOL_FILE_EXTENSION}", "wb") as f:
+                f.write(b'{"s3_file_path": "d/accel/1.c')
+            deleted_participant.delete()
+            
+            # the unreadable and unregistrable uploads don't stop the others from being flushed
+            with self.assertRaises(SpooledFilesQuarantined):
+                flush_upload_spool(spool_directory)
+            self.assertEqual(
+                sorted(FileToProcess.objects.values_list("s3_file_path", flat=True)),
+                [f"{self.session_study.object_id}/a/accel/1.csv", f"{self.session_study.object_id}/c/accel/1.csv"],
+            )
+            self.assertEqual(sorted(listdir(spool_directory)), [".flush_lock", QUARANTINE_DIRECTORY_NAME])
+            self.assertEqual(len(listdir(f"{spool_directory}/{QUARANTINE_DIRECTORY_NAME}")), 2)
+            self.assertEqual(flush_upload_spool(spool_directory), 0)
+
 
 class TestGraph(ParticipantSessionTest):
     ENDPOINT_NAME = "mobile_pages.fetch_graph"
@@ -0,0 +1,424 @@
+from datetime import datetime, timedelta
+from operator import itemgetter
+from unittest import skipUnless
+from unittest.mock import patch
+
+from cronutils.error_handler import ErrorHandler
+from dateutil.tz import UTC
+
+from libs.file_processing.byte_budget import ByteBudget
+from constants.data_stream_constants import ACCELEROMETER, GPS
+from database.data_access_models import ChunkRegistry, FileToProcess
+from database.tableau_api_models import SummaryStatisticDaily
+from libs.file_processing.columnar_binning import (binify_csv_columnar, ColumnarBin,
+    COLUMNAR_ENGINE_AVAILABLE, merge_binned_rows)
+from libs.file_processing.data_qty_stats import (calculate_data_quantity_stats,
+    update_data_quantity_stats)
+from libs.file_processing.file_processing_core import binify_csv_rows, FileProcessingPipeline
+from libs.file_processing.utility_functions_csvs import (append_to_sorted_csv,
+    construct_csv_string, construct_csv_string_from_lines, csv_to_list, merge_into_sorted_csv,
+    unix_time_to_string)
+from libs.file_processing.utility_functions_simple import (convert_unix_to_human_readable_timestamps,
+    ensure_sorted_by_timestamp)
+from libs.s3 import s3_retrieve, s3_upload
+from tests.common import CommonTestCase
+from tests.helpers import DummyS3Client, DummyThreadPool
+
+
+HEADER = b"timestamp,accuracy,x,y,z"
+# two hours of data, out of order, with a duplicate, an empty line, and a missing timestamp
+ACCELEROMETER_FILE = HEADER + b"\n" + b"\n".join([
+    b"1601863200500,unknown,0.1,0.2,0.3",
+    b"1601866800001,unknown,1.1,1.2,1.3",
+    b"1601863200002,unknown,0.4,0.5,0.6",
+    b"",
+    b",unknown,9,9,9",
+    b"1601863200500,unknown,0.1,0.2,0.3",
+    b"1601866799999,unknown,0.7,0.8,0.9",
+    b"1601863200002,unknown,0.4,0.5,0.7",
+    b"1601866800001",
+]) + b"\n"
+
+
+def row_by_row_chunks(file_contents: bytes) -> dict:
+    """ The reference implementation: the row-by-row code path from process_csv_data through
+    chunk_not_exists_case. """
+    header, rows = csv_to_list(file_contents)
+    chunks = {}
+    for data_bin, bin_rows in binify_csv_rows(list(rows), "study", "user", "accelerometer", header).items():
+        updated_header, lines = convert_unix_to_human_readable_timestamps(header, bin_rows)
+        lines.sort(key=itemgetter(0))
+        chunks[data_bin] = construct_csv_string_from_lines(updated_header, [line for _, line in lines])
+    return chunks
+
+
+def columnar_chunks(file_contents: bytes) -> dict:
+    chunks = {}
+    for data_bin, columnar_bin in binify_csv_columnar(file_contents, "study", "user", "accelerometer", HEADER).items():
+        updated_header, _ = convert_unix_to_human_readable_timestamps(HEADER, [])
+        chunks[data_bin] = columnar_bin.construct_csv_string(updated_header)
+    return chunks
+
+
+@skipUnless(COLUMNAR_ENGINE_AVAILABLE, "numpy is not installed")
+class TestColumnarBinning(CommonTestCase):
+
+    def test_output_identical(self):
+        reference = row_by_row_chunks(ACCELEROMETER_FILE)
+        self.assertEqual(len(reference), 2)
+        self.assertEqual(reference, columnar_chunks(ACCELEROMETER_FILE))
+
+    def test_header_only(self):
+        self.assertEqual(binify_csv_columnar(HEADER, "study", "user", "accelerometer", HEADER), {})
+        self.assertEqual(binify_csv_columnar(HEADER + b"\n", "study", "user", "accelerometer", HEADER), {})
+
+    def test_declines_bad_timestamps(self):
+        for bad_line in (b"16018632OO500,unknown,0,0,0", b" 1601863200500,unknown,0,0,0", b"9" * 19):
+            file_contents = HEADER + b"\n" + bad_line
+            self.assertIsNone(binify_csv_columnar(file_contents, "study", "user", "accelerometer", HEADER))
+
+    def test_merge_with_row_by_row_data(self):
+        columnar = binify_csv_columnar(ACCELEROMETER_FILE, "study", "user", "accelerometer", HEADER)
+        columnar_bin = list(columnar.values())[0]
+        self.assertIsInstance(merge_binned_rows([], columnar_bin), ColumnarBin)
+
+        merged = merge_binned_rows([[b"1601863200000", b"a", b"b", b"c", b"d"]], columnar_bin)
+        self.assertIsInstance(merged, list)
+        self.assertEqual(len(merged), len(columnar_bin) + 1)
+
+
+class TestUtcTimeColumn(CommonTestCase):
+    
+    def test_matches_per_row_formatting(self):
+        timestamps = [b"1601863200000", b"1601863200001", b"1601863200001", b"1601863200999",
+                      b"1601863201050", b"0500", b"-5", b"1601866799999"]
+        rows = [[timestamp, b"x"] for timestamp in timestamps]
+        header, lines = convert_unix_to_human_readable_timestamps(b"timestamp,x", rows)
+        self.assertEqual(header, b"timestamp,UTC time,x")
+        for timestamp, (line_timestamp, line) in zip(timestamps, lines):
+            # the original implementation
+            row = [timestamp, b"x"]
+            row.insert(1, unix_time_to_string(int(timestamp) // 1000) + b".%03d" % (int(timestamp) % 1000))
+            self.assertEqual(line, b",".join(row))
+            self.assertEqual(line_timestamp, int(timestamp))
+        self.assertEqual(lines[0][1], b"1601863200000,2020-10-05T02:00:00.000,x")
+        # the rows are not modified
+        self.assertEqual(rows[0], [b"1601863200000", b"x"])
+    
+    def test_single_column_rows(self):
+        _, lines = convert_unix_to_human_readable_timestamps(b"timestamp", [[b"1601863200000"]])
+        self.assertEqual(lines, [(1601863200000, b"1601863200000,2020-10-05T02:00:00.000")])
+
+
+class TestChunkMerge(CommonTestCase):
+    HEADER = b"timestamp,UTC time,x"
+    EXISTING_CHUNK = HEADER + b"\n" + b"\n".join([
+        b"1000,1970-01-01T00:00:01.000,a",
+        b"1000,1970-01-01T00:00:01.000,b",
+        b"2000,1970-01-01T00:00:02.000,a",
+        b"3000,1970-01-01T00:00:03.000,a",
+    ])
+    
+    def full_sort(self, existing_chunk: bytes, new_rows: list) -> bytes:
+        header, old_rows = csv_to_list(existing_chunk)
+        old_rows = list(old_rows)
+        old_rows.extend(new_rows)
+        ensure_sorted_by_timestamp(old_rows)
+        return construct_csv_string(header, old_rows)
+    
+    def merge(self, existing_chunk: bytes, new_rows: list) -> bytes:
+        new_rows = sorted(new_rows, key=lambda row: int(row[0]))
+        return merge_into_sorted_csv(existing_chunk, [[(int(row[0]), b",".join(row)) for row in new_rows]])
+    
+    def assert_merge_matches(self, existing_chunk: bytes, new_lines: list):
+        new_rows = [line.split(b",") for line in new_lines]
+        self.assertEqual(
+            self.full_sort(existing_chunk, [list(row) for row in new_rows]),
+            self.merge(existing_chunk, new_rows),
+        )
+    
+    def test_append_after(self):
+        self.assert_merge_matches(self.EXISTING_CHUNK, [b"5000,1970-01-01T00:00:05.000,a", b"4000,1970-01-01T00:00:04.000,a"])
+    
+    def test_interleaved_with_duplicates(self):
+        self.assert_merge_matches(self.EXISTING_CHUNK, [
+            b"2000,1970-01-01T00:00:02.000,a",
+            b"2000,1970-01-01T00:00:02.000,b",
+            b"1000,1970-01-01T00:00:01.000,b",
+            b"0500,1970-01-01T00:00:00.500,a",
+            b"3000,1970-01-01T00:00:03.000,a",
+            b"3000,1970-01-01T00:00:03.000,a",
+        ])
+    
+    def test_empty_existing_chunk(self):
+        self.assert_merge_matches(self.HEADER, [b"1000,1970-01-01T00:00:01.000,a"])
+        self.assert_merge_matches(self.HEADER + b"\n", [b"1000,1970-01-01T00:00:01.000,a"])
+    
+    def test_unsorted_existing_chunk(self):
+        unsorted = self.HEADER + b"\n1000,x,a\n3000,x,a\n2500,x,a"
+        self.assertIsNone(self.merge(unsorted, [[b"2000", b"x", b"a"]]))
+    
+    def test_append_fast_path(self):
+        new_runs = [[(4000, b"4000,1970-01-01T00:00:04.000,a"), (5000, b"5000,1970-01-01T00:00:05.000,a")]]
+        self.assertEqual(append_to_sorted_csv(self.EXISTING_CHUNK, new_runs), merge_into_sorted_csv(self.EXISTING_CHUNK, new_runs))
+        # new data that overlaps the existing data can't be appended
+        self.assertIsNone(append_to_sorted_csv(self.EXISTING_CHUNK, [[(3000, b"3000,1970-01-01T00:00:03.000,b")]]))
+        self.assertIsNone(append_to_sorted_csv(self.HEADER, new_runs))
+    
+    def test_unchanged_chunk(self):
+        new_runs = [[(2000, b"2000,1970-01-01T00:00:02.000,a")]]
+        self.assertEqual(merge_into_sorted_csv(self.EXISTING_CHUNK, new_runs), self.EXISTING_CHUNK)
+
+
+class TestByteBudget(CommonTestCase):
+    
+    def test_budget(self):
+        budget = ByteBudget(100)
+        self.assertTrue(budget.try_acquire(60))
+        self.assertFalse(budget.try_acquire(50))
+        self.assertTrue(budget.try_acquire(40))
+        self.assertEqual(budget.in_flight, 100)
+        budget.release(100)
+        self.assertEqual(budget.in_flight, 0)
+        self.assertEqual(budget.peak, 100)
+    
+    def test_oversized_acquisition_runs_alone(self):
+        budget = ByteBudget(100)
+        self.assertTrue(budget.try_acquire(1))
+        self.assertFalse(budget.try_acquire(500))
+        budget.release(1)
+        self.assertTrue(budget.try_acquire(500))
+        self.assertFalse(budget.try_acquire(1))
+
+
+class TestDataQuantityStats(CommonTestCase):
+    # the study timezone is America/New_York, 12:00 UTC is the same day.
+    DAY_1 = datetime(2020, 10, 5, 12, tzinfo=UTC)
+    DAY_2 = datetime(2020, 10, 6, 12, tzinfo=UTC)
+    
+    def summary_bytes(self) -> list:
+        return list(SummaryStatisticDaily.objects.order_by("date").values_list(
+            "date", "beiwe_accelerometer_bytes", "beiwe_gps_bytes"
+        ))
+    
+    def test_deltas_match_full_calculation(self):
+        participant = self.default_participant
+        self.generate_chunk_registry(self.session_study, participant, ACCELEROMETER, time_bin=self.DAY_1, file_size=100)
+        self.generate_chunk_registry(self.session_study, participant, GPS, time_bin=self.DAY_1, file_size=10)
+        
+        # no summary exists for day 1, it is calculated in full
+        update_data_quantity_stats(participant, {(self.DAY_1, ACCELEROMETER): 100})
+        self.assertEqual(self.summary_bytes(), [(self.DAY_1.date(), 100, 10)])
+        
+        # an existing chunk grows, and a chunk is created on a new day
+        chunk = participant.chunk_registries.get(data_type=ACCELEROMETER)
+        chunk.update(file_size=150)
+        self.generate_chunk_registry(self.session_study, participant, GPS, time_bin=self.DAY_2, file_size=20)
+        update_data_quantity_stats(participant, {(self.DAY_1, ACCELEROMETER): 50, (self.DAY_2, GPS): 20})
+        incremental = self.summary_bytes()
+        self.assertEqual(incremental, [(self.DAY_1.date(), 150, 10), (self.DAY_2.date(), None, 20)])
+        
+        SummaryStatisticDaily.objects.all().delete()
+        calculate_data_quantity_stats(participant)
+        self.assertEqual(incremental, self.summary_bytes())
+    
+    def test_null_byte_count_calculated_in_full(self):
+        participant = self.default_participant
+        # forest creates summaries without byte counts
+        SummaryStatisticDaily.objects.create(participant=participant, date=self.DAY_1.date())
+        self.generate_chunk_registry(self.session_study, participant, ACCELEROMETER, time_bin=self.DAY_1, file_size=100)
+        self.generate_chunk_registry(
+            self.session_study, participant, ACCELEROMETER, time_bin=self.DAY_1 + timedelta(hours=1),
+            file_size=30,
+        )
+        update_data_quantity_stats(participant, {(self.DAY_1 + timedelta(hours=1), ACCELEROMETER): 30})
+        self.assertEqual(self.summary_bytes(), [(self.DAY_1.date(), 130, None)])
+
+
+class TestFileProcessingPipeline(CommonTestCase):
+    HEADER = b"timestamp,accuracy,x,y,z"
+    CHUNK_HEADER = b"timestamp,UTC time,accuracy,x,y,z"
+    # 2020-10-05T02:00:00 UTC, the start of a time bin
+    HOUR_1 = 1601863200000
+    HOUR_2 = HOUR_1 + 3600 * 1000
+    
+    def setUp(self):
+        self.s3 = DummyS3Client()
+        for patcher in (
+            patch("libs.s3.conn", self.s3),
+            # the test database can't be shared with other threads, every stage runs inline.
+            patch("libs.file_processing.file_processing_core.ThreadPool", DummyThreadPool),
+            patch("libs.file_processing.uploader.ThreadPool", DummyThreadPool),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.error_handler = ErrorHandler()
+    
+    def upload_file(self, timestamps: list, upload_to_s3: bool = True) -> FileToProcess:
+        """ Creates an accelerometer file to process, with a row for each timestamp. """
+        study = self.session_study
+        patient_id = self.default_participant.patient_id
+        s3_file_path = f"{study.object_id}/{patient_id}/accel/{timestamps[0]}.csv"
+        if upload_to_s3:
+            contents = self.HEADER + b"".join(b"\n%d,unknown,1,2,3" % t for t in timestamps)
+            s3_upload(s3_file_path, contents, study.object_id, raw_path=True)
+        return self.generate_file_to_process(s3_file_path)
+    
+    def chunk_line(self, timestamp: int) -> bytes:
+        return b"%d,%s,unknown,1,2,3" % (timestamp, unix_time_to_string(timestamp // 1000) + b".000")
+    
+    def chunk_contents(self, time_bin: int) -> bytes:
+        chunk = ChunkRegistry.objects.get(time_bin=datetime.fromtimestamp(time_bin // 1000, UTC))
+        return s3_retrieve(chunk.chunk_path, self.session_study.object_id, raw_path=True)
+    
+    def process(self) -> FileProcessingPipeline:
+        pipeline = FileProcessingPipeline(self.error_handler)
+        try:
+            pipeline.process_participant(self.default_participant)
+        finally:
+            pipeline.close()
+        return pipeline
+    
+    def test_process_participant(self):
+        self.upload_file([self.HOUR_1 + 2000, self.HOUR_1])
+        # the second file overlaps the first hour and extends into the second
+        self.upload_file([self.HOUR_1 + 1000, self.HOUR_1 + 2000, self.HOUR_2])
+        missing = self.upload_file([self.HOUR_2 + 5000], upload_to_s3=False)
+        self.process()
+        
+        # the file that failed to download is left to be retried, and its error is reported
+        self.assertEqual(list(FileToProcess.objects.values_list("pk", flat=True)), [missing.pk])
+        self.assertEqual(len(self.error_handler.errors), 1)
+        self.assertEqual(ChunkRegistry.objects.count(), 2)
+        self.assertEqual(self.chunk_contents(self.HOUR_1), self.CHUNK_HEADER + b"\n" + b"\n".join(
+            self.chunk_line(t) for t in (self.HOUR_1, self.HOUR_1 + 1000, self.HOUR_1 + 2000)
+        ))
+        self.assertEqual(self.chunk_contents(self.HOUR_2), self.CHUNK_HEADER + b"\n" + self.chunk_line(self.HOUR_2))
+        for chunk in ChunkRegistry.objects.all():
+            self.assertEqual(chunk.file_size, len(self.chunk_contents(int(chunk.time_bin.timestamp() * 1000))))
+    
+    @patch("libs.file_processing.file_processing_core.FILE_PROCESS_PAGE_SIZE", 1)
+    def test_merge_into_existing_chunks(self):
+        # one file per page, the later pages merge into the chunks uploaded by the earlier ones.
+        self.upload_file([self.HOUR_1 + 3000])
+        self.upload_file([self.HOUR_1 + 1000, self.HOUR_2])
+        self.upload_file([self.HOUR_1 + 2000, self.HOUR_1 + 3000])
+        self.process()
+        
+        self.assertFalse(FileToProcess.objects.exists())
+        self.assertEqual(self.error_handler.errors, {})
+        self.assertEqual(self.chunk_contents(self.HOUR_1), self.CHUNK_HEADER + b"\n" + b"\n".join(
+            self.chunk_line(t) for t in (self.HOUR_1 + 1000, self.HOUR_1 + 2000, self.HOUR_1 + 3000)
+        ))
+        self.assertEqual(self.chunk_contents(self.HOUR_2), self.CHUNK_HEADER + b"\n" + self.chunk_line(self.HOUR_2))
+    
+    @patch("libs.file_processing.file_processing_core.FILE_PROCESS_MERGE_QUEUE_DEPTH", 3)
+    @patch("libs.file_processing.file_processing_core.FILE_PROCESS_PAGE_SIZE", 1)
+    def test_merge_queue_keeps_pages_in_order(self):
+        self.upload_file([self.HOUR_1 + 3000])
+        self.upload_file([self.HOUR_1 + 1000])
+        self.upload_file([self.HOUR_1 + 2000])
+        self.process()
+        
+        self.assertFalse(FileToProcess.objects.exists())
+        self.assertEqual(self.chunk_contents(self.HOUR_1), self.CHUNK_HEADER + b"\n" + b"\n".join(
+            self.chunk_line(t) for t in (self.HOUR_1 + 1000, self.HOUR_1 + 2000, self.HOUR_1 + 3000)
+        ))
+    
+    def test_time_limit_leaves_files_for_next_run(self):
+        self.upload_file([self.HOUR_1])
+        pipeline = FileProcessingPipeline(self.error_handler)
+        try:
+            pipeline.process_participant(self.default_participant, time_limit=timedelta(seconds=-1))
+        finally:
+            pipeline.close()
+        
+        self.assertEqual(FileToProcess.objects.count(), 1)
+        self.assertFalse(ChunkRegistry.objects.exists())
+    
+    def process_with_budget(self, budget: int) -> "RecordingPipeline":
+        with patch("libs.file_processing.file_processing_core.FILE_PROCESS_MEMORY_BUDGET", budget):
+            pipeline = RecordingPipeline(self.error_handler)
+        try:
+            pipeline.process_participant(self.default_participant)
+        finally:
+            pipeline.close()
+        return pipeline
+    
+    def test_files_admitted_against_byte_budget(self):
+        for i in range(6):
+            self.upload_file([self.HOUR_1 + i * 1000])
+        file_size = max(len(contents) for contents in self.s3.objects.values())
+        # room for 4 files, pages are closed at half the budget
+        pipeline = self.process_with_budget(file_size * 4)
+        
+        self.assertFalse(FileToProcess.objects.exists())
+        self.assertLessEqual(pipeline.byte_budget.peak, file_size * 4)
+        self.assertEqual(pipeline.page_file_counts, [2, 2, 2])
+        self.assertEqual(pipeline.in_flight_bytes, 0)
+    
+    def test_oversized_file_processed_alone(self):
+        self.upload_file([self.HOUR_1])
+        self.upload_file([self.HOUR_1 + 1000])
+        big_file = self.upload_file([self.HOUR_1 + 2000 + i for i in range(200)])
+        self.upload_file([self.HOUR_1 + 3000])
+        big_file_size = len(self.s3.objects[big_file.s3_file_path])
+        # the budget is smaller than the big file
+        pipeline = self.process_with_budget(big_file_size // 2)
+        
+        self.assertFalse(FileToProcess.objects.exists())
+        self.assertEqual(pipeline.page_file_counts, [2, 1, 1])
+        self.assertEqual(pipeline.get_stats(), {
+            "memory_budget": big_file_size // 2, "peak_in_flight_bytes": big_file_size, "oversized_files": 1,
+        })
+        self.assertEqual(pipeline.in_flight_bytes, 0)
+        self.assertEqual(len(self.chunk_contents(self.HOUR_1).splitlines()), 204)
+    
+    @patch("libs.file_processing.batched_network_operations.s3_upload")
+    def test_bytes_released_after_failed_page(self, s3_upload_mock):
+        s3_upload_mock.side_effect = Exception("upload failed")
+        self.upload_file([self.HOUR_1])
+        self.upload_file([self.HOUR_2])
+        pipeline = self.process_with_budget(1024 * 1024)
+        
+        self.assertEqual(pipeline.page_file_counts, [2])
+        self.assertEqual(pipeline.in_flight_bytes, 0)
+        self.assertEqual(FileToProcess.objects.count(), 2)
+        self.assertFalse(ChunkRegistry.objects.exists())
+    
+    def test_data_quantity_stats_after_failed_upload(self):
+        self.upload_file([self.HOUR_1])
+        self.upload_file([self.HOUR_2])
+        failing_chunk_path_end = unix_time_to_string(self.HOUR_2 // 1000) + b".csv"
+        
+        def fail_hour_2(chunk_path, *args, **kwargs):
+            if chunk_path.encode().endswith(failing_chunk_path_end):
+                raise Exception("upload failed")
+            return s3_upload(chunk_path, *args, **kwargs)
+        
+        def summary_bytes() -> int:
+            return sum(SummaryStatisticDaily.objects.values_list("beiwe_accelerometer_bytes", flat=True))
+        
+        # the first hour is uploaded and registered, the page fails.
+        with patch("libs.file_processing.batched_network_operations.s3_upload", fail_hour_2):
+            self.process()
+        self.assertEqual(FileToProcess.objects.count(), 2)
+        self.assertEqual(summary_bytes(), ChunkRegistry.objects.get().file_size)
+        
+        # on the retry the first hour's chunk is unchanged, only the second hour is new.
+        self.process()
+        self.assertFalse(FileToProcess.objects.exists())
+        self.assertEqual(ChunkRegistry.objects.count(), 2)
+        self.assertEqual(summary_bytes(), sum(ChunkRegistry.objects.values_list("file_size", flat=True)))
+
+
+class RecordingPipeline(FileProcessingPipeline):
+    """ Records the number of files in each page that is uploaded. """
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.page_file_counts = []
+    
+    def upload_page(self, participant, page):
+        self.page_file_counts.append(page.file_count)
+        super().upload_page(participant, page)
@@ -1,7 +1,36 @@
+import json
+from datetime import datetime, timedelta
+from io import BytesIO
+from os import urandom
+from struct import unpack_from
+from zipfile import ZipFile
+from unittest.mock import MagicMock, patch
+from zlib import crc32
+
+from botocore.exceptions import EndpointConnectionError
+from botocore.stub import Stubber
+from dateutil import tz
+from Cryptodome.Cipher import AES
 from django.core.exceptions import ValidationError
+from django.db import connection
+from django.utils import timezone
 
+from api.dashboard_api import dashboard_chunkregistry_date_query
+from constants.common_constants import BEIWE_PROJECT_ROOT
+from constants.data_stream_constants import ACCELEROMETER, GPS, POWER_STATE, VOICE_RECORDING
+from database.data_access_models import ChunkRegistry, ChunkTimeRange
+from database.profiling_models import EncryptionErrorMetadata, LineEncryptionError
 from database.study_models import DeviceSettings, Study
+from libs.encryption import (decrypt_device_file, decrypt_server, decrypt_server_stream,
+    encrypt_for_server, get_RSA_cipher)
+from libs.key_caches import (AES_KEY_CACHE, LRUCache, PRIVATE_KEY_CACHE,
+    STUDY_ENCRYPTION_KEY_CACHE)
+from libs.s3 import (make_s3_client, S3_METRICS, s3_max_pool_connections, s3_retrieve,
+    s3_retrieve_to_file, s3_upload, s3_upload_encrypted)
+from libs.security import encode_base64
+from libs.streaming_zip import prefetching_zip_generator
 from tests.common import CommonTestCase
+from tests.helpers import DummyS3Client
 
 
 # This file contains some minimal tests of some models.  They are old, they were written before 
@@ -62,3 +91,535 @@ class StudyModelTests(CommonTestCase):
 
         bad_study = Study.create_with_object_id(name='name', encryption_key=encryption_key, deleted=True)
         self.assertNotIn(bad_study, Study.get_all_studies_by_name())
+
+
+class ChunkRegistryModelTests(CommonTestCase):
+    CONTENTS = b"timestamp,UTC time,x\n1000,1970-01-01T00:00:01.000,a\n2000,1970-01-01T00:00:02.000,a"
+    
+    def build_chunk(self, chunk_path: str) -> ChunkRegistry:
+        return ChunkRegistry.build_chunked_data(
+            ACCELEROMETER, 0, chunk_path, self.CONTENTS, self.session_study.pk, self.default_participant.pk
+        )
+    
+    def test_bulk_register(self):
+        existing = self.generate_chunk_registry(self.session_study, self.default_participant, ACCELEROMETER)
+        existing.set_chunk_contents(self.CONTENTS)
+        ChunkRegistry.bulk_register_chunked_data([self.build_chunk("a"), self.build_chunk("b")], [existing])
+        
+        self.assertEqual(ChunkRegistry.objects.count(), 3)
+        for chunk in ChunkRegistry.objects.all():
+            self.assertEqual(chunk.file_size, len(self.CONTENTS))
+    
+    def test_bulk_register_duplicate_path(self):
+        self.assertEqual(ChunkRegistry.bulk_register_chunked_data([self.build_chunk("a")], []), [])
+        duplicate = self.build_chunk("a")
+        failures = ChunkRegistry.bulk_register_chunked_data(
+            [self.build_chunk("b"), duplicate, self.build_chunk("c")], []
+        )
+        # every other chunk is saved, the duplicate fails like individual registration does.
+        self.assertEqual(len(failures), 1)
+        self.assertIs(failures[0][0], duplicate)
+        self.assertIsInstance(failures[0][1], ValidationError)
+        self.assertEqual(
+            sorted(ChunkRegistry.objects.values_list("chunk_path", flat=True)), ["a", "b", "c"]
+        )
+    
+    def test_bulk_register_validates_new_chunks(self):
+        invalid = self.build_chunk("a" * 300)  # longer than chunk_path's max_length
+        failures = ChunkRegistry.bulk_register_chunked_data([self.build_chunk("b"), invalid], [])
+        self.assertEqual(len(failures), 1)
+        self.assertIs(failures[0][0], invalid)
+        self.assertIsInstance(failures[0][1], ValidationError)
+        self.assertEqual(list(ChunkRegistry.objects.values_list("chunk_path", flat=True)), ["b"])
+    
+    def test_bulk_register_updates_last_updated(self):
+        existing = self.generate_chunk_registry(self.session_study, self.default_participant, ACCELEROMETER)
+        ChunkRegistry.objects.filter(pk=existing.pk).update(last_updated=datetime(2020, 1, 1, tzinfo=timezone.utc))
+        existing.refresh_from_db()
+        existing.set_chunk_contents(self.CONTENTS)
+        ChunkRegistry.bulk_register_chunked_data([], [existing])
+        existing.refresh_from_db()
+        self.assertGreater(existing.last_updated, datetime(2020, 1, 1, tzinfo=timezone.utc))
+
+
+class ChunkTimeRangeTests(CommonTestCase):
+    CONTENTS = ChunkRegistryModelTests.CONTENTS
+    
+    def register(self, data_type: str, time_bin: datetime, chunk_path: str):
+        # build_chunked_data takes the time bin as a number of hours since the epoch
+        chunk = ChunkRegistry.build_chunked_data(
+            data_type, int(time_bin.timestamp()) // 3600, chunk_path, self.CONTENTS,
+            self.session_study.pk, self.default_participant.pk,
+        )
+        ChunkRegistry.bulk_register_chunked_data([chunk], [])
+    
+    def assert_time_range(self, data_type: str, earliest: datetime, latest: datetime):
+        time_range = ChunkTimeRange.objects.get(participant=self.default_participant, data_type=data_type)
+        self.assertEqual((time_range.earliest_time_bin, time_range.latest_time_bin), (earliest, latest))
+    
+    def test_registering_expands_time_range(self):
+        day = datetime(2020, 10, 5, tzinfo=tz.UTC)
+        self.register(ACCELEROMETER, day, "a")
+        self.assert_time_range(ACCELEROMETER, day, day)
+        self.register(ACCELEROMETER, day + timedelta(hours=3), "b")
+        self.register(ACCELEROMETER, day - timedelta(hours=2), "c")
+        self.register(ACCELEROMETER, day + timedelta(hours=1), "d")
+        self.assert_time_range(ACCELEROMETER, day - timedelta(hours=2), day + timedelta(hours=3))
+        self.register(GPS, day, "e")
+        self.assert_time_range(GPS, day, day)
+        self.assertEqual(ChunkTimeRange.objects.count(), 2)
+    
+    def test_invalid_time_bins_ignored(self):
+        self.register(ACCELEROMETER, datetime(1970, 1, 1, 5, tzinfo=tz.UTC), "a")
+        self.assertFalse(ChunkTimeRange.objects.exists())
+    
+    def test_unchunked_data(self):
+        ChunkRegistry.register_unchunked_data(
+            VOICE_RECORDING, 1601870400, "a", self.session_study.pk, self.default_participant.pk,
+            b"content",
+        )
+        day = datetime(2020, 10, 5, 4, tzinfo=tz.UTC)
+        self.assert_time_range(VOICE_RECORDING, day, day)
+    
+    def test_study_and_dashboard_time_range(self):
+        self.assertIsNone(self.session_study.get_earliest_data_time_bin())
+        self.assertEqual(dashboard_chunkregistry_date_query(self.session_study.pk), (None, None))
+        
+        day = datetime(2020, 10, 5, tzinfo=tz.UTC)
+        self.register(ACCELEROMETER, day, "a")
+        self.register(GPS, day + timedelta(days=2), "b")
+        self.assertEqual(self.session_study.get_earliest_data_time_bin(), day)
+        self.assertEqual(self.session_study.get_latest_data_time_bin(), day + timedelta(days=2))
+        self.assertEqual(
+            dashboard_chunkregistry_date_query(self.session_study.pk),
+            (day.date(), (day + timedelta(days=2)).date()),
+        )
+        self.assertEqual(
+            dashboard_chunkregistry_date_query(self.session_study.pk, ACCELEROMETER),
+            (day.date(), day.date()),
+        )
+    
+    def test_future_time_bins(self):
+        day = datetime(2020, 10, 5, tzinfo=tz.UTC)
+        self.register(ACCELEROMETER, day, "a")
+        self.register(ACCELEROMETER, datetime(2100, 1, 1, tzinfo=tz.UTC), "b")
+        self.assertEqual(self.session_study.get_latest_data_time_bin(), day)
+        self.assertEqual(
+            self.session_study.get_latest_data_time_bin(only_before_now=False),
+            datetime(2100, 1, 1, tzinfo=tz.UTC),
+        )
+    
+    def test_future_time_bins_queried_per_data_stream(self):
+        day = datetime(2020, 10, 5, tzinfo=tz.UTC)
+        future = datetime(2100, 1, 1, tzinfo=tz.UTC)
+        self.register(ACCELEROMETER, day, "a")
+        # data before and after now, the latest time bin before now is the study's latest
+        self.register(GPS, day - timedelta(days=1), "b")
+        self.register(GPS, day + timedelta(days=1), "c")
+        self.register(GPS, future, "d")
+        # only data in the future, this data stream is not queried
+        self.register(POWER_STATE, future, "e")
+        # the time ranges, then one ChunkRegistry query for GPS
+        with self.assertNumQueries(3):
+            self.assertEqual(self.session_study.get_latest_data_time_bin(), day + timedelta(days=1))
+        self.assertEqual(self.session_study.get_earliest_data_time_bin(), day - timedelta(days=1))
+        
+        ChunkRegistry.objects.filter(chunk_path="c").delete()
+        self.assertEqual(self.session_study.get_latest_data_time_bin(), day)
+    
+    def test_recalculate_participant(self):
+        day = datetime(2020, 10, 5, tzinfo=tz.UTC)
+        self.register(ACCELEROMETER, day, "a")
+        self.register(ACCELEROMETER, day + timedelta(days=1), "b")
+        self.register(GPS, day, "c")
+        ChunkRegistry.objects.filter(chunk_path__in=["b", "c"]).delete()
+        ChunkTimeRange.recalculate_participant(self.default_participant)
+        self.assert_time_range(ACCELEROMETER, day, day)
+        self.assertFalse(ChunkTimeRange.objects.filter(data_type=GPS).exists())
+
+
+class ChunkRegistryQueryPlanTests(CommonTestCase):
+    """ Runs EXPLAIN on the hot ChunkRegistry queries, and checks that they use the composite
+    indexes declared on ChunkRegistry.Meta. """
+    
+    def setUp(self) -> None:
+        super().setUp()
+        self.now = timezone.now()
+        for i in range(20):
+            self.generate_chunk_registry(
+                self.session_study, self.default_participant, GPS, time_bin=self.now - timedelta(hours=i)
+            )
+        if connection.vendor == "postgresql":
+            # the test tables are tiny, sequential scans would always win.
+            with connection.cursor() as cursor:
+                cursor.execute("SET enable_seqscan = off")
+    
+    def assert_uses_index(self, index_name: str, plan: str):
+        self.assertIn(index_name, plan, f"\nthe query plan did not use {index_name}:\n{plan}")
+    
+    def test_get_chunks_time_range(self):
+        query = ChunkRegistry.get_chunks_time_range(
+            self.session_study.id, data_types=[GPS], start=self.now - timedelta(days=1), end=self.now
+        )
+        self.assert_uses_index("chunk_study_type_time", query.explain())
+    
+    def test_get_chunks_time_range_users(self):
+        query = ChunkRegistry.get_chunks_time_range(
+            self.session_study.id, user_ids=[self.default_participant.patient_id], data_types=[GPS],
+            start=self.now - timedelta(days=1), end=self.now,
+        )
+        self.assert_uses_index("chunk_participant_type_time", query.explain())
+    
+    def test_participant_time_window(self):
+        # the query in services.celery_forest.celery_run_forest
+        query = ChunkRegistry.objects.filter(participant=self.default_participant) \
+            .filter(time_bin__gte=self.now - timedelta(days=1)).filter(time_bin__lte=self.now)
+        self.assert_uses_index("chunk_participant_time", query.explain())
+    
+    def test_get_updated_users_for_study(self):
+        query = ChunkRegistry.get_updated_users_for_study(
+            self.session_study, self.now - timedelta(days=1)
+        )
+        self.assert_uses_index("chunk_study_updated", query.explain())
+
+
+class DeviceEncryptionTestCase(CommonTestCase):
+    with open(f"{BEIWE_PROJECT_ROOT}/tests/files/private_key", 'rb') as f:
+        PRIVATE_KEY = get_RSA_cipher(f.read())
+    with open(f"{BEIWE_PROJECT_ROOT}/tests/files/public_key", 'rb') as f:
+        PUBLIC_KEY = get_RSA_cipher(f.read())
+    
+    def setUp(self) -> None:
+        PRIVATE_KEY_CACHE.clear()
+        AES_KEY_CACHE.clear()
+        return super().setUp()
+    
+    def encrypt_device_line(self, aes_key: bytes, line: bytes) -> bytes:
+        iv = urandom(16)
+        padding = 16 - len(line) % 16
+        data = AES.new(aes_key, AES.MODE_CBC, iv=iv).encrypt(line + bytes([padding]) * padding)
+        return encode_base64(iv) + b":" + encode_base64(data)
+    
+    def encrypt_device_file(self, aes_key: bytes, lines: list) -> bytes:
+        """ Encrypts lines the way the apps do. """
+        key_line = encode_base64(self.PUBLIC_KEY.encrypt(encode_base64(aes_key), None)[0])
+        return b"\n".join([key_line] + [self.encrypt_device_line(aes_key, line) for line in lines])
+
+
+class ParticipantKeyCacheTests(DeviceEncryptionTestCase):
+    
+    def test_lru_cache(self):
+        cache = LRUCache(2)
+        cache.set(("a", 1), 1)
+        cache.set(("b", 1), 2)
+        self.assertEqual(cache.get(("a", 1)), 1)
+        cache.set(("a", 2), 3)  # ("b", 1) is the least recently used
+        self.assertIsNone(cache.get(("b", 1)))
+        cache.remove_participant("a")
+        self.assertEqual(len(cache), 0)
+    
+    @patch("libs.s3.get_client_private_key")
+    def test_private_key_cached(self, get_client_private_key: MagicMock):
+        get_client_private_key.return_value = self.PRIVATE_KEY
+        participant = self.default_participant
+        self.assertIs(participant.get_private_key(), self.PRIVATE_KEY)
+        self.assertIs(participant.get_private_key(), self.PRIVATE_KEY)
+        self.assertEqual(get_client_private_key.call_count, 1)
+        participant.clear_key_caches()
+        participant.get_private_key()
+        self.assertEqual(get_client_private_key.call_count, 2)
+    
+    @patch("database.user_models.Participant.get_private_key")
+    def test_aes_key_cached(self, get_private_key: MagicMock):
+        get_private_key.return_value = self.PRIVATE_KEY
+        participant = self.default_participant
+        aes_key = urandom(16)
+        
+        for contents in (b"a,b,c", b"d,e,f"):
+            file_data = self.encrypt_device_file(aes_key, [contents])
+            self.assertEqual(decrypt_device_file("file.csv", file_data, participant), contents)
+        self.assertEqual(get_private_key.call_count, 1)
+        
+        # a new device (or a reset) clears the cache
+        participant.clear_key_caches()
+        self.assertEqual(decrypt_device_file("file.csv", file_data, participant), b"d,e,f")
+        self.assertEqual(get_private_key.call_count, 2)
+
+
+class StudyKeyCacheTests(CommonTestCase):
+    
+    def setUp(self):
+        STUDY_ENCRYPTION_KEY_CACHE.clear()
+    
+    def test_study_key_cached(self):
+        study = self.session_study
+        with self.assertNumQueries(1):
+            encrypted = encrypt_for_server(b"some data", study.object_id)
+        with self.assertNumQueries(0):
+            self.assertEqual(decrypt_server(encrypted, study.object_id), b"some data")
+    
+    def test_study_key_invalidated_on_save(self):
+        study = self.session_study
+        encrypt_for_server(b"some data", study.object_id)
+        study.encryption_key = "a" * 32
+        study.save()
+        encrypted = encrypt_for_server(b"some data", study.object_id)
+        # decrypting with the new key directly
+        self.assertEqual(
+            AES.new(b"a" * 32, AES.MODE_CFB, segment_size=8, IV=encrypted[:16]).decrypt(encrypted[16:]),
+            b"some data",
+        )
+    
+    def test_study_key_expires(self):
+        study = self.session_study
+        STUDY_ENCRYPTION_KEY_CACHE.set(study.object_id, b"b" * 32)
+        with patch("libs.key_caches.monotonic", return_value=10 ** 12):
+            with self.assertNumQueries(1):
+                encrypt_for_server(b"some data", study.object_id)
+
+
+class ServerStreamDecryptionTests(CommonTestCase):
+    
+    def test_decrypt_server_stream(self):
+        object_id = self.session_study.object_id
+        data = urandom(1000)
+        encrypted = encrypt_for_server(data, object_id)
+        # the iv can be split across blocks
+        for block_size in (1, 7, 16, 17, 100, 2000):
+            blocks = [encrypted[i:i + block_size] for i in range(0, len(encrypted), block_size)]
+            self.assertEqual(b"".join(decrypt_server_stream(blocks, object_id)), data)
+            self.assertEqual(decrypt_server(encrypted, object_id), data)
+    
+    def test_decrypt_server_stream_no_iv(self):
+        with self.assertRaises(ValueError):
+            list(decrypt_server_stream([b"too short"], self.session_study.object_id))
+    
+    @patch("libs.s3.conn")
+    def test_s3_retrieve_to_file(self, conn: MagicMock):
+        object_id = self.session_study.object_id
+        data = urandom(1000)
+        conn.get_object.return_value = {"Body": BytesIO(encrypt_for_server(data, object_id))}
+        sink = BytesIO()
+        self.assertEqual(s3_retrieve_to_file("a_file", object_id, sink, block_size=64), 1000)
+        self.assertEqual(sink.getvalue(), data)
+        conn.get_object.assert_called_once()
+        self.assertEqual(conn.get_object.call_args.kwargs["Key"], object_id + "/a_file")
+
+
+@patch("libs.s3.S3_MULTIPART_CONCURRENCY", 2)
+@patch("libs.s3.S3_MULTIPART_PART_SIZE", 100)
+@patch("libs.s3.S3_MULTIPART_THRESHOLD", 250)
+class S3UploadTests(CommonTestCase):
+    
+    def setUp(self):
+        self.s3 = DummyS3Client(minimum_part_size=100)
+        patcher = patch("libs.s3.conn", self.s3)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+    
+    def test_small_upload_uses_put_object(self):
+        object_id = self.session_study.object_id
+        data = urandom(249)
+        s3_upload("a_file", data, object_id)
+        self.assertEqual(len(self.s3.objects), 1)
+        self.assertEqual(s3_retrieve("a_file", object_id), data)
+    
+    def test_multipart_upload(self):
+        object_id = self.session_study.object_id
+        data = urandom(1234)
+        with patch.object(self.s3, "put_object") as put_object:
+            s3_upload("a_file", data, object_id)
+            put_object.assert_not_called()
+        self.assertEqual(s3_retrieve("a_file", object_id), data)
+    
+    def test_multipart_upload_aborted(self):
+        object_id = self.session_study.object_id
+        with patch.object(self.s3, "upload_part", side_effect=Exception("a persistent failure")):
+            with self.assertRaises(Exception):
+                s3_upload("a_file", urandom(1000), object_id)
+        self.assertEqual(self.s3.objects, {})
+        self.assertEqual(self.s3.multipart_uploads, {})
+    
+    @patch("libs.s3.S3_MULTIPART_CONCURRENCY", 1)
+    @patch("libs.s3.S3_BUCKET", "a_bucket")
+    @patch("libs.s3.BEIWE_SERVER_AWS_SECRET_ACCESS_KEY", "a_secret_key")
+    @patch("libs.s3.BEIWE_SERVER_AWS_ACCESS_KEY_ID", "an_access_key")
+    def test_multipart_upload_parameters(self):
+        # a real client validates the request parameters (e.g. that Body is bytes), it is stubbed
+        # after validation.  Parts are uploaded one at a time so the calls are in order.
+        client = make_s3_client()
+        encrypted_data = urandom(250)
+        key = {"Bucket": "a_bucket", "Key": "a_file"}
+        with Stubber(client) as stubber, patch("libs.s3.conn", client):
+            stubber.add_response("create_multipart_upload", {"UploadId": "an_upload"}, key)
+            for part_number in (1, 2, 3):
+                start = (part_number - 1) * 100
+                stubber.add_response("upload_part", {"ETag": str(part_number)}, dict(
+                    key, UploadId="an_upload", PartNumber=part_number,
+                    Body=encrypted_data[start:start + 100],
+                ))
+            stubber.add_response("complete_multipart_upload", {}, dict(
+                key, UploadId="an_upload", MultipartUpload={"Parts": [
+                    {"ETag": str(part_number), "PartNumber": part_number} for part_number in (1, 2, 3)
+                ]},
+            ))
+            s3_upload_encrypted("a_file", encrypted_data)
+            stubber.assert_no_pending_responses()
+
+
+class S3ClientTests(CommonTestCase):
+    
+    def setUp(self):
+        S3_METRICS.clear()
+    
+    def test_client_config(self):
+        config = make_s3_client().meta.config
+        self.assertEqual(config.max_pool_connections, s3_max_pool_connections())
+        self.assertEqual(config.retries["mode"], "adaptive")
+    
+    @patch("libs.s3.CONCURRENT_NETWORK_OPS", 20)
+    def test_pool_size_scales_with_concurrency(self):
+        self.assertEqual(s3_max_pool_connections(), 80)
+        with patch("libs.s3.S3_MAX_POOL_CONNECTIONS", 12):
+            self.assertEqual(s3_max_pool_connections(), 12)
+    
+    def test_metrics(self):
+        client = make_s3_client()
+        params = {"Bucket": "a_bucket", "Key": "a_key"}
+        with Stubber(client) as stubber:
+            stubber.add_response(
+                "head_object", {"ContentLength": 5, "ResponseMetadata": {"RetryAttempts": 2}}, params
+            )
+            stubber.add_client_error("head_object", "404", expected_params=params)
+            client.head_object(**params)
+            with self.assertRaises(Exception):
+                client.head_object(**params)
+        metrics = S3_METRICS.as_dict()["HeadObject"]
+        self.assertEqual(metrics["calls"], 2)
+        self.assertEqual(metrics["retries"], 2)
+        self.assertEqual(metrics["errors"], 1)
+        self.assertGreater(metrics["total_seconds"], 0)
+    
+    @patch("libs.s3.S3_MAX_ATTEMPTS", 1)
+    @patch("libs.s3.BEIWE_SERVER_AWS_SECRET_ACCESS_KEY", "a_secret_key")
+    @patch("libs.s3.BEIWE_SERVER_AWS_ACCESS_KEY_ID", "an_access_key")
+    def test_metrics_connection_error(self):
+        # requests are signed before they are sent, the client needs (any) credentials.
+        client = make_s3_client()
+        
+        def refuse_connection(request, **kwargs):
+            raise EndpointConnectionError(endpoint_url=request.url)
+        
+        client.meta.events.register("before-send.s3", refuse_connection)
+        with self.assertRaises(EndpointConnectionError):
+            client.head_object(Bucket="a_bucket", Key="a_key")
+        metrics = S3_METRICS.as_dict()["HeadObject"]
+        self.assertEqual(metrics["calls"], 1)
+        self.assertEqual(metrics["retries"], 0)
+        self.assertEqual(metrics["errors"], 1)
+
+
+class DecryptDeviceFileTests(DeviceEncryptionTestCase):
+    
+    @patch("libs.encryption.STORE_DECRYPTION_LINE_ERRORS", True)
+    @patch("database.user_models.Participant.get_private_key")
+    def test_line_errors(self, get_private_key: MagicMock):
+        get_private_key.return_value = self.PRIVATE_KEY
+        aes_key = urandom(16)
+        good_lines = [b"1601863200000,a", b"", b"1601863200001," + b"b" * 100, b"x" * 16]
+        bad_lines = [
+            b"no colon",
+            encode_base64(urandom(16)) + b":" + encode_base64(b"short"),  # too little data
+            encode_base64(urandom(8)) + b":" + encode_base64(urandom(32)),  # short iv
+            encode_base64(urandom(20)) + b":" + encode_base64(urandom(32)),  # long iv
+        ]
+        file_data = self.encrypt_device_file(aes_key, good_lines[:2])
+        file_data += b"\n" + b"\n".join(bad_lines)
+        file_data += b"\n" + b"\n".join(self.encrypt_device_line(aes_key, line) for line in good_lines[2:])
+        
+        self.assertEqual(
+            decrypt_device_file("file.csv", file_data, self.default_participant), b"\n".join(good_lines)
+        )
+        expected_errors = [
+            LineEncryptionError.MALFORMED_CONFIG, LineEncryptionError.LINE_EMPTY,
+            LineEncryptionError.IV_MISSING, LineEncryptionError.IV_BAD_LENGTH,
+        ]
+        self.assertEqual(
+            list(LineEncryptionError.objects.order_by("pk").values_list("type", flat=True)), expected_errors
+        )
+        metadata = EncryptionErrorMetadata.objects.get()
+        self.assertEqual(metadata.number_errors, 4)
+        self.assertEqual(json.loads(metadata.error_types), expected_errors)
+
+
+class PrefetchingZipGeneratorTests(CommonTestCase):
+    
+    def setUp(self):
+        self.s3 = DummyS3Client()
+        patcher = patch("libs.s3.conn", self.s3)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+    
+    def upload_chunks(self, file_contents: list) -> list:
+        """ Uploads files and returns chunk dicts for them, as from ChunkRegistry.values(). """
+        study = self.session_study
+        chunks = []
+        for i, contents in enumerate(file_contents):
+            chunk_path = f"{study.object_id}/patient1/{ACCELEROMETER}/{i}.csv"
+            s3_upload(chunk_path, contents, study.object_id, raw_path=True)
+            chunks.append({
+                "chunk_path": chunk_path,
+                "chunk_hash": str(i),
+                "data_type": ACCELEROMETER,
+                "participant__patient_id": "patient1",
+                "study_id": study.id,
+                "time_bin": datetime(2021, 1, 1, i),
+                "file_size": len(contents),
+            })
+        return chunks
+    
+    def test_zip_contents_and_order(self):
+        # the last file is written as its own pieces, the others are combined with the zip headers
+        file_contents = [urandom(100 * (i + 1)) for i in range(5)] + [urandom(200 * 1024)]
+        chunks = self.upload_chunks(file_contents)
+        # a duplicate file name, which is not included
+        chunks.append(dict(chunks[0], chunk_path=chunks[1]["chunk_path"], chunk_hash="6"))
+        
+        # the window only fits two files
+        zip_data = b"".join(
+            prefetching_zip_generator(chunks, construct_registry=True, prefetch_workers=2, prefetch_bytes=700)
+        )
+        zip_file = ZipFile(BytesIO(zip_data))
+        self.assertIsNone(zip_file.testzip())
+        names = zip_file.namelist()
+        self.assertEqual(len(names), 7)
+        self.assertEqual(names[-1], "registry")
+        for name, contents in zip(names, file_contents):
+            self.assertEqual(zip_file.read(name), contents)
+        self.assertEqual(len(json.loads(zip_file.read("registry"))), 6)
+    
+    def test_complete_local_headers(self):
+        # streaming unzip clients read the local headers, they must have the crc and sizes, and no
+        # data descriptor (flag 0x08).
+        file_contents = [b"a,b,c", urandom(200 * 1024)]
+        zip_data = b"".join(prefetching_zip_generator(self.upload_chunks(file_contents), construct_registry=True))
+        zip_file = ZipFile(BytesIO(zip_data))
+        self.assertIsNone(zip_file.testzip())
+        for zinfo in zip_file.infolist():
+            contents = zip_file.read(zinfo)
+            signature, flags, crc, compressed_size, file_size = unpack_from(
+                "<4s2xH6xLLL", zip_data, zinfo.header_offset
+            )
+            self.assertEqual(signature, b"PK\x03\x04")
+            self.assertEqual(flags & 0x08, 0)
+            self.assertEqual(crc, crc32(contents))
+            self.assertEqual((compressed_size, file_size), (len(contents), len(contents)))
+    
+    def test_study_looked_up_once(self):
+        chunks = self.upload_chunks([b"a,b,c", b"d,e,f", b"g,h,i"])
+        STUDY_ENCRYPTION_KEY_CACHE.clear()
+        with self.assertNumQueries(1):  # the study's object id and encryption key
+            zip_data = b"".join(prefetching_zip_generator(chunks))
+        self.assertEqual(len(ZipFile(BytesIO(zip_data)).namelist()), 3)
+        # the key is passed to the download threads, they don't use the key cache
+        self.assertIsNone(STUDY_ENCRYPTION_KEY_CACHE.get(self.session_study.object_id))
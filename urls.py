@@ -337,6 +337,14 @@ urlpatterns = [
         "get-data/v1",
         data_access_api.get_data,
         name="data_access_api.get_data"),
+    path(
+        "get-data-manifest/v1",
+        data_access_api.get_data_manifest,
+        name="data_access_api.get_data_manifest"),
+    path(
+        "get-data-range/v1",
+        data_access_api.get_data_range,
+        name="data_access_api.get_data_range"),
     # path(
     #     "get-pipeline/v1",
     #     data_access_api.pipeline_data_download,